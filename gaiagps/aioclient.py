@@ -0,0 +1,383 @@
+import asyncio
+import logging
+import os
+import pprint
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from gaiagps import apiclient
+from gaiagps.apiclient import AuthFailure, find, gurl
+from gaiagps import util
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _logresp(r):
+    LOG.debug('Response: %s %s: %r' % (r.status_code, r.reason_phrase,
+                                       r.content))
+
+
+class AsyncGaiaClient(object):
+    """An asyncio-native client for gaiagps.com.
+
+    This provides the same operations as
+    :class:`~gaiagps.apiclient.GaiaClient`, as coroutines. All requests
+    share a single connection pool, so many of them can be in flight at
+    once on a single thread. This requires the ``httpx`` package.
+
+    Unlike :class:`~gaiagps.apiclient.GaiaClient`, constructing the client
+    does not contact the server. Call :func:`~connect()` (or use the client
+    as an async context manager) to check the session and login if
+    necessary::
+
+      async with AsyncGaiaClient(user, password, cookies=jar) as client:
+          waypoints = await client.list_objects('waypoint')
+
+    :param username: Username for gaiagps.com
+    :type username: str
+    :param password: Password for gaiagps.com
+    :type password: str
+    :param cookies: A cookie jar or ``None``. The jar is used directly, so
+                    it can be shared with (and saved like the one used by)
+                    :class:`~gaiagps.apiclient.GaiaClient`.
+    :type cookies: http.cookiejar.CookieJar
+    :param concurrency: The default number of requests to run at once
+                        for bulk operations like :func:`~get_objects()`
+    :type concurrency: int
+    :param max_connections: The size of the shared connection pool
+    :type max_connections: int
+    :raises RuntimeError: if httpx is not available
+    """
+
+    def __init__(self, username, password, cookies=None,
+                 concurrency=util.DEFAULT_CONCURRENCY, max_connections=100):
+        if httpx is None:
+            raise RuntimeError('AsyncGaiaClient requires httpx')
+
+        self.username = username
+        self.password = password
+        self.concurrency = concurrency
+        self.s = httpx.AsyncClient(
+            headers={
+                'User-Agent': apiclient.USER_AGENT,
+                'Accept': 'application/json, text/plain, */*',
+            },
+            cookies=cookies,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections),
+            # Match the (lack of) timeouts of the synchronous client
+            timeout=None)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        """Check the session and login (if necessary).
+
+        :raises AuthFailure: if login fails
+        :raises RuntimeError: if session is stale and credentials are
+                not provided
+        """
+        if not await self.test_auth():
+            if not all([self.username, self.password]):
+                raise RuntimeError('Session expired; '
+                                   'username and password are required')
+            LOG.debug('Not authenticated, logging in...')
+            await self.login()
+        else:
+            LOG.debug('Already logged in')
+
+    async def close(self):
+        """Close the connection pool."""
+        await self.s.aclose()
+
+    async def test_auth(self):
+        """Test the session to see if we are successfully logged in.
+
+        :returns: ``True`` if we are already logged in
+        :rtype: `bool`
+        """
+        r = await self.s.get(gurl('profile'))
+        return 'login' not in str(r.url)
+
+    async def login(self):
+        """Login with our credentials.
+
+        There is usually no need to call this directly, as it will be
+        called from :func:`~connect()` when necessary.
+
+        :raises AuthFailure: if login is not possible
+        """
+        r = await self.s.post(gurl('register/addDevice'),
+                              data={'email': self.username,
+                                    'password': self.password})
+        if r.status_code >= 400:
+            LOG.debug('Status code from login was %s' % r.status_code)
+            raise AuthFailure('Login failed')
+
+        if 'login' in str(r.url):
+            LOG.debug('Post login expected /, got %s' % r.url)
+            raise AuthFailure('Login failed')
+
+        LOG.info('Login successful')
+
+    async def iter_objects(self, objtype, archived=True,
+                           page_size=apiclient.DEFAULT_PAGE_SIZE):
+        """Generates object descriptions, one page at a time.
+
+        See :func:`gaiagps.apiclient.GaiaClient.iter_objects`. This is an
+        asynchronous generator, for use with ``async for``.
+        """
+        assert objtype in ('folder', 'track', 'waypoint', 'photo')
+
+        page = 1
+        while True:
+            r = await self.s.get(gurl('api', 'objects', objtype),
+                                 params=apiclient._list_params(archived,
+                                                               page,
+                                                               page_size))
+            items = r.json()
+            for item in items:
+                yield item
+
+            LOG.debug('Listed %i %ss from page %i' % (len(items), objtype,
+                                                      page))
+            if len(items) < page_size:
+                break
+            page += 1
+
+    async def list_objects(self, objtype, archived=True):
+        """Returns a list of object descriptions.
+
+        See :func:`gaiagps.apiclient.GaiaClient.list_objects`.
+        """
+        return [item async for item in self.iter_objects(objtype,
+                                                         archived=archived)]
+
+    async def lookup_object(self, objtype, name):
+        """Lookup a single object by name.
+
+        See :func:`gaiagps.apiclient.GaiaClient.lookup_object`.
+        """
+        objects = await self.list_objects(objtype)
+        return find(objects, 'title', name)
+
+    async def get_object(self, objtype, name=None, id_=None, fmt=None):
+        """Return an object data structure by name or id.
+
+        See :func:`gaiagps.apiclient.GaiaClient.get_object`.
+        """
+        if not any([name, id_]):
+            raise RuntimeError('Object name or id must be specified')
+
+        if id_ is None:
+            id_ = (await self.lookup_object(objtype, name))['id']
+
+        resource = apiclient._object_resource(id_, fmt)
+
+        result = await self.s.get(gurl('api', 'objects', objtype, resource))
+        if fmt is None:
+            objdata = result.json()
+            LOG.debug('Retrieved object %s/%s: %s' % (
+                objtype, resource, objdata))
+            return objdata
+        else:
+            return result.content
+
+    async def get_objects(self, objtype, ids, concurrency=None,
+                          return_exceptions=False):
+        """Fetch many objects by id.
+
+        Up to ``concurrency`` requests are run at once. Unlike
+        :func:`gaiagps.apiclient.GaiaClient.get_objects`, this returns a
+        complete list (in ``ids`` order) once all of them have finished.
+
+        :param objtype: The type of the objects
+        :type objtype: str
+        :param ids: The ids of the objects to fetch
+        :type ids: list
+        :param concurrency: The maximum number of requests to run at once
+                            (defaults to the client's ``concurrency``)
+        :type concurrency: int
+        :param return_exceptions: If ``True``, a failure to fetch an object
+                                  is reported by returning the exception in
+                                  its place instead of raising it
+        :type return_exceptions: bool
+        :returns: A list of object data structures
+        :rtype: `list`
+        """
+        sem = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def _get(id_):
+            async with sem:
+                return await self.get_object(objtype, id_=id_)
+
+        return await asyncio.gather(*[_get(id_) for id_ in ids],
+                                    return_exceptions=return_exceptions)
+
+    async def create_object(self, objtype, objdata):
+        """Create an object.
+
+        See :func:`gaiagps.apiclient.GaiaClient.create_object`.
+        """
+        LOG.debug('Creating %s: %s' % (objtype, pprint.pformat(objdata)))
+        r = await self.s.post(gurl('api', 'objects', objtype), json=objdata)
+        _logresp(r)
+        if r.status_code < 400:
+            obj = r.json()
+            if 'id' not in obj and 'id' in obj.get('properties', {}):
+                obj['id'] = obj['properties']['id']
+            return obj
+
+    async def put_object(self, objtype, objdata):
+        """Update an object.
+
+        See :func:`gaiagps.apiclient.GaiaClient.put_object`.
+        """
+        LOG.debug('Putting %s/%s: %s' % (objtype, objdata['id'],
+                                         pprint.pformat(objdata)))
+        r = await self.s.put(gurl('api', 'objects', objtype, objdata['id']),
+                             json=objdata)
+        _logresp(r)
+        if r.status_code <= 201:
+            return r.json()
+        elif r.status_code < 299:
+            return True
+
+    async def delete_object(self, objtype, id_):
+        """Delete an object by id.
+
+        See :func:`gaiagps.apiclient.GaiaClient.delete_object`.
+        """
+        r = await self.s.delete(gurl('api', 'objects', objtype, id_))
+        _logresp(r)
+
+    async def _update_folder_members(self, folderid, objects, add):
+        # Check the types before doing any work
+        for objtype in objects:
+            apiclient._folder_list_key(objtype)
+
+        folders = await self.list_objects('folder')
+        folder = find(folders, 'id', folderid)
+        apiclient._apply_folder_members(folder, objects, add)
+
+        LOG.debug('Updating folder %s: %s' % (folderid,
+                                              pprint.pformat(folder)))
+
+        return await self.put_object('folder', folder)
+
+    async def add_objects_to_folder(self, folderid, objects):
+        """Adds many objects to a folder at once.
+
+        See :func:`gaiagps.apiclient.GaiaClient.add_objects_to_folder`.
+        """
+        return await self._update_folder_members(folderid, objects, True)
+
+    async def remove_objects_from_folder(self, folderid, objects):
+        """Removes many objects from a folder at once.
+
+        See :func:`gaiagps.apiclient.GaiaClient.remove_objects_from_folder`.
+        """
+        return await self._update_folder_members(folderid, objects, False)
+
+    async def add_object_to_folder(self, folderid, objtype, objid):
+        """Adds an object to a folder.
+
+        See :func:`gaiagps.apiclient.GaiaClient.add_object_to_folder`.
+        """
+        return await self.add_objects_to_folder(folderid, {objtype: [objid]})
+
+    async def remove_object_from_folder(self, folderid, objtype, objid):
+        """Removes an object from a folder.
+
+        See :func:`gaiagps.apiclient.GaiaClient.remove_object_from_folder`.
+        """
+        return await self.remove_objects_from_folder(folderid,
+                                                     {objtype: [objid]})
+
+    async def upload_file(self, filename, progress=None):
+        """Upload a file by name.
+
+        See :func:`gaiagps.apiclient.GaiaClient.upload_file`.
+        """
+        name = os.path.basename(filename)
+        with apiclient.MultipartEncoder({'name': name}, 'files', filename,
+                                        progress=progress) as body:
+            r = await self.s.post(gurl('upload'),
+                                  content=body.aiter_chunks(),
+                                  headers={'Content-Type': body.content_type,
+                                           'Content-Length': str(len(body))})
+        _logresp(r)
+        folder_id = apiclient._upload_folder_id(r.content, str(r.url))
+        if folder_id is None:
+            return None
+        return await self.get_object('folder', id_=folder_id)
+
+    async def set_objects_archive(self, objtype, ids, archive=False):
+        """Control archive (sync) status on a set of objects.
+
+        See :func:`gaiagps.apiclient.GaiaClient.set_objects_archive`.
+        """
+        r = await self.s.put(gurl('api', 'objects', objtype),
+                             json={'deleted': archive,
+                                   objtype: ids})
+        _logresp(r)
+        return r.status_code == 200
+
+    async def get_photo(self, photoid, size='fullsize', photo=None):
+        """Get the image contents of a photo by id.
+
+        See :func:`gaiagps.apiclient.GaiaClient.get_photo`. Streaming to a
+        destination is not supported here.
+        """
+        assert size in ('fullsize', 'thumbnail', 'scaled')
+
+        url_key = '%s_url' % size
+        if photo is None or url_key not in photo.get('properties', {}):
+            photo = await self.get_object('photo', id_=photoid)
+        url = photo['properties'][url_key]
+        r = await self.s.get(url)
+        if r.status_code != 200:
+            LOG.debug('Attempt to fetch %r returned %i: %s' % (
+                url, r.status_code, r.reason_phrase))
+            raise RuntimeError('Server did not return image')
+        content_type = r.headers['Content-Type']
+        LOG.debug('Photo headers: %s' % r.headers)
+
+        return content_type, r.content
+
+    async def get_access(self, folderid):
+        """Get access information for a folder.
+
+        See :func:`gaiagps.apiclient.GaiaClient.get_access`.
+        """
+        r = await self.s.get(gurl('api', 'objects', 'folder', folderid,
+                                  'access'))
+        if r.status_code != 200:
+            LOG.debug('Server refused folder access with %i: %s' % (
+                r.status_code, r.reason_phrase))
+            raise RuntimeError('Server refused to list access')
+
+        return r.json()
+
+    async def get_invites(self, folderid):
+        """Get invite information for a folder.
+
+        See :func:`gaiagps.apiclient.GaiaClient.get_invites`.
+        """
+        r = await self.s.get(gurl('api', 'objects', 'folder', folderid,
+                                  'invite'))
+        if r.status_code != 200:
+            LOG.debug('Server refused folder invites with %i: %s' % (
+                r.status_code, r.reason_phrase))
+            raise RuntimeError('Server refused to list invites')
+
+        return r.json()
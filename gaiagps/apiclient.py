@@ -1,3 +1,7 @@
+import asyncio
+import collections
+import contextlib
+import functools
 import itertools
 import logging
 import os
@@ -5,6 +9,11 @@ import re
 import requests
 import sys
 import pprint
+import urllib.parse
+import uuid
+
+from gaiagps import cache
+from gaiagps import util
 
 
 logging.getLogger('requests').setLevel(logging.ERROR)
@@ -34,29 +43,133 @@ def gurl(*sub):
                                     ['']))
 
 
+@functools.lru_cache(maxsize=256)
+def _compile(pattern):
+    return re.compile(pattern)
+
+
+class ObjectIndex(object):
+    """An index of object descriptions for fast lookups.
+
+    This wraps a listing (like you get from
+    :func:`~GaiaClient.list_objects`) once, and then answers lookups by
+    key (like ``id`` or ``title``) from hash maps instead of scanning the
+    whole listing each time. Maps are built on first use of each key and
+    are multi-valued, since titles need not be unique. Regular expression
+    searches are cached per pattern.
+
+    An index is iterable and can be passed to :func:`find` and
+    :func:`match` in place of the listing itself.
+
+    :param items: Object descriptions to index
+    :type items: list
+    """
+
+    def __init__(self, items):
+        self._items = list(items)
+        self._maps = {}
+        self._matches = {}
+        self._folders = None
+        self._dates = None
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def lookup(self, key, value):
+        """Find all items for which ``key`` equals ``value``.
+
+        :param key: The key to match
+        :param value: The value to match
+        :returns: A list of matching items, in listing order
+        :rtype: `list`
+        """
+        try:
+            keymap = self._maps[key]
+        except KeyError:
+            keymap = self._maps[key] = collections.defaultdict(list)
+            for item in self._items:
+                keymap[item[key]].append(item)
+        return list(keymap.get(value, []))
+
+    def match(self, key, pattern):
+        """Find all items where ``key`` matches ``pattern``.
+
+        :param key: The key to match
+        :param pattern: A regular expression to use for matching
+        :returns: A list of matching items, in listing order
+        :rtype: `list`
+        """
+        try:
+            matches = self._matches[(key, pattern)]
+        except KeyError:
+            search = _compile(pattern).search
+            matches = self._matches[(key, pattern)] = [
+                i for i in self._items if search(i[key])]
+        return list(matches)
+
+    def in_folder(self, folder_id):
+        """Find all items directly inside a folder.
+
+        :param folder_id: The id of the folder, or ``''`` for the root
+        :type folder_id: str
+        :returns: A list of items, in listing order
+        :rtype: `list`
+        """
+        if self._folders is None:
+            self._folders = collections.defaultdict(list)
+            for item in self._items:
+                self._folders[item.get('folder')].append(item)
+        return list(self._folders.get(folder_id, []))
+
+    def between(self, start, end):
+        """Find all items created within a date range.
+
+        See :class:`~gaiagps.util.DateIndex`.
+
+        :param start: The start of the range (inclusive), in local time
+        :type start: datetime.datetime
+        :param end: The end of the range (inclusive), in local time
+        :type end: datetime.datetime
+        :returns: A list of items, in date order
+        :rtype: `list`
+        """
+        if self._dates is None:
+            self._dates = util.DateIndex(self._items)
+        return self._dates.between(start, end)
+
+
 def match(iterable, key, pattern):
     """Find items in iterable where ``key`` matches ``pattern``.
 
-    :param iterable: Items to search
+    :param iterable: Items to search (or an :class:`ObjectIndex`)
     :param key: The key to match
     :param pattern: A regular expression to use for matching
     :returns: A list of objects that match
     """
+    if isinstance(iterable, ObjectIndex):
+        return iterable.match(key, pattern)
+    search = _compile(pattern).search
     return [i for i in iterable
-            if re.search(pattern, i[key])]
+            if search(i[key])]
 
 
 def find(iterable, key, value):
     """Find exactly one item in iterable for which ``key`` equals ``value``.
 
-    :param iterable: Items to search
+    :param iterable: Items to search (or an :class:`ObjectIndex`)
     :param key: The key to match
     :param value: The value to match
     :raises NotFound: If a match is not found
     :raises RuntimeError: If multiple matches are found
     """
-    matches = [i for i in iterable
-               if i[key] == value]
+    if isinstance(iterable, ObjectIndex):
+        matches = iterable.lookup(key, value)
+    else:
+        matches = [i for i in iterable
+                   if i[key] == value]
     if not matches:
         raise NotFound('Item with %s=%s not found' % (key, value))
     elif len(matches) > 1:
@@ -64,11 +177,94 @@ def find(iterable, key, value):
     return matches[0]
 
 
+def _list_params(archived, page, page_size):
+    # Query parameters for one page of an object listing
+    return {
+        'count': str(page_size), 'page': str(page),
+        'routepoints': 'false',
+        'show_archived': 'true' if archived else 'false',
+        'show_filed': 'true',
+        'sort_direction': 'desc',
+        'sort_field': 'create_date',
+    }
+
+
+def _object_resource(id_, fmt):
+    # The resource path element for an object, optionally in a file format
+    if fmt is not None:
+        # FIXME: Add GeoJSON
+        assert fmt in ('gpx', 'kml')
+        return '%s.%s' % (id_, fmt)
+    else:
+        return id_
+
+
+def _folder_list_key(objtype):
+    # The key in a folder description that lists objects of objtype
+    assert objtype in ('waypoint', 'track', 'folder', 'photo')
+    if objtype == 'folder':
+        # For some reason this is different for folders
+        return 'children'
+    else:
+        return '%ss' % objtype
+
+
+def _apply_folder_members(folder, objects, add):
+    # Add (or remove) lists of object ids by type to (or from) a folder
+    # description in place
+    for objtype, objids in objects.items():
+        members = folder[_folder_list_key(objtype)]
+        for objid in objids:
+            if add:
+                assert objid not in members
+                members.append(objid)
+            else:
+                assert objid in members
+                members.remove(objid)
+
+
+def _copy_content(r, f):
+    # Stream the body of a response to a file, returning the size
+    size = 0
+    for chunk in r.iter_content(chunk_size=PHOTO_CHUNK_SIZE):
+        f.write(chunk)
+        size += len(chunk)
+    return size
+
+
+def _upload_folder_id(content, url):
+    # Interpret the response to an upload, returning the id of the folder
+    # created for it, or None if the upload was queued for processing
+    if b'File uploaded to queue' in content:
+        # This is unfortunately very  fragile, but there is not
+        # much else we can do
+        LOG.debug('Upload was queued')
+        return None
+
+    folder_id = url.rstrip('/').split('/')[-1]
+    if folder_id == 'upload':
+        # Redirected back to the upload page, which means the server
+        # does not like our file
+        raise RuntimeError('Server rejected file (likely '
+                           'unsupported type)')
+    LOG.debug('Upload URL is %s, folder id is %s' % (url, folder_id))
+    return folder_id
+
+
 def _logresp(r):
     LOG.debug('Response: %s %s: %r' % (r.status_code, r.reason,
                                        r.content))
 
 
+# The number of items requested per page when listing objects
+DEFAULT_PAGE_SIZE = 5000
+
+# The size of the pieces photos are streamed to disk in
+PHOTO_CHUNK_SIZE = 64 * 1024
+
+# The size of the pieces files are read in when uploading
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
 USER_AGENT_ELEMENTS = [
     'Python/%s.%s.%s' % (sys.version_info.major,
                          sys.version_info.minor,
@@ -83,6 +279,149 @@ USER_AGENT = 'https://github.com/kk7ds/gaiagpsclient (%s)' % (
     '; '.join(USER_AGENT_ELEMENTS))
 
 
+def _quote_header(value):
+    # Escape a value for a quoted-string in a form-data header the way
+    # browsers do
+    return value.replace('"', '%22').replace('\r', '%0D').replace(
+        '\n', '%0A')
+
+
+class MultipartEncoder(object):
+    """A streaming ``multipart/form-data`` request body for one file.
+
+    The body is produced a chunk at a time as it is read (or iterated),
+    so a file of any size can be uploaded without holding it in memory.
+    The length is known up front, so it can be sent with a
+    ``Content-Length`` instead of chunked encoding. The file is closed as
+    soon as it has been read completely, or when :func:`~close()` is
+    called (or the encoder is used as a context manager)::
+
+      with MultipartEncoder({'name': 'foo.gpx'}, 'files', path) as body:
+          requests.post(url, data=body,
+                        headers={'Content-Type': body.content_type})
+
+    :param fields: Plain form fields to send before the file
+    :type fields: dict
+    :param name: The form field name for the file
+    :type name: str
+    :param filename: The local filename to upload
+    :type filename: str
+    :param progress: A callable that is called with the number of bytes
+                     sent so far and the total as the body is consumed
+    :type progress: callable
+    :param chunk_size: The size of the pieces the file is read in
+    :type chunk_size: int
+    """
+
+    def __init__(self, fields, name, filename, progress=None,
+                 chunk_size=UPLOAD_CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % (
+            self.boundary)
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.sent = 0
+
+        head = []
+        for key, value in fields.items():
+            head.append('--%s\r\n'
+                        'Content-Disposition: form-data; name="%s"\r\n'
+                        '\r\n%s\r\n' % (
+                            self.boundary, _quote_header(key), value))
+        head.append('--%s\r\n'
+                    'Content-Disposition: form-data; name="%s"; '
+                    'filename="%s"\r\n\r\n' % (
+                        self.boundary, _quote_header(name),
+                        _quote_header(os.path.basename(filename))))
+        self._head = ''.join(head).encode()
+        self._tail = ('\r\n--%s--\r\n' % self.boundary).encode()
+
+        self._f = open(filename, 'rb')
+        try:
+            # Only send what was there when we started, so that the body
+            # always matches our length
+            self._size = os.fstat(self._f.fileno()).st_size
+        except Exception:
+            self._f.close()
+            raise
+        self._chunks = self._generate()
+        self._buffer = b''
+
+    def __len__(self):
+        return len(self._head) + self._size + len(self._tail)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """Close the file being uploaded."""
+        self._f.close()
+
+    def _generate(self):
+        try:
+            yield self._head
+            remaining = self._size
+            while remaining > 0:
+                chunk = self._f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise RuntimeError('File was truncated during upload')
+                remaining -= len(chunk)
+                yield chunk
+            yield self._tail
+        finally:
+            self.close()
+
+    def _count(self, data):
+        self.sent += len(data)
+        if self.progress:
+            self.progress(self.sent, len(self))
+        return data
+
+    def read(self, size=-1):
+        """Read some of the body.
+
+        :param size: The maximum number of bytes to return, or -1 for all
+                     of the rest of the body
+        :type size: int
+        :returns: The next piece of the body, or ``b''`` at the end
+        :rtype: `bytes`
+        """
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return self._count(data)
+
+    def __iter__(self):
+        if self._buffer:
+            yield self.read(len(self._buffer))
+        for chunk in self._chunks:
+            yield self._count(chunk)
+
+    async def aiter_chunks(self):
+        """Generate the body asynchronously, for clients like httpx.
+
+        The file is read in the event loop's default executor, so that a
+        large upload does not hold up other coroutines while it is read.
+        """
+        loop = asyncio.get_running_loop()
+        if self._buffer:
+            yield self.read(len(self._buffer))
+        while True:
+            chunk = await loop.run_in_executor(None, next, self._chunks, None)
+            if chunk is None:
+                break
+            yield self._count(chunk)
+
+
 class GaiaClient(object):
     """A low-level client for gaiagps.com.
 
@@ -96,15 +435,48 @@ class GaiaClient(object):
     :type password: str
     :param cookies: A cookie jar or ``None``
     :type cookies: http.cookiejar.CookieJar
+    :param concurrency: The default number of requests to run at once
+                        for bulk operations like :func:`~get_objects()`
+    :type concurrency: int
+    :param list_cache_ttl: The number of seconds object listings are cached
+                           for (``0`` to disable). The cache is available as
+                           ``listing_cache`` and is invalidated when objects
+                           are changed through this client.
+    :type list_cache_ttl: float
+    :param object_cache: An optional persistent cache of full objects. If
+                         provided, :func:`~get_object()` uses a cached copy
+                         when a listing has shown that the object's revision
+                         has not changed.
+    :type object_cache: gaiagps.cache.ObjectCache
+    :param validator_store: An optional store of HTTP cache validators
+                            (like :class:`~gaiagps.cache.MemoryValidatorStore`
+                            or :class:`~gaiagps.cache.DiskValidatorStore`). If
+                            provided, objects and listings are fetched with
+                            conditional requests, and the stored body is
+                            reused when the server reports no change.
+    :type validator_store: gaiagps.cache.MemoryValidatorStore
     :raises AuthFailure: if login fails
     :raises RuntimeError: if session is stale and credentials are
             not provided
     """
 
-    def __init__(self, username, password, cookies=None):
+    def __init__(self, username, password, cookies=None,
+                 concurrency=util.DEFAULT_CONCURRENCY,
+                 list_cache_ttl=cache.DEFAULT_LISTING_TTL,
+                 object_cache=None, validator_store=None):
         self.username = username
         self.password = password
+        self.concurrency = concurrency
+        self.listing_cache = cache.ListingCache(list_cache_ttl)
+        self.object_cache = object_cache
+        self.validator_store = validator_store
+        # The latest revision of each (objtype, id) we have seen listed
+        self._revisions = {}
         self.s = requests.Session()
+        # Make sure the connection pool is large enough that bulk
+        # operations do not have to wait for (or discard) connections
+        self.s.mount('https://', requests.adapters.HTTPAdapter(
+            pool_maxsize=max(concurrency, 10)))
         self.s.headers = {
             'User-Agent': USER_AGENT,
             'Accept': 'application/json, text/plain, */*',
@@ -121,6 +493,44 @@ class GaiaClient(object):
         else:
             LOG.debug('Already logged in')
 
+    def _get(self, url, params=None):
+        # GET a resource, conditionally if we have validators for it
+        kwargs = {}
+        if params is not None:
+            kwargs['params'] = params
+
+        store = self.validator_store
+        if store is None:
+            return self.s.get(url, **kwargs)
+
+        key = url
+        if params:
+            key += '?' + urllib.parse.urlencode(sorted(params.items()))
+        stored = store.get(key)
+        if stored:
+            etag, last_modified, body = stored
+            headers = {}
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+            kwargs['headers'] = headers
+
+        r = self.s.get(url, **kwargs)
+        if r.status_code == 304 and stored:
+            LOG.debug('Not modified: %s' % key)
+            store.note_revalidated()
+            # Make this look like the full response the caller expects
+            r.status_code = 200
+            r._content = stored[2]
+        elif r.status_code == 200:
+            store.note_downloaded()
+            etag = r.headers.get('ETag')
+            last_modified = r.headers.get('Last-Modified')
+            if etag or last_modified:
+                store.put(key, etag, last_modified, r.content)
+        return r
+
     def test_auth(self):
         """Test the session to see if we are successfully logged in.
 
@@ -151,11 +561,91 @@ class GaiaClient(object):
 
         LOG.info('Login successful')
 
+    def iter_objects(self, objtype, archived=True,
+                     page_size=DEFAULT_PAGE_SIZE):
+        """Generates object descriptions, one page at a time.
+
+        This walks the paginated listing for ``objtype``, requesting
+        ``page_size`` items at a time and yielding each summary as its
+        page arrives, until the server runs out of results. A complete
+        listing is cached (see ``listing_cache``) and later iterations
+        are served from it while it is fresh.
+
+        :param objtype: The type of object to be listed
+        :type objtype: str
+        :param archived: If ``True``, archived objects will be included
+        :type archived: bool
+        :param page_size: The number of items to request per page
+        :type page_size: int
+        :returns: A generator of object descriptions
+        :rtype: `generator`
+        """
+        assert objtype in ('folder', 'track', 'waypoint', 'photo')
+
+        cached = self.listing_cache.get(objtype, archived)
+        if cached is not None:
+            for item in cached:
+                self._note_revision(objtype, item)
+                yield item
+            return
+
+        # Only collect the listing if it is going to be cached
+        listing = [] if self.listing_cache.ttl else None
+        generation = self.listing_cache.generation(objtype)
+        page = 1
+        while True:
+            r = self._get(gurl('api', 'objects', objtype),
+                          params=_list_params(archived, page, page_size))
+            items = r.json()
+            if listing is not None:
+                listing.extend(items)
+            count = 0
+            for item in items:
+                count += 1
+                self._note_revision(objtype, item)
+                yield item
+
+            LOG.debug('Listed %i %ss from page %i' % (count, objtype, page))
+            if count < page_size:
+                # A short (or empty) page means there is nothing more
+                break
+            page += 1
+
+        if listing is not None:
+            self.listing_cache.put(objtype, archived, listing,
+                                   generation=generation)
+
+    def _note_revision(self, objtype, item):
+        revision = util.object_revision(item)
+        if revision is not None:
+            self._revisions[(objtype, item['id'])] = revision
+
+    def _forget_objects(self, objtype, ids):
+        # Whatever revision we last saw of these objects is out of date
+        # now, so make sure the next get_object() fetches them again
+        for id_ in ids:
+            self._revisions.pop((objtype, id_), None)
+            if self.object_cache:
+                self.object_cache.delete(objtype, id_)
+
+    def _invalidate_listings(self, objtype=None):
+        # Drop cached listings that a change to objtype may have affected.
+        # Folder changes can move anything, and folder listings include
+        # their contents, so those are always affected.
+        if objtype is None or objtype == 'folder':
+            self.listing_cache.invalidate()
+        elif objtype in ('waypoint', 'photo'):
+            # Photos are managed as waypoints
+            self.listing_cache.invalidate('waypoint', 'photo', 'folder')
+        else:
+            self.listing_cache.invalidate(objtype, 'folder')
+
     def list_objects(self, objtype, archived=True):
         """Returns a list of object descriptions.
 
         This is similar to the result of :func:`~get_object()`, but with object
-        references instead of full objects.
+        references instead of full objects. All pages of the listing are
+        fetched; see :func:`~iter_objects()` to process them as they arrive.
 
         :param objtype: The type of object to be listed
         :type objtype: str
@@ -164,18 +654,7 @@ class GaiaClient(object):
         :returns: A list of objects
         :rtype: `list`
         """
-        assert objtype in ('folder', 'track', 'waypoint', 'photo')
-
-        r = self.s.get(gurl('api', 'objects', objtype),
-                       params={
-                           'count': '5000', 'page': '1',
-                           'routepoints': 'false',
-                           'show_archived': 'true' if archived else 'false',
-                           'show_filed': 'true',
-                           'sort_direction': 'desc',
-                           'sort_field': 'create_date',
-                       })
-        return r.json()
+        return list(self.iter_objects(objtype, archived=archived))
 
     def lookup_object(self, objtype, name):
         """Lookup a single object by name.
@@ -193,7 +672,7 @@ class GaiaClient(object):
         :raises RuntimeError: When multiple objects by the same name are found
         :raises NotFound: When no object by the given name is found
         """
-        objects = self.list_objects(objtype)
+        objects = ObjectIndex(self.list_objects(objtype))
         return find(objects, 'title', name)
 
     def get_object(self, objtype, name=None, id_=None, fmt=None):
@@ -221,22 +700,61 @@ class GaiaClient(object):
         if id_ is None:
             id_ = self.lookup_object(objtype, name)['id']
 
-        if fmt is not None:
-            # FIXME: Add GeoJSON
-            assert fmt in ('gpx', 'kml')
-            resource = '%s.%s' % (id_, fmt)
-        else:
-            resource = id_
+        resource = _object_resource(id_, fmt)
 
-        result = self.s.get(gurl('api', 'objects', objtype, resource))
+        revision = self._revisions.get((objtype, id_))
+        if fmt is None and self.object_cache and revision is not None:
+            objdata = self.object_cache.get(objtype, id_, revision)
+            if objdata is not None:
+                return objdata
+
+        result = self._get(gurl('api', 'objects', objtype, resource))
         if fmt is None:
             objdata = result.json()
             LOG.debug('Retrieved object %s/%s: %s' % (
                 objtype, resource, objdata))
+            if self.object_cache:
+                revision = util.object_revision(objdata) or revision
+                if revision is not None:
+                    self.object_cache.put(objtype, id_, revision, objdata)
             return objdata
         else:
             return result.content
 
+    def get_objects(self, objtype, ids, concurrency=None,
+                    return_exceptions=False):
+        """Fetch many objects by id.
+
+        This is the bulk equivalent of :func:`~get_object()`, running up to
+        ``concurrency`` requests at once. Results are generated in the
+        same order as ``ids``, each as soon as it (and everything before it)
+        is available.
+
+        :param objtype: The type of the objects
+        :type objtype: str
+        :param ids: The ids of the objects to fetch
+        :type ids: list
+        :param concurrency: The maximum number of requests to run at once
+                            (defaults to the client's ``concurrency``)
+        :type concurrency: int
+        :param return_exceptions: If ``True``, a failure to fetch an object
+                                  is reported by generating the exception in
+                                  its place instead of raising it
+        :type return_exceptions: bool
+        :returns: A generator of object data structures in ``ids`` order
+        :rtype: `generator`
+        """
+        def _get(id_):
+            try:
+                return self.get_object(objtype, id_=id_)
+            except Exception as e:
+                LOG.debug('Failed to fetch %s/%s: %s' % (objtype, id_, e))
+                raise
+
+        return util.parallel_map(_get, ids,
+                                 concurrency=concurrency or self.concurrency,
+                                 return_exceptions=return_exceptions)
+
     def create_object(self, objtype, objdata):
         """Create an object.
 
@@ -250,6 +768,7 @@ class GaiaClient(object):
         LOG.debug('Creating %s: %s' % (objtype, pprint.pformat(objdata)))
         r = self.s.post(gurl('api', 'objects', objtype), json=objdata)
         _logresp(r)
+        self._invalidate_listings(objtype)
         if r:
             obj = r.json()
             if 'id' not in obj and 'id' in obj.get('properties', {}):
@@ -272,6 +791,8 @@ class GaiaClient(object):
         r = self.s.put(gurl('api', 'objects', objtype, objdata['id']),
                        json=objdata)
         _logresp(r)
+        self._forget_objects(objtype, [objdata['id']])
+        self._invalidate_listings(objtype)
         if r.status_code <= 201:
             return r.json()
         elif r.status_code < 299:
@@ -287,6 +808,57 @@ class GaiaClient(object):
         """
         r = self.s.delete(gurl('api', 'objects', objtype, id_))
         _logresp(r)
+        self._forget_objects(objtype, [id_])
+        self._invalidate_listings(objtype)
+
+    def _update_folder_members(self, folderid, objects, add):
+        # Check the types before doing any work
+        for objtype in objects:
+            _folder_list_key(objtype)
+
+        # The whole folder is written back, so it must be read fresh or
+        # we could undo changes made since the listing was cached
+        self.listing_cache.invalidate('folder')
+        folders = self.list_objects('folder')
+        folder = find(folders, 'id', folderid)
+        _apply_folder_members(folder, objects, add)
+
+        LOG.debug('Updating folder %s: %s' % (folderid,
+                                              pprint.pformat(folder)))
+
+        return self.put_object('folder', folder)
+
+    def add_objects_to_folder(self, folderid, objects):
+        """Adds many objects to a folder at once.
+
+        The folder is updated with a single request, no matter how many
+        objects are added.
+
+        :param folderid: The id of the folder in question
+        :type folderid: str
+        :param objects: Lists of object ids to add, by type, like
+                        ``{'waypoint': [...], 'track': [...]}``
+        :type objects: dict
+        :returns: The updated folder description
+        :rtype: `dict`
+        """
+        return self._update_folder_members(folderid, objects, add=True)
+
+    def remove_objects_from_folder(self, folderid, objects):
+        """Removes many objects from a folder at once.
+
+        The folder is updated with a single request, no matter how many
+        objects are removed.
+
+        :param folderid: The id of the folder in question
+        :type folderid: str
+        :param objects: Lists of object ids to remove, by type, like
+                        ``{'waypoint': [...], 'track': [...]}``
+        :type objects: dict
+        :returns: The updated folder description
+        :rtype: `dict`
+        """
+        return self._update_folder_members(folderid, objects, add=False)
 
     def add_object_to_folder(self, folderid, objtype, objid):
         """Adds an object to a folder.
@@ -300,24 +872,7 @@ class GaiaClient(object):
         :returns: The updated folder description
         :rtype: `dict`
         """
-
-        assert objtype in ('waypoint', 'track', 'folder', 'photo')
-
-        folders = self.list_objects('folder')
-        folder = find(folders, 'id', folderid)
-
-        if objtype == 'folder':
-            # For some reason this is different for folders
-            folder_list_key = 'children'
-        else:
-            folder_list_key = '%ss' % objtype
-        assert objid not in folder[folder_list_key]
-        folder[folder_list_key].append(objid)
-
-        LOG.debug('Updating folder %s: %s' % (folderid,
-                                              pprint.pformat(folder)))
-
-        return self.put_object('folder', folder)
+        return self.add_objects_to_folder(folderid, {objtype: [objid]})
 
     def remove_object_from_folder(self, folderid, objtype, objid):
         """Removes an object from a folder.
@@ -331,54 +886,37 @@ class GaiaClient(object):
         :returns: The updated folder description
         :rtype: `dict`
         """
+        return self.remove_objects_from_folder(folderid, {objtype: [objid]})
 
-        assert objtype in ('waypoint', 'track', 'folder', 'photo')
-
-        folders = self.list_objects('folder')
-        folder = find(folders, 'id', folderid)
-        if objtype == 'folder':
-            # For some reason this is different for folders
-            folder_list_key = 'children'
-        else:
-            folder_list_key = '%ss' % objtype
-        assert objid in folder[folder_list_key]
-        folder[folder_list_key].remove(objid)
-
-        LOG.debug('Updating folder %s: %s' % (folderid,
-                                              pprint.pformat(folder)))
-
-        return self.put_object('folder', folder)
-
-    def upload_file(self, filename):
+    def upload_file(self, filename, progress=None):
         """Upload a file by name.
 
+        The file is streamed to the server with a
+        :class:`MultipartEncoder`, so it is never held in memory.
+
         :param filename: The local filename to upload
         :type filename: str
+        :param progress: A callable that is called with the number of bytes
+                         sent so far and the total as the upload proceeds
+        :type progress: callable
         :returns: The resulting folder object that is created to hold the
                   contents of the file, as you would get from
                   :func:`~get_object`. None is returned if the server reports
                   that the upload was queued for processing.
         :rtype: `dict`
         """
-        files = {'files': open(filename, 'rb')}
         name = os.path.basename(filename)
-        r = self.s.post(gurl('upload'), files=files,
-                        data={'name': name},
-                        allow_redirects=True)
+        with MultipartEncoder({'name': name}, 'files', filename,
+                              progress=progress) as body:
+            r = self.s.post(gurl('upload'), data=body,
+                            headers={'Content-Type': body.content_type},
+                            allow_redirects=True)
         _logresp(r)
-        if b'File uploaded to queue' in r.content:
-            # This is unfortunately very  fragile, but there is not
-            # much else we can do
-            LOG.debug('Upload was queued')
+        # New objects (possibly of any type) appear in a new folder
+        self._invalidate_listings()
+        folder_id = _upload_folder_id(r.content, r.url)
+        if folder_id is None:
             return None
-
-        folder_id = r.url.rstrip('/').split('/')[-1]
-        if folder_id == 'upload':
-            # Redirected back to the upload page, which means the server
-            # does not like our file
-            raise RuntimeError('Server rejected file (likely '
-                               'unsupported type)')
-        LOG.debug('Upload URL is %s, folder id is %s' % (r.url, folder_id))
         return self.get_object('folder', id_=folder_id)
 
     def set_objects_archive(self, objtype, ids, archive=False):
@@ -399,33 +937,80 @@ class GaiaClient(object):
                        json={'deleted': archive,
                              objtype: ids})
         _logresp(r)
+        self._forget_objects(objtype, ids)
+        self._invalidate_listings(objtype)
         return r.status_code == 200
 
-    def get_photo(self, photoid, size='fullsize'):
+    def get_photo(self, photoid, size='fullsize', photo=None, dest=None):
         """Get the image contents of a photo by id.
 
+        If ``dest`` is given, the image is streamed to it in chunks instead
+        of being returned in memory. It may be:
+
+        - A filename, which is created (or truncated) and written. If the
+          download fails part way, the file is removed.
+        - A file-like object open for binary writing. The image is written
+          from its current position, and it is left open.
+        - A callable, for choosing where to write based on the type of
+          image. It is called once, with the ``Content-Type`` of the
+          response, before any of the image is read, and must return a
+          filename or file-like object as above, or ``None`` to skip the
+          download.
+
         :param photoid: The id of the photo
         :type photoid: str
         :param size: The size of the image (one of ``fullsize``, ``scaled``,
                      or ``thumbnail``.
         :type size: str
-        :returns: A tuple of content-type and the bytes content of the photo
-        :rtype: `tuple` (`str`, `bytes`)
+        :param photo: The photo object, if it has already been fetched
+        :type photo: dict
+        :param dest: Where to write the image (see above)
+        :type dest: `str`, file-like object, or callable
+        :returns: A tuple of the content type and the image contents if
+                  ``dest`` is not given. Otherwise a tuple of the content
+                  type and the number of bytes written to ``dest``, or
+                  ``None`` in place of that if the ``dest`` callable
+                  skipped the download.
+        :rtype: `tuple` of (`str`, `bytes`) or (`str`, `int`)
+        :raises RuntimeError: if the server did not return the image
         """
         assert size in ('fullsize', 'thumbnail', 'scaled')
 
-        photo = self.get_object('photo', id_=photoid)
-        url = photo['properties']['%s_url' % size]
-        r = self.s.get(url)
-        if r.status_code != 200:
-            LOG.debug('Attempt to fetch %r returned %i: %s' % (url,
-                                                               r.status_code,
-                                                               r.reason))
-            raise RuntimeError('Server did not return image')
-        content_type = r.headers['Content-Type']
-        LOG.debug('Photo headers: %s' % r.headers)
-
-        return content_type, r.content
+        url_key = '%s_url' % size
+        if photo is None or url_key not in photo.get('properties', {}):
+            photo = self.get_object('photo', id_=photoid)
+        url = photo['properties'][url_key]
+        if dest is None:
+            r = self.s.get(url)
+        else:
+            r = self.s.get(url, stream=True)
+        with contextlib.closing(r):
+            if r.status_code != 200:
+                LOG.debug('Attempt to fetch %r returned %i: %s' % (
+                    url, r.status_code, r.reason))
+                raise RuntimeError('Server did not return image')
+            content_type = r.headers['Content-Type']
+            LOG.debug('Photo headers: %s' % r.headers)
+
+            if dest is None:
+                return content_type, r.content
+
+            if callable(dest):
+                dest = dest(content_type)
+                if dest is None:
+                    return content_type, None
+
+            if not isinstance(dest, str):
+                return content_type, _copy_content(r, dest)
+
+            try:
+                with open(dest, 'wb') as f:
+                    return content_type, _copy_content(r, f)
+            except Exception:
+                # Do not leave a partial image behind
+                if os.path.exists(dest):
+                    os.remove(dest)
+                raise
 
     def get_access(self, folderid):
         """Get access information for a folder.
@@ -0,0 +1,425 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+LOG = logging.getLogger(__name__)
+
+# The default number of seconds a listing is considered fresh
+DEFAULT_LISTING_TTL = 30
+
+# Where persistent caches are stored by default
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'gaiagps')
+
+# The default limit on the (compressed) size of the object cache
+DEFAULT_OBJECT_CACHE_SIZE = 256 * 1024 * 1024
+
+# The default limit on the (compressed) size of stored response bodies
+DEFAULT_VALIDATOR_STORE_SIZE = 64 * 1024 * 1024
+
+
+def _table_size(db, table):
+    return db.execute(
+        'SELECT COALESCE(SUM(size), 0) FROM %s' % table).fetchone()[0]
+
+
+def _row_size(db, table, keys, values):
+    # The size of an existing row, or 0 if there is none
+    row = db.execute('SELECT size FROM %s WHERE %s' % (
+        table, ' AND '.join('%s = ?' % key for key in keys)),
+        values).fetchone()
+    return row[0] if row else 0
+
+
+def _evict_lru(db, table, keys, max_size):
+    # Drop the least-recently-used rows of table (identified by the keys
+    # columns) until the total size is within max_size, and return the
+    # new total. The total is counted again here, rather than trusting
+    # the caller's running count, in case another process has changed
+    # the table.
+    total = _table_size(db, table)
+    if total <= max_size:
+        return total
+
+    doomed = []
+    for row in db.execute('SELECT %s, size FROM %s ORDER BY atime' % (
+            ', '.join(keys), table)):
+        if total <= max_size:
+            break
+        doomed.append(row[:-1])
+        total -= row[-1]
+    LOG.debug('Evicting %i entries from %s cache' % (len(doomed), table))
+    db.executemany('DELETE FROM %s WHERE %s' % (
+        table, ' AND '.join('%s = ?' % key for key in keys)), doomed)
+    return total
+
+
+class ListingCache(object):
+    """An in-memory cache of object listings.
+
+    This holds the results of
+    :func:`~gaiagps.apiclient.GaiaClient.list_objects` for up to ``ttl``
+    seconds, so that repeated lookups within a single operation do not
+    have to fetch the whole listing again. Entries are keyed by
+    ``(objtype, archived)`` and can be invalidated by object type when
+    something changes them.
+
+    A listing that was being fetched while its type was invalidated is
+    stale, so callers take a :meth:`generation` before fetching and pass
+    it to :meth:`put`, which drops the result if an invalidation happened
+    in between.
+
+    The ``hits`` and ``misses`` attributes count how many lookups were
+    (and were not) served from the cache.
+
+    :param ttl: The number of seconds an entry is valid for, or ``0`` to
+                disable caching
+    :type ttl: float
+    """
+
+    def __init__(self, ttl=DEFAULT_LISTING_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._generations = collections.Counter()
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def generation(self, objtype):
+        """Get the current generation of a type's listings.
+
+        :param objtype: The type of object listed
+        :type objtype: str
+        :returns: An opaque token that changes whenever listings of
+                  ``objtype`` are invalidated
+        """
+        with self._lock:
+            return self._epoch, self._generations[objtype]
+
+    def get(self, objtype, archived):
+        """Get a cached listing.
+
+        :param objtype: The type of object listed
+        :type objtype: str
+        :param archived: Whether archived objects were included
+        :type archived: bool
+        :returns: A copy of the listing, or ``None`` if there is no fresh
+                  entry for it
+        :rtype: `list`
+        """
+        with self._lock:
+            entry = self._entries.get((objtype, archived))
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                items = entry[1]
+            else:
+                self.misses += 1
+                return None
+
+        LOG.debug('Using cached %s listing' % objtype)
+        # Callers are free to modify what they get back
+        return json.loads(items)
+
+    def put(self, objtype, archived, items, generation=None):
+        """Store a listing.
+
+        The listing is serialized when it is stored, so later changes to
+        ``items`` do not affect the cache.
+
+        :param objtype: The type of object listed
+        :type objtype: str
+        :param archived: Whether archived objects were included
+        :type archived: bool
+        :param items: The listing
+        :type items: list
+        :param generation: The result of :meth:`generation` taken before
+                           the listing was fetched. If the listing has been
+                           invalidated since then, it is not stored.
+        """
+        if not self.ttl:
+            return
+        data = json.dumps(items)
+        with self._lock:
+            if (generation is not None and
+                    generation != (self._epoch, self._generations[objtype])):
+                LOG.debug('Dropping stale %s listing' % objtype)
+                return
+            self._entries[(objtype, archived)] = (time.monotonic(), data)
+
+    def invalidate(self, *objtypes):
+        """Invalidate cached listings.
+
+        :param objtypes: The types of object whose listings should be
+                         dropped. If none are given, everything is dropped.
+        """
+        with self._lock:
+            if objtypes:
+                self._generations.update(objtypes)
+            else:
+                self._epoch += 1
+            for key in list(self._entries):
+                if not objtypes or key[0] in objtypes:
+                    del self._entries[key]
+
+
+class ObjectCache(object):
+    """A persistent cache of full objects.
+
+    This stores objects as returned by
+    :func:`~gaiagps.apiclient.GaiaClient.get_object` in an SQLite database,
+    keyed by type, id, and revision. A cached object is only returned for
+    the exact revision requested, so a stale copy is never used once the
+    object has changed on the server. Objects are stored compressed, and
+    the least-recently-used ones are evicted when the total exceeds
+    ``max_size`` bytes.
+
+    The ``hits`` and ``misses`` attributes count how many lookups were
+    (and were not) served from the cache.
+
+    :param path: The database filename (defaults to ``objects.db`` in
+                 :data:`DEFAULT_CACHE_DIR`)
+    :type path: str
+    :param max_size: The maximum total size of stored objects, in bytes
+    :type max_size: int
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_OBJECT_CACHE_SIZE):
+        if path is None:
+            os.makedirs(DEFAULT_CACHE_DIR, exist_ok=True)
+            path = os.path.join(DEFAULT_CACHE_DIR, 'objects.db')
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                'objtype TEXT NOT NULL, '
+                'id TEXT NOT NULL, '
+                'revision TEXT NOT NULL, '
+                'data BLOB NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'atime REAL NOT NULL, '
+                'PRIMARY KEY (objtype, id))')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS objects_atime ON objects (atime)')
+            # Kept up to date as we go, so that storing an object does not
+            # have to add up the whole table
+            self._size = _table_size(self._db, 'objects')
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+    def get(self, objtype, id_, revision):
+        """Get a cached object.
+
+        :param objtype: The type of the object
+        :type objtype: str
+        :param id_: The id of the object
+        :type id_: str
+        :param revision: The revision of the object that is wanted
+        :returns: The object, or ``None`` if that revision is not cached
+        :rtype: `dict`
+        """
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT data FROM objects '
+                'WHERE objtype = ? AND id = ? AND revision = ?',
+                (objtype, id_, str(revision))).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                'UPDATE objects SET atime = ? WHERE objtype = ? AND id = ?',
+                (time.time(), objtype, id_))
+
+        LOG.debug('Using cached %s/%s revision %s' % (objtype, id_, revision))
+        return json.loads(zlib.decompress(row[0]).decode())
+
+    def put(self, objtype, id_, revision, obj):
+        """Store an object, replacing any other revision of it.
+
+        :param objtype: The type of the object
+        :type objtype: str
+        :param id_: The id of the object
+        :type id_: str
+        :param revision: The revision of the object
+        :param obj: The object
+        :type obj: dict
+        """
+        data = zlib.compress(json.dumps(obj).encode())
+        with self._lock, self._db:
+            old_size = _row_size(self._db, 'objects', ('objtype', 'id'),
+                                 (objtype, id_))
+            self._db.execute(
+                'INSERT OR REPLACE INTO objects '
+                '(objtype, id, revision, data, size, atime) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (objtype, id_, str(revision), data, len(data), time.time()))
+            self._size += len(data) - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def delete(self, objtype, id_):
+        """Drop every revision of an object.
+
+        :param objtype: The type of the object
+        :type objtype: str
+        :param id_: The id of the object
+        :type id_: str
+        """
+        with self._lock, self._db:
+            self._size -= _row_size(self._db, 'objects', ('objtype', 'id'),
+                                    (objtype, id_))
+            self._db.execute(
+                'DELETE FROM objects WHERE objtype = ? AND id = ?',
+                (objtype, id_))
+
+    def _evict(self):
+        self._size = _evict_lru(self._db, 'objects', ('objtype', 'id'),
+                                self.max_size)
+
+
+class MemoryValidatorStore(object):
+    """An in-memory store of HTTP cache validators.
+
+    This remembers the ``ETag`` and ``Last-Modified`` validators (and the
+    body) of responses by URL, so that
+    :class:`~gaiagps.apiclient.GaiaClient` can make conditional requests
+    and reuse the body when the server says it has not changed.
+
+    The ``revalidated`` and ``downloaded`` attributes count how many
+    responses were served from the store after a ``304 Not Modified`` and
+    how many were downloaded in full.
+    """
+
+    def __init__(self):
+        self.revalidated = 0
+        self.downloaded = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def note_revalidated(self):
+        """Count a response that was served from the store."""
+        with self._lock:
+            self.revalidated += 1
+
+    def note_downloaded(self):
+        """Count a response that was downloaded in full."""
+        with self._lock:
+            self.downloaded += 1
+
+    def get(self, key):
+        """Get the validators for a URL.
+
+        :param key: The URL (including query string)
+        :type key: str
+        :returns: A tuple of (etag, last_modified, body) or ``None``
+        :rtype: `tuple`
+        """
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, etag, last_modified, body):
+        """Store the validators for a URL.
+
+        :param key: The URL (including query string)
+        :type key: str
+        :param etag: The ``ETag`` header, or ``None``
+        :type etag: str
+        :param last_modified: The ``Last-Modified`` header, or ``None``
+        :type last_modified: str
+        :param body: The response body
+        :type body: bytes
+        """
+        with self._lock:
+            self._entries[key] = (etag, last_modified, body)
+
+
+class DiskValidatorStore(MemoryValidatorStore):
+    """A persistent store of HTTP cache validators.
+
+    This is like :class:`MemoryValidatorStore`, but keeps its entries in
+    an SQLite database so that they survive across runs. Like
+    :class:`ObjectCache`, the least-recently-used entries are evicted when
+    the total (compressed) size of the stored bodies exceeds ``max_size``
+    bytes.
+
+    :param path: The database filename (defaults to ``validators.db`` in
+                 :data:`DEFAULT_CACHE_DIR`)
+    :type path: str
+    :param max_size: The maximum total size of stored bodies, in bytes
+    :type max_size: int
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_VALIDATOR_STORE_SIZE):
+        super(DiskValidatorStore, self).__init__()
+        if path is None:
+            os.makedirs(DEFAULT_CACHE_DIR, exist_ok=True)
+            path = os.path.join(DEFAULT_CACHE_DIR, 'validators.db')
+        self.path = path
+        self.max_size = max_size
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            columns = [row[1] for row in self._db.execute(
+                'PRAGMA table_info(validators)')]
+            if columns and 'atime' not in columns:
+                # Written by a version that did not track sizes; it is
+                # only a cache, so start again
+                LOG.debug('Discarding old validator store %s' % path)
+                self._db.execute('DROP TABLE validators')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS validators ('
+                'key TEXT PRIMARY KEY, '
+                'etag TEXT, '
+                'last_modified TEXT, '
+                'body BLOB NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'atime REAL NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS validators_atime '
+                'ON validators (atime)')
+            self._size = _table_size(self._db, 'validators')
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+    def get(self, key):
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT etag, last_modified, body FROM validators '
+                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE validators SET atime = ? WHERE key = ?',
+                (time.time(), key))
+        etag, last_modified, body = row
+        return etag, last_modified, zlib.decompress(body)
+
+    def put(self, key, etag, last_modified, body):
+        data = zlib.compress(body)
+        with self._lock, self._db:
+            old_size = _row_size(self._db, 'validators', ('key',), (key,))
+            self._db.execute(
+                'INSERT OR REPLACE INTO validators '
+                '(key, etag, last_modified, body, size, atime) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, etag, last_modified, data, len(data), time.time()))
+            self._size += len(data) - old_size
+            if self._size > self.max_size:
+                self._size = _evict_lru(self._db, 'validators', ('key',),
+                                        self.max_size)
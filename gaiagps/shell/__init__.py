@@ -9,6 +9,7 @@ import sys
 import traceback
 
 from gaiagps import apiclient
+from gaiagps import cache
 from gaiagps.shell import command
 from gaiagps.shell import photo
 from gaiagps.shell import upload
@@ -46,6 +47,15 @@ def main(args=None):
                         action='store_true')
     parser.add_argument('--verbose', help='Enable verbose output',
                         action='store_true')
+    parser.add_argument('--object-cache', action='store_true',
+                        help=('Cache full objects on disk (in %s) and '
+                              'reuse them while they are unchanged on the '
+                              'server' % cache.DEFAULT_CACHE_DIR))
+    parser.add_argument('--conditional-get', action='store_true',
+                        help=('Remember response validators on disk '
+                              '(in %s) and only download objects and '
+                              'listings again if they have changed' % (
+                                  cache.DEFAULT_CACHE_DIR)))
 
     cmds = parser.add_subparsers(dest='cmd')
 
@@ -105,6 +115,11 @@ def main(args=None):
                 print('Unable to access Gaia: %s' % e)
                 return 1
 
+        if args.object_cache:
+            client.object_cache = cache.ObjectCache()
+        if args.conditional_get:
+            client.validator_store = cache.DiskValidatorStore()
+
         cmd = commands[args.cmd](client, verbose=args.verbose)
         try:
             return int(cmd.dispatch(parser, args) or 0)
@@ -1,3 +1,6 @@
+import collections
+import copy
+import json
 import logging
 import os
 import pprint
@@ -16,13 +19,21 @@ class _Safety(Exception):
     pass
 
 
+# Placeholder for values missing from an edited object
+_MISSING = object()
+
+# Use the (much faster) libyaml emitter and parser if they are available
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 class Command(object):
     def __init__(self, client, verbose=False):
         self.client = client
         if verbose:
             self.verbose = lambda x, e=None: print(x, end=e)
         else:
-            self.verbose = lambda x: None
+            self.verbose = lambda x, e=None: None
 
     @property
     def objtype(self):
@@ -54,7 +65,10 @@ class Command(object):
             if not items and folder_id is not None:
                 self.verbose('Generating list of items in folder %r' % (
                     name_or_id))
-                items = self.client.list_objects(self.objtype)
+                index = apiclient.ObjectIndex(
+                    self.client.iter_objects(self.objtype))
+                yield from index.in_folder(folder_id)
+                return
             for item in items:
                 if folder_id is None or item['folder'] == folder_id:
                     yield item
@@ -82,7 +96,8 @@ class Command(object):
     def find_objects(self, names_or_ids, objtype=None, match=False,
                      date_range=None, allow_missing=False):
         matched_objs = []
-        objs = self.client.list_objects(objtype or self.objtype)
+        objs = apiclient.ObjectIndex(
+            self.client.iter_objects(objtype or self.objtype))
         if names_or_ids:
             for name_or_id in names_or_ids:
                 if util.is_id(name_or_id):
@@ -98,11 +113,11 @@ class Command(object):
                         if not allow_missing:
                             raise
         else:
-            matched_objs = objs
+            matched_objs = list(objs)
 
         if date_range:
-            matched_objs = [x for x in matched_objs
-                            if self._match_date(x, date_range)]
+            in_range = set(o['id'] for o in objs.between(*date_range))
+            matched_objs = [x for x in matched_objs if x['id'] in in_range]
 
         if not names_or_ids and len(matched_objs) == len(objs):
             # Refuse to find all objects because no criteria was specified
@@ -178,27 +193,38 @@ class Command(object):
             self.verbose('No items matched criteria')
             return 1
 
+        # Group the objects by the folder that has to change, so that each
+        # folder is only updated once
+        by_folder = collections.defaultdict(list)
         if args.destination == '/':
-            for obj in folder_filter(to_move):
+            for obj in to_move:
                 if obj['folder']:
                     self.verbose('Moving %s %r (%s) to /' % (
                         objtype, obj['title'], obj['id']))
-                    if not args.dry_run:
-                        self.client.remove_object_from_folder(
-                            obj['folder'], objtype, obj['id'])
+                    by_folder[obj['folder']].append(obj['id'])
                 else:
                     print('%s %r is already at root' % (
                         objtype.title(), obj['title']))
+            if not args.dry_run:
+                for folderid, ids in by_folder.items():
+                    self.client.remove_objects_from_folder(
+                        folderid, {objtype: ids})
         else:
             folder = self.get_object(args.destination,
                                      objtype='folder')
-            for obj in folder_filter(to_move):
+            for obj in to_move:
+                if obj['folder'] == folder['id']:
+                    print('%s %r is already in %s' % (
+                        objtype.title(), obj['title'],
+                        folder['properties']['name']))
+                    continue
                 self.verbose('Moving %s %r (%s) to %s' % (
                     objtype, obj['title'], obj['id'],
                     folder['properties']['name']))
-                if not args.dry_run:
-                    self.client.add_object_to_folder(
-                        folder['id'], objtype, obj['id'])
+                by_folder[folder['id']].append(obj['id'])
+            if not args.dry_run and by_folder:
+                self.client.add_objects_to_folder(
+                    folder['id'], {objtype: by_folder[folder['id']]})
         if args.dry_run:
             print('Dry run; no action taken')
 
@@ -219,15 +245,6 @@ class Command(object):
                                      util.datefmt(item),
                                      item['title']))
 
-    def _match_date(self, item, date_range):
-        start, end = date_range
-        item_dt = util.date_parse(item)
-        if item_dt:
-            item_dt = item_dt.replace(tzinfo=None)
-            return item_dt >= start and item_dt <= end
-        else:
-            return False
-
     def list(self, args):
         if args.format and args.format.lower() == 'help':
             msg = ['--format takes a python-like format string, such as: ',
@@ -251,7 +268,9 @@ class Command(object):
                 ['',
                  'Note that using --format causes an API call for each item ',
                  'in a list in order to fetch the full set of properties. ',
-                 'Please limit the list in some way to avoid undue stress ',
+                 'These are made several at a time (see --jobs), and are ',
+                 'served from the object cache when it is enabled, but ',
+                 'please limit the list in some way to avoid undue stress ',
                  'on gaiagps.com.'])
 
             print(os.linesep.join(msg))
@@ -289,24 +308,42 @@ class Command(object):
         def sortkey(i):
             return i['folder_name'] + ' ' + i['title']
 
+        if args.match_date:
+            in_range = set(i['id'] for i in util.DateIndex(items).between(
+                *args.match_date))
+
+        rows = []
         for item in sorted(folder_filter(items), key=sortkey):
             if args.match and not re.search(args.match, item['title']):
                 continue
-            if args.match_date and not self._match_date(item, args.match_date):
+            if args.match_date and item['id'] not in in_range:
                 continue
             if only_archived and not item['deleted']:
                 continue
-            if args.format:
-                # This is unfortunately very heavy, but since we do not seem to
-                # be able to get whole objects in list format, this is really
-                # the only option at the moment.
-                item = self.get_object(item['id'])
-                print(args.format % util.ThingFormatter(item))
-            else:
+            rows.append(item)
+
+        if args.format:
+            # Since we do not seem to be able to get whole objects in list
+            # format, fetch them all (in parallel, and from the object cache
+            # if possible), printing each row as soon as it and those
+            # before it are available.
+            rc = 0
+            objs = self.client.get_objects(objtype, [i['id'] for i in rows],
+                                           concurrency=args.jobs,
+                                           return_exceptions=True)
+            for row, item in zip(rows, objs):
+                if isinstance(item, Exception):
+                    print('Failed to fetch %s %r: %s' % (
+                        objtype, row['title'], item))
+                    rc = 1
+                    continue
+                print(args.format % util.ThingFormatter(item), flush=True)
+            return rc
+        else:
+            for item in rows:
                 table.add_row([item['title'],
                                util.datefmt(item),
                                item['folder_name']])
-        if not args.format:
             print(table)
 
     def dump(self, args):
@@ -418,8 +455,8 @@ class Command(object):
         PUT document."""
         return obj
 
-    def _dump_for_edit(self, objs, editable, temp_fn):
-        """Dump objects to yaml.
+    def _dump_for_edit(self, objs, editable, temp_fn, fmt='yaml'):
+        """Dump objects to yaml (or jsonl, one object per line).
 
         editable is a list paths into each object, dicts and lists. Example:
 
@@ -428,126 +465,248 @@ class Command(object):
          "features/0/properties/bar", # obj['features'][0]['properties']['bar']
         ]
         """
+        if not objs:
+            return []
+
+        # Write each entry as soon as it is fetched, as an item of the
+        # top-level list, so that the full objects need not all be held
+        # at once
         editable_objects = []
-        for obj in objs:
-            obj = self.client.get_object(self.objtype, id_=obj['id'])
-            editable_object = {}
-            for path in editable:
-                # Pointer to which part of the object we have drilled
-                # down to
-                tmp = self._edit_preprocess(obj)
-
-                # Pointer to the current level in editable_object we are
-                # constructing
-                parent = editable_object
-
-                # Drill through the path, moving both pointers down,
-                # and only copying from the object to editable_object
-                # for the leaves
-                elements = path.split('/')
-                while elements:
-                    element = elements.pop(0)
-                    if element.isdigit():
-                        element = int(element)
-                        childtype = type(tmp[element])
-                        tmp = tmp[element]
-                    else:
-                        childtype = type(tmp[element])
-                        tmp = tmp.get(element, {})
-                    if elements:
-                        try:
-                            parent.setdefault(element, childtype())
-                        except AttributeError:
-                            if len(parent) < element + 1:
-                                parent.append(childtype())
-                    else:
-                        # Assume leaf parent is a dict
-                        parent[element] = tmp
-                    parent = parent[element]
-            editable_objects.append(editable_object)
-
-        if editable_objects:
-            with open(temp_fn, 'w') as f:
+        with open(temp_fn, 'w') as f:
+            if fmt == 'yaml':
                 f.write(os.linesep.join(['# %s' % line
                                          for line in self._edit_preamble()]))
                 f.write(os.linesep * 2)
-                f.write(yaml.dump(editable_objects, default_flow_style=False))
-        return len(editable_objects)
+            for obj in self.client.get_objects(self.objtype,
+                                               [o['id'] for o in objs]):
+                editable_object = self._edit_projection(obj, editable)
+                if fmt == 'jsonl':
+                    f.write(json.dumps(editable_object, sort_keys=True))
+                    f.write('\n')
+                else:
+                    f.write(yaml.dump([editable_object], Dumper=_YAML_DUMPER,
+                                      default_flow_style=False))
+                editable_objects.append(editable_object)
+        return editable_objects
+
+    def _edit_projection(self, obj, editable):
+        """Return the editable parts of an object, as they are dumped.
+
+        The object is pre-processed (in place) first.
+        """
+        obj = self._edit_preprocess(obj)
+        editable_object = {}
+        for path in editable:
+            # Pointer to which part of the object we have drilled
+            # down to
+            tmp = obj
+
+            # Pointer to the current level in editable_object we are
+            # constructing
+            parent = editable_object
+
+            # Drill through the path, moving both pointers down,
+            # and only copying from the object to editable_object
+            # for the leaves
+            elements = path.split('/')
+            while elements:
+                element = elements.pop(0)
+                if element.isdigit():
+                    element = int(element)
+                    childtype = type(tmp[element])
+                    tmp = tmp[element]
+                else:
+                    childtype = type(tmp[element])
+                    tmp = tmp.get(element, {})
+                if elements:
+                    try:
+                        parent.setdefault(element, childtype())
+                    except AttributeError:
+                        if len(parent) < element + 1:
+                            parent.append(childtype())
+                else:
+                    # Assume leaf parent is a dict
+                    parent[element] = tmp
+                parent = parent[element]
+        return editable_object
+
+    @staticmethod
+    def _edit_values(editable_object, editable):
+        """Return the values of the editable paths of an object, for
+        comparison. Missing values are reported as _MISSING."""
+        values = []
+        for path in editable:
+            value = editable_object
+            try:
+                for element in path.split('/'):
+                    if element.isdigit():
+                        element = int(element)
+                    value = value[element]
+            except (KeyError, IndexError, TypeError):
+                value = _MISSING
+            values.append(value)
+        return values
+
+    def _read_for_edit(self, fn, fmt):
+        """Read an edit file.
+
+        Returns the number of entries and an iterable of them. Entries in
+        jsonl files are parsed as they are consumed.
+        """
+        if fmt == 'jsonl':
+            with open(fn, 'r') as f:
+                count = sum(1 for line in f if line.strip())
+
+            def entries():
+                with open(fn, 'r') as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
+
+            return count, entries()
 
-    def _load_for_edit(self, objs, editable, fn):
-        # See definition of editable above in _dump_for_edit()
-        log = logging.getLogger('shell_edit')
         with open(fn, 'r') as f:
-            editable_objects = yaml.load(f.read())
+            editable_objects = yaml.load(f.read(), Loader=_YAML_LOADER)
 
         if not isinstance(editable_objects, list):
             raise Exception('Input file format is incorrect. The top level '
                             'YAML must be a list')
 
-        if len(editable_objects) != len(objs):
+        return len(editable_objects), editable_objects
+
+    def _load_for_edit(self, objs, editable, fn, dumped=None, fmt='yaml'):
+        """Apply edits from a file to the server.
+
+        Only objects whose editable values differ from those that were
+        dumped (if ``dumped`` is given) or from the current server copy
+        are updated, concurrently. Returns False if any update failed.
+        """
+        # See definition of editable above in _dump_for_edit()
+        log = logging.getLogger('shell_edit')
+        count, editable_objects = self._read_for_edit(fn, fmt)
+
+        if count != len(objs):
             raise Exception(
                 ('Input file contains %i items but matched %i from the '
                  'server. Adding and deleting items via the edit process '
-                 'is not supported.') % (len(editable_objects), len(objs)))
-
-        for i, editable_object in enumerate(editable_objects):
-            obj = self.client.get_object(self.objtype, id_=objs[i]['id'])
-
-            # We stored the revision in the waypoint file,
-            # and we are processing a stable ordering. Compare
-            # the n'th server waypoint's revision with the n'th
-            # in the file to make sure we have not gotten out of
-            # sync with the server (as best we can)
-            try:
-                self._rev_match(obj, editable_object)
-            except Exception as e:
-                print('%s #%i: %s' % (self.objtype.title(), i, e))
-                continue
+                 'is not supported.') % (count, len(objs)))
+
+        def changed(editable_object, original):
+            return (self._edit_values(editable_object, editable) !=
+                    self._edit_values(original, editable))
+
+        stats = {'skipped': 0, 'failed': 0}
+        if dumped is not None:
+            # We know what we dumped, so only the changed objects need to
+            # be fetched from the server
+            candidates = [(i, editable_object) for i, editable_object
+                          in enumerate(editable_objects)
+                          if changed(editable_object, dumped[i])]
+            ids = [objs[i]['id'] for i, editable_object in candidates]
+            stats['skipped'] = len(objs) - len(candidates)
+        else:
+            # Entries are matched up with the objects as they are read
+            candidates = enumerate(editable_objects)
+            ids = [obj['id'] for obj in objs]
+
+        def prepare():
+            # Generate the changed objects to PUT, as the entries are read
+            # and the server copies become available
+            if not ids:
+                return
+            server_objects = self.client.get_objects(self.objtype, ids,
+                                                     return_exceptions=True)
+            for (i, editable_object), obj in zip(candidates, server_objects):
+                if isinstance(obj, Exception):
+                    print('Failed to fetch object %i (%s): %s' % (
+                        i, objs[i]['id'], obj))
+                    stats['failed'] += 1
+                    continue
+
+                if dumped is None and not changed(
+                        editable_object,
+                        self._edit_projection(copy.deepcopy(obj), editable)):
+                    stats['skipped'] += 1
+                    continue
+
+                # We stored the revision in the waypoint file,
+                # and we are processing a stable ordering. Compare
+                # the n'th server waypoint's revision with the n'th
+                # in the file to make sure we have not gotten out of
+                # sync with the server (as best we can)
+                try:
+                    self._rev_match(obj, editable_object)
+                except Exception as e:
+                    print('%s #%i: %s' % (self.objtype.title(), i, e))
+                    stats['failed'] += 1
+                    continue
+
+                if obj['id'] != editable_object.get('id'):
+                    log.debug('Server id is %r, local is %r' % (
+                        obj['id'], editable_object.get('id')))
+                    print(('Object %i (%s) id does not match the server;. '
+                           'Unable to apply changes') % (
+                               i, obj['properties']['title']))
+                    stats['failed'] += 1
+                    continue
+
+                for path in editable:
+                    elements = path.split('/')
+                    src = editable_object
+                    dst = obj
+                    while len(elements) > 1:
+                        element = elements.pop(0)
+                        if element.isdigit():
+                            element = int(element)
+                        src = src[element]
+                        dst = dst[element]
+                    leaf = elements[0]
 
-            if obj['id'] != editable_object.get('id'):
-                log.debug('Server id is %r, local is %r' % (
-                    obj['id'], editable_object.get('id')))
-                print(('Object %i (%s) id does not match the server;. '
-                       'Unable to apply changes') % (
-                           i, obj['properties']['title']))
-                continue
+                    try:
+                        dst[leaf] = src[leaf]
+                    except KeyError:
+                        # User removed this key, so just skip
+                        raise Exception(
+                            'Missing key %s from object #%i. '
+                            'Deleting values during edit is not '
+                            'allowed.' % (path, i))
 
-            for path in editable:
-                elements = path.split('/')
-                src = editable_object
-                dst = obj
-                while len(elements) > 1:
-                    element = elements.pop(0)
-                    if element.isdigit():
-                        element = int(element)
-                    src = src[element]
-                    dst = dst[element]
-                leaf = elements[0]
+                obj = self._edit_postprocess(obj)
 
                 try:
-                    dst[leaf] = src[leaf]
+                    title = obj['properties']['title']
                 except KeyError:
-                    # User removed this key, so just skip
-                    raise Exception(
-                        'Missing key %s from object #%i. '
-                        'Deleting values during edit is not allowed.' % (path,
-                                                                         i))
-
-            obj = self._edit_postprocess(obj)
+                    try:
+                        title = obj['features'][0]['properties']['title']
+                    except KeyError:
+                        title = obj['id']
+                yield i, title, obj
 
+        def put(update):
+            i, title, obj = update
             log.debug('Updating object: %s' % obj)
             try:
-                title = obj['properties']['title']
-            except KeyError:
-                try:
-                    title = obj['features'][0]['properties']['title']
-                except KeyError:
-                    title = obj['id']
-            if self.client.put_object(self.objtype, obj):
+                return update, self.client.put_object(self.objtype, obj)
+            except Exception as e:
+                return update, e
+
+        updated = rejected = 0
+        for (i, title, obj), result in util.parallel_map(
+                put, prepare(), concurrency=self.client.concurrency):
+            if result and not isinstance(result, Exception):
                 self.verbose('Updated object %i (%s)' % (i, title))
+                updated += 1
+                continue
+            if isinstance(result, Exception):
+                reason = result
             else:
-                raise Exception(('Failed to update object %i (%s): '
-                                 'server rejected changes') % (i, title))
+                reason = 'server rejected changes'
+            print('Failed to update object %i (%s): %s' % (i, title, reason))
+            rejected += 1
+
+        print('Updated %i, skipped %i unchanged, %i failed' % (
+            updated, stats['skipped'], stats['failed'] + rejected))
+        return not (rejected or stats['failed'])
 
     def _edit(self, args, editable):
         folder_filter = self.folder_filter(args.in_folder)
@@ -565,10 +724,16 @@ class Command(object):
             print('No objects matched criteria.')
             return 1
 
-        temp_fn = '%ss.yml' % self.objtype
+        fmt = args.format
+        if fmt is None:
+            if args.file and args.file.endswith('.jsonl'):
+                fmt = 'jsonl'
+            else:
+                fmt = 'yaml'
+        temp_fn = '%ss.%s' % (self.objtype, 'yml' if fmt == 'yaml' else fmt)
 
         if hasattr(args, 'interactive') and args.interactive:
-            self._dump_for_edit(objs, editable, temp_fn)
+            dumped = self._dump_for_edit(objs, editable, temp_fn, fmt=fmt)
             orig_mtime = os.path.getmtime(temp_fn)
             subprocess.call([util.get_editor(), temp_fn])
             new_mtime = os.path.getmtime(temp_fn)
@@ -576,7 +741,9 @@ class Command(object):
                 print('No changes made; not updating')
                 return 0
             try:
-                self._load_for_edit(objs, editable, temp_fn)
+                if not self._load_for_edit(objs, editable, temp_fn,
+                                           dumped=dumped, fmt=fmt):
+                    return 1
             except Exception as e:
                 log.debug(traceback.format_exc())
                 print(e)
@@ -584,13 +751,16 @@ class Command(object):
 
         elif args.file:
             try:
-                self._load_for_edit(objs, editable, args.file)
+                if not self._load_for_edit(objs, editable, args.file,
+                                           fmt=fmt):
+                    return 1
             except Exception as e:
                 log.debug(traceback.format_exc())
                 print(e)
                 return 1
         else:
-            count = self._dump_for_edit(objs, editable, temp_fn)
+            count = len(self._dump_for_edit(objs, editable, temp_fn,
+                                            fmt=fmt))
             print(('Wrote %i %ss to %r. Edit and then apply '
                    'with edit -f') % (count, self.objtype, temp_fn))
 
@@ -619,12 +789,24 @@ class Tree(Command):
     def opts(parser):
         parser.add_argument('--long', action='store_true',
                             help='Show long format with dates')
+        parser.add_argument('--fast', action='store_true',
+                            help=('Build the tree from object listings '
+                                  'only, without fetching each folder'))
 
     def default(self, args):
+        if args.fast:
+            folders, waypoints, tracks = util.parallel_map(
+                self.client.list_objects, ('folder', 'waypoint', 'track'))
+            root = util.make_tree(folders, waypoints=waypoints,
+                                  tracks=tracks)
+            util.pprint_folder(root, long=args.long)
+            return
+
         folders = self.client.list_objects('folder')
         root = util.make_tree(folders)
-        tree = util.resolve_tree(self.client, root)
-        util.pprint_folder(tree, long=args.long)
+        # Print each top-level folder as soon as its subtree is resolved
+        subfolders = util.iter_resolve_tree(self.client, root)
+        util.pprint_folder(root, long=args.long, subfolders=subfolders)
 
 
 class Query(Command):
@@ -130,6 +130,10 @@ def list_and_dump_ops(cmds):
                       help=('Set explicit output format instead of default '
                             'table layout. Use --format=help for '
                             'instructions'))
+    list.add_argument('--jobs', type=int, metavar='N',
+                      help=('Number of objects to fetch at once for '
+                            '--format (default is %i)' % (
+                                util.DEFAULT_CONCURRENCY)))
     list.add_argument('--in-folder',
                       help='Limit to items in this folder')
     dump = cmds.add_parser('dump', help='Raw dump of the data structure',
@@ -200,6 +204,11 @@ def edit_ops(cmds):
                             'all matches'))
     edit.add_argument('--in-folder',
                       help='Only edit items in this folder')
+    edit.add_argument('--format', choices=('yaml', 'jsonl'),
+                      help=('Format of the edit file: a YAML document, or '
+                            'JSON with one item per line, which is faster '
+                            'for very large edits (default is yaml, or '
+                            'jsonl for a -f file named *.jsonl)'))
 
 
 def show_ops(cmds):
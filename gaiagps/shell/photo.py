@@ -1,11 +1,23 @@
+import hashlib
+import json
+import logging
 import os
 import pathvalidate
+import shutil
+import tempfile
+import threading
 import time
 
 from gaiagps.shell import command
 from gaiagps.shell import options
 from gaiagps import util
 
+LOG = logging.getLogger(__name__)
+
+# The name of the manifest kept in a --sync directory
+MANIFEST_NAME = '.gaiagps-manifest.json'
+MANIFEST_VERSION = 1
+
 type_to_extension = {
     'image/jpeg': 'jpg',
     'image/png': 'png',
@@ -13,6 +25,65 @@ type_to_extension = {
 }
 
 
+class _HashingWriter(object):
+    """A file wrapper that hashes everything written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def _load_manifest(path):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {'version': MANIFEST_VERSION, 'photos': {}}
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise RuntimeError('Unsupported manifest version %r in %s' % (
+            manifest.get('version'), path))
+    return manifest
+
+
+def _save_manifest(path, manifest):
+    # Write a new file and rename it over the old one, so that an
+    # interrupted run does not leave a truncated manifest behind
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix='.manifest-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def _photo_version(photo):
+    # Something from the listing that changes whenever the photo does: its
+    # revision, or failing that when it was last updated. None means we
+    # can not tell, so the photo has to be fetched to find out.
+    revision = util.object_revision(photo)
+    if revision is not None:
+        return revision
+    return (photo.get('updated_date') or
+            (photo.get('properties') or {}).get('updated_date'))
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
 class Photo(command.Command):
     """Manage Photos
 
@@ -40,6 +111,19 @@ class Photo(command.Command):
         export.add_argument('--dry-run', action='store_true',
                             help=('Do not actually export anything '
                                   '(use with --verbose)'))
+        export.add_argument('--size', default='fullsize',
+                            choices=('fullsize', 'scaled', 'thumbnail'),
+                            help='Size of image to download')
+        export.add_argument('--sync', metavar='DIR',
+                            help=('Mirror photos into DIR, keeping a '
+                                  'manifest so that later runs only '
+                                  'download new or changed photos. All '
+                                  'photos are exported if no names are '
+                                  'given.'))
+        export.add_argument('--jobs', type=int, metavar='N',
+                            help=('Number of photos to download at once '
+                                  '(default is %i)' % (
+                                      util.DEFAULT_CONCURRENCY)))
         export.add_argument('name', help='Name (or ID)',
                             nargs='*')
 
@@ -51,26 +135,207 @@ class Photo(command.Command):
             to_export = self.find_objects(args.name, match=args.match,
                                           date_range=args.match_date)
         except command._Safety:
-            to_export = []
+            if args.sync:
+                to_export = self.client.list_objects('photo')
+            else:
+                to_export = []
 
         if not to_export:
             self.verbose('No items matched criteria')
             return 1
 
-        for photo in to_export:
-            if args.dry_run:
+        if args.sync:
+            return self._sync(args, to_export)
+
+        if args.dry_run:
+            for photo in to_export:
                 self.verbose('Would download %r' % photo['title'])
-            else:
-                ds = util.date_parse(photo)
-                ts = time.mktime(ds.timetuple())
-                content_type, content = self.client.get_photo(photo['id'])
+            return
+
+        # Filenames already chosen by downloads in flight
+        claimed = set()
+        lock = threading.Lock()
+
+        def export_one(photo):
+            filenames = []
+
+            def choose_file(content_type):
                 extension = type_to_extension.get(content_type, 'dat')
                 filename = '%s.%s' % (
                     pathvalidate.sanitize_filename(photo['title']), extension)
-                if os.path.exists(filename):
-                    print('File %r already exists; not overwriting' % filename)
-                    continue
-                with open(filename, 'wb') as f:
-                    f.write(content)
-                os.utime(filename, (ts, ts))
+                filenames.append(filename)
+                with lock:
+                    if filename in claimed or os.path.exists(filename):
+                        return None
+                    claimed.add(filename)
+                return filename
+
+            content_type, size = self.client.get_photo(photo['id'],
+                                                       size=args.size,
+                                                       photo=photo,
+                                                       dest=choose_file)
+            ds = util.date_parse(photo)
+            if size is not None and ds:
+                ts = time.mktime(ds.timetuple())
+                os.utime(filenames[0], (ts, ts))
+            return filenames[0], size is not None
+
+        rc = 0
+        results = util.parallel_map(
+            export_one, to_export,
+            concurrency=args.jobs or self.client.concurrency,
+            return_exceptions=True)
+        for photo, result in zip(to_export, results):
+            if isinstance(result, Exception):
+                print('Failed to download %r: %s' % (photo['title'], result))
+                rc = 1
+                continue
+            filename, written = result
+            if written:
                 self.verbose('Wrote %r' % filename)
+            else:
+                print('File %r already exists; not overwriting' % filename)
+        return rc
+
+    def _sync(self, args, to_export):
+        os.makedirs(args.sync, exist_ok=True)
+        manifest_path = os.path.join(args.sync, MANIFEST_NAME)
+        manifest = _load_manifest(manifest_path)
+        entries = manifest['photos']
+
+        def key_for(photo):
+            return '%s/%s' % (photo['id'], args.size)
+
+        def present(entry):
+            return os.path.exists(os.path.join(args.sync, entry['filename']))
+
+        def intact(entry):
+            # The file is still what we wrote there
+            try:
+                st = os.stat(os.path.join(args.sync, entry['filename']))
+            except FileNotFoundError:
+                return False
+            return (st.st_size == entry['size'] and
+                    st.st_mtime == entry['mtime'])
+
+        # Only fetch photos that are new, have changed, or whose file has
+        # gone missing or been changed since the last run
+        todo = []
+        current = 0
+        for photo in to_export:
+            entry = entries.get(key_for(photo))
+            version = _photo_version(photo)
+            if (entry and version is not None and
+                    entry.get('version', entry['revision']) == version and
+                    intact(entry)):
+                current += 1
+            else:
+                todo.append(photo)
+
+        if args.dry_run:
+            for photo in todo:
+                self.verbose('Would download %r' % photo['title'])
+            return
+
+        def fetch(photo):
+            fd, tmp = tempfile.mkstemp(dir=args.sync, prefix='.partial-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    writer = _HashingWriter(f)
+                    content_type, size = self.client.get_photo(
+                        photo['id'], size=args.size, photo=photo, dest=writer)
+            except Exception:
+                os.remove(tmp)
+                raise
+            return content_type, tmp, writer.hexdigest(), size
+
+        # Downloads run in the pool; everything touching the manifest and
+        # the final filenames happens here, in order, as they complete
+        owners = {e['filename']: k for k, e in entries.items()}
+        by_hash = {e['sha256']: e['filename'] for e in entries.values()}
+        hash_of = {e['filename']: e['sha256'] for e in entries.values()}
+
+        def forget(filename):
+            # The file is about to be replaced or removed, so it must not
+            # be used as the source of a link for what it held before
+            digest = hash_of.pop(filename, None)
+            if digest and by_hash.get(digest) == filename:
+                del by_hash[digest]
+
+        downloaded = linked = failed = 0
+        results = util.parallel_map(
+            fetch, todo, concurrency=args.jobs or self.client.concurrency,
+            return_exceptions=True)
+        try:
+            for photo, result in zip(todo, results):
+                if isinstance(result, Exception):
+                    print('Failed to download %r: %s' % (photo['title'],
+                                                         result))
+                    failed += 1
+                    continue
+                content_type, tmp, digest, size = result
+                key = key_for(photo)
+                title = pathvalidate.sanitize_filename(photo['title'])
+                extension = type_to_extension.get(content_type, 'dat')
+                filename = '%s.%s' % (title, extension)
+                if owners.get(filename, key) != key:
+                    # Another photo has the same title
+                    filename = '%s-%s.%s' % (title, photo['id'], extension)
+                target = os.path.join(args.sync, filename)
+
+                old = entries.get(key)
+                if (old and _photo_version(photo) is None and
+                        old['filename'] == filename and
+                        old['sha256'] == digest and intact(old)):
+                    # The listing could not tell us, but it has not changed
+                    os.remove(tmp)
+                    current += 1
+                    continue
+
+                same = by_hash.get(digest)
+                forget(filename)
+                if (same and same != filename and
+                        os.path.exists(os.path.join(args.sync, same))):
+                    os.remove(tmp)
+                    if os.path.exists(target):
+                        os.remove(target)
+                    _link_or_copy(os.path.join(args.sync, same), target)
+                    linked += 1
+                    self.verbose('Linked %r to identical %r' % (
+                        filename, same))
+                else:
+                    os.replace(tmp, target)
+                    downloaded += 1
+                    self.verbose('Wrote %r' % filename)
+                    # Only for files we wrote, as a link shares the time
+                    # of the file it is linked to
+                    ds = util.date_parse(photo)
+                    if ds:
+                        ts = time.mktime(ds.timetuple())
+                        os.utime(target, (ts, ts))
+
+                if old and old['filename'] != filename:
+                    # The title changed, so drop the file under the old name
+                    del owners[old['filename']]
+                    forget(old['filename'])
+                    if present(old):
+                        LOG.debug('Removing renamed %r' % old['filename'])
+                        os.remove(os.path.join(args.sync, old['filename']))
+                entries[key] = {
+                    'filename': filename,
+                    'revision': util.object_revision(photo),
+                    'version': _photo_version(photo),
+                    'sha256': digest,
+                    'size': size,
+                    'mtime': os.stat(target).st_mtime,
+                }
+                owners[filename] = key
+                by_hash[digest] = filename
+                hash_of[filename] = digest
+        finally:
+            _save_manifest(manifest_path, manifest)
+
+        print('Downloaded %i, linked %i duplicates, %i up to date, '
+              '%i failed' % (downloaded, linked, current, failed))
+        if failed:
+            return 1
@@ -3,11 +3,16 @@ import random
 import re
 import textwrap
 
+from gaiagps import apiclient
 from gaiagps.shell import command
 from gaiagps.shell import options
 from gaiagps import util
 
 
+# Map of color codes back to their aliases, for editing
+COLOR_ALIASES_REV = {v: k for k, v in util.COLOR_ALIASES.items()}
+
+
 class Track(command.Command):
     """Manage tracks
 
@@ -80,10 +85,10 @@ class Track(command.Command):
                               ' '.join(util.COLOR_ALIASES.keys())))
 
     def _edit_preprocess(self, obj):
-        color_rev = {v: k for k, v in util.COLOR_ALIASES.items()}
         props = {k: obj['features'][0]['properties'][k]
                  for k in self._editable_properties}
-        props['color'] = color_rev.get(props['color'].upper(), props['color'])
+        props['color'] = COLOR_ALIASES_REV.get(props['color'].upper(),
+                                               props['color'])
         props['id'] = obj['id']
         obj['features'][0]['properties'] = props
         return obj
@@ -119,6 +124,68 @@ class Track(command.Command):
                 raise RuntimeError('Failed to set track %r to %r' % (
                     track_id, color_code))
 
+    def _colorize_from_gpx(self, args, objs, only_folder):
+        if objs:
+            candidates = apiclient.ObjectIndex(only_folder(objs))
+        else:
+            # No names/ids specified, so try to look up everything
+            # in the GPX file, as we find it there
+            candidates = apiclient.ObjectIndex(
+                only_folder(self.client.iter_objects('track')))
+
+        # Tracks are colored as they are read from the file, so we can get
+        # started before a large one has been parsed completely
+        found = 0
+        colored = set()
+        seen = set()
+        ambiguous = 0
+        # Someone that has already read the file (like upload) can pass
+        # along what they found instead of us reading it again
+        tracks = getattr(args, 'gpx_track_colors', None)
+        if tracks is None:
+            tracks = util.iter_track_colors_from_gpx(args.from_gpx_file)
+        else:
+            tracks = tracks.items()
+        for name, color in tracks:
+            found += 1
+            if name in seen:
+                self.verbose('Track %r appears more than once in GPX file; '
+                             'using the first' % name)
+                continue
+            seen.add(name)
+            matches = candidates.lookup('title', name)
+            if not objs and len(matches) > 1:
+                # Nothing tells us which one the file means
+                print('Multiple tracks named %r found; not colorizing '
+                      'them' % name)
+                ambiguous += 1
+                continue
+            self._colorize_tracks_by_id(
+                args.dry_run,
+                {(obj['title'], obj['id']): (
+                    util.COLOR_ALIASES[util.GPXX_COLORS_TO_GAIA[color]])
+                 for obj in matches})
+            colored.update(obj['id'] for obj in matches)
+
+        if not found:
+            print('No colored tracks found in %r' % args.from_gpx_file)
+            return 1
+
+        if objs:
+            for obj in candidates:
+                if obj['id'] not in colored:
+                    self.verbose('Track %r not found in GPX file' % (
+                        obj['title']))
+        else:
+            self.verbose('Looked up %i tracks from %i found in GPX file' % (
+                len(colored), found))
+            if not colored and not ambiguous:
+                print('No matching objects to colorize')
+                return 1
+
+        if ambiguous:
+            return 1
+
     def colorize(self, args):
         try:
             objs = self.find_objects(args.name, match=args.match)
@@ -146,35 +213,7 @@ class Track(command.Command):
                 {(t['title'], t['id']): random.choice(colors)
                  for t in only_folder(objs)})
         elif args.from_gpx_file:
-            gpx_tracks = util.get_track_colors_from_gpx(args.from_gpx_file)
-            to_change = {}
-
-            if not gpx_tracks:
-                print('No colored tracks found in %r' % args.from_gpx_file)
-                return 1
-
-            if not objs:
-                # No names/ids specified, so try to look up everything
-                # in the GPX file. This is not very efficient, but alas.
-                objs = self.find_objects(gpx_tracks.keys(), allow_missing=True)
-                self.verbose(
-                    'Looked up %i tracks from %i found in GPX file' % (
-                        len(objs), len(gpx_tracks)))
-
-            if not objs:
-                print('No matching objects to colorize')
-                return 1
-
-            for obj in only_folder(objs):
-                if obj['title'] in gpx_tracks:
-                    to_change[(obj['title'], obj['id'])] = (
-                        util.COLOR_ALIASES[
-                            util.GPXX_COLORS_TO_GAIA[
-                                gpx_tracks[obj['title']]]])
-                else:
-                    self.verbose('Track %r not found in GPX file' % (
-                        obj['title']))
-            self._colorize_tracks_by_id(args.dry_run, to_change)
+            return self._colorize_from_gpx(args, objs, only_folder)
         elif args.color:
             if not re.match('^#?[A-f0-9]{6}$', args.color):
                 print('Invalid color code. Provide an HTML color like #FCEBDA')
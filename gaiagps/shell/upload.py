@@ -1,6 +1,14 @@
+import collections
+import contextlib
+import copy
+import glob
 import logging
 import os
+import prettytable
+import random
 import sys
+import tempfile
+import threading
 import time
 import traceback
 
@@ -11,79 +19,235 @@ from gaiagps.shell import options
 from gaiagps.shell import track
 
 
+# The delay before the first check for a queued upload, and the most we
+# will back off to between checks, in seconds
+POLL_INITIAL_DELAY = 2
+POLL_MAX_DELAY = 16
+
+
+class _UploadPoller(object):
+    """Waits for queued uploads to show up as folders.
+
+    Any number of threads may wait at once. Only one of them polls at a
+    time, checking every pending name against a single folder listing
+    per tick, and the delay between ticks backs off exponentially (with
+    some jitter) while there is nothing new. Folders that existed before
+    the uploads started (see :meth:`ignore_existing`) are never taken to
+    be one of them, even if they have the same name.
+
+    :param client: The client to poll with
+    :param timeout: How long each upload is waited for, in seconds
+    :type timeout: float
+    :param tick: Called after each tick that does not find an upload
+    :type tick: callable
+    """
+
+    def __init__(self, client, timeout, tick=None):
+        self.client = client
+        self.timeout = timeout
+        self.tick = tick
+        self._cond = threading.Condition()
+        self._pending = collections.Counter()
+        self._found = {}
+        self._claimed = set()
+        self._polling = False
+        self._delay = POLL_INITIAL_DELAY
+
+    def ignore_existing(self):
+        """Ignore the folders that exist now.
+
+        This should be called before uploading, so that the folder left by
+        an earlier upload of the same file is not mistaken for a new one.
+        """
+        self.client.listing_cache.invalidate('folder')
+        folders = self.client.list_objects('folder')
+        with self._cond:
+            self._claimed.update(folder['id'] for folder in folders)
+
+    def _poll(self, delay, remaining):
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        # Make sure we see the latest folder list each time
+        self.client.listing_cache.invalidate('folder')
+        folders = self.client.list_objects('folder')
+        with self._cond:
+            for folder in folders:
+                name = folder['title']
+                if (self._pending[name] and name not in self._found and
+                        folder['id'] not in self._claimed):
+                    self._found[name] = folder['id']
+                    self._claimed.add(folder['id'])
+
+    def wait(self, name):
+        """Wait for an upload to appear.
+
+        :param name: The name of the folder the upload will create
+        :type name: str
+        :returns: The folder, or ``None`` if it did not appear in time
+        :rtype: `dict`
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            if not any(self._pending.values()):
+                self._delay = POLL_INITIAL_DELAY
+            self._pending[name] += 1
+            try:
+                while name not in self._found:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    if self._polling:
+                        # Someone else is polling for all of us
+                        self._cond.wait(remaining)
+                        continue
+
+                    self._polling = True
+                    delay = self._delay
+                    self._delay = min(delay * 2, POLL_MAX_DELAY)
+                    self._cond.release()
+                    try:
+                        self._poll(delay, remaining)
+                    finally:
+                        self._cond.acquire()
+                        self._polling = False
+                        self._cond.notify_all()
+                    if name not in self._found and self.tick:
+                        self.tick()
+                folder_id = self._found.pop(name)
+            finally:
+                self._pending[name] -= 1
+
+        return self.client.get_object('folder', id_=folder_id)
+
+
 class Upload(command.Command):
-    """Upload an entire file of tracks and/or waypoints
+    """Upload entire files of tracks and/or waypoints
 
-    This command takes a file (in a format supported by Gaia) and
-    uploads the data within to gaiagps.com. By default gaiagps.com
-    places this in a new folder of its own, according to the filename.
+    This command takes one or more files (in a format supported by Gaia)
+    and uploads the data within to gaiagps.com. By default gaiagps.com
+    places each in a new folder of its own, according to the filename.
     If the --existing-folder or --new-folder options are provided, the
-    uploaded data will be moved out of the temporary upload folder
-    and the latter will be deleted afterwards.
+    uploaded data will be moved out of the temporary upload folders
+    and the latter will be deleted afterwards. Several files are uploaded
+    at once, and a summary is printed when they are all done.
     """
     @staticmethod
     def opts(parser):
-        parser.add_argument('filename', help='File to upload')
+        parser.add_argument('filename', nargs='+',
+                            help='File(s) (or patterns) to upload')
+        parser.add_argument('--jobs', type=int, metavar='N',
+                            help=('Number of files to upload at once '
+                                  '(default is %i)' % (
+                                      util.DEFAULT_CONCURRENCY)))
         parser.add_argument('--strip-gpx-extensions', action='store_true',
                             help=('Remove all schema extensions from file '
                                   'before uploading. This applies only to '
                                   'GPX files and may help improve '
                                   'compatibility as gaiagps will choke on '
                                   'files with extensions.'))
+        parser.add_argument('--temp-dir', action='store_true',
+                            help=('Write the file stripped of extensions to '
+                                  'a temporary directory (removed after '
+                                  'uploading) instead of next to the '
+                                  'original as clean-FILENAME'))
         parser.add_argument('--poll', action='store_true',
-                            help=('Poll server for up to a minute for '
-                                  'completion in the case where an upload '
-                                  'is queued for processing.'))
+                            help=('Poll server for completion in the case '
+                                  'where an upload is queued for '
+                                  'processing.'))
+        parser.add_argument('--poll-timeout', type=float, default=60,
+                            metavar='SECONDS',
+                            help=('How long to poll for each queued upload '
+                                  '(default is %(default)i seconds)'))
         parser.add_argument('--colorize-tracks', action='store_true',
                             help=('Attempt to colorize tracks after upload '
                                   'to match the source file (GPX only)'))
         options.folder_ops(parser)
 
-    def _poll_for_upload(self, expected_folder):
-        sleep_time = 5
-        timeout = 60
-        self.verbose('Waiting for upload to appear...', '')
-        for i in range(0, timeout // sleep_time):
-            try:
-                folder = self.client.get_object('folder', expected_folder)
-                self.verbose('done')
-                return folder
-            except apiclient.NotFound:
-                pass
+    def _move_to_destination(self, args, new_folder, dest):
+        log = logging.getLogger('upload')
 
-            self.verbose('.', '')
-            sys.stdout.flush()
-            time.sleep(sleep_time)
+        # Uploads finish concurrently, but they all update the same
+        # destination folder, so only one of them may do so at a time
+        with dest['lock']:
+            if args.new_folder and not dest['folder']:
+                dest['folder'] = self.client.create_object(
+                    'folder', util.make_folder(args.new_folder))
+                if not dest['folder']:
+                    print('Uploaded file, but failed to create folder %s' % (
+                        args.new_folder))
+                    return 1
+            dst_folder = dest['folder']
+            if not dst_folder:
+                return
 
-    def default(self, args):
-        log = logging.getLogger('upload')
+            # I want that...other version of a folder
+            folders = self.client.list_objects('folder')
+            new_folder_desc = apiclient.find(folders, 'id', new_folder['id'])
+            dst_folder_desc = apiclient.find(folders, 'id', dst_folder['id'])
 
-        if args.strip_gpx_extensions:
-            tmpfile = os.path.join(
-                os.path.dirname(args.filename),
-                'clean-%s' % os.path.basename(args.filename))
-            self.verbose('Stripping GPX extensions from input file')
-            util.strip_gpx_extensions(args.filename, tmpfile)
-            args.filename = tmpfile
+            log.info('Moving contents of %s to %s' % (
+                new_folder['properties']['name'],
+                dst_folder['properties']['name']))
 
-        if args.existing_folder:
-            dst_folder = self.get_object(args.existing_folder,
-                                         objtype='folder')
-        else:
-            dst_folder = None
+            for waypoint in new_folder_desc['waypoints']:
+                log.info('Moving waypoint %s' % waypoint)
+                dst_folder_desc['waypoints'].append(waypoint)
+            for t in new_folder_desc['tracks']:
+                log.info('Moving track %s' % t)
+                dst_folder_desc['tracks'].append(t)
+            updated_dst = self.client.put_object('folder', dst_folder_desc)
+            log.info('Updated destination folder %s' % (
+                dst_folder['properties']['name']))
+            if not updated_dst:
+                print('Failed to move tracks and waypoints from '
+                      'upload folder %s to requested folder %s' % (
+                          new_folder['properties']['name'],
+                          dst_folder['properties']['name']))
+                return 1
+        log.info('Deleting temporary folder %s' % (
+            new_folder['properties']['name']))
+        self.client.delete_object('folder', new_folder['id'])
 
-        new_folder = self.client.upload_file(args.filename)
+    def _tick(self):
+        self.verbose('.', '')
+        sys.stdout.flush()
+
+    def _upload_one(self, args, filename, dest, poller):
+        log = logging.getLogger('upload')
+
+        track_colors = None
+        upload_name = filename
+        with contextlib.ExitStack() as cleanup:
+            if args.strip_gpx_extensions:
+                if args.temp_dir:
+                    # Keep the name, which the server uses for the folder
+                    tmpdir = cleanup.enter_context(
+                        tempfile.TemporaryDirectory(prefix='gaiagps-'))
+                    upload_name = os.path.join(tmpdir,
+                                               os.path.basename(filename))
+                else:
+                    upload_name = os.path.join(
+                        os.path.dirname(filename),
+                        'clean-%s' % os.path.basename(filename))
+                self.verbose('Stripping GPX extensions from %s' % filename)
+                # The colors are stripped too, so collect them on the way
+                track_colors = util.strip_gpx_extensions(filename,
+                                                         upload_name)
+
+            new_folder = self.client.upload_file(upload_name)
 
         if not new_folder and args.poll:
-            new_folder = self._poll_for_upload(os.path.basename(args.filename))
+            self.verbose('Waiting for upload to appear...', '')
+            new_folder = poller.wait(os.path.basename(upload_name))
+            if new_folder:
+                self.verbose('done')
 
         if not new_folder:
             print('File upload has been queued at the server and '
                   'may take time to appear.')
-            if dst_folder:
+            if dest['folder'] or args.new_folder:
                 print('Unable to move to destination folder until '
                       'processing is complete.')
-            return
+            return 0, 'Queued', ''
 
         log.debug(new_folder)
         log.info('Uploaded file to new folder %s/%s' % (
@@ -92,52 +256,74 @@ class Upload(command.Command):
 
         if args.colorize_tracks:
             track_cmd = track.Track(self.client, verbose=args.verbose)
-            args.name = []
-            args.match = None
-            args.random = None
-            args.dry_run = None
-            args.from_gpx_file = args.filename
-            args.in_folder = new_folder['properties']['name']
+            # Each upload needs its own arguments, as they run at once
+            track_args = copy.copy(args)
+            track_args.name = []
+            track_args.match = None
+            track_args.random = None
+            track_args.dry_run = None
+            track_args.from_gpx_file = filename
+            track_args.gpx_track_colors = track_colors
+            track_args.in_folder = new_folder['properties']['name']
             try:
-                track_cmd.colorize(args)
+                track_cmd.colorize(track_args)
             except Exception as e:
                 log.debug(traceback.format_exc())
                 print('Failed to colorize track: %s' % e)
 
-        if args.new_folder:
-            dst_folder = self.client.create_object('folder',
-                                                   util.make_folder(
-                                                       args.new_folder))
-            if not dst_folder:
-                print('Uploaded file, but failed to create folder %s' % (
-                    args.new_folder))
-                return 1
+        rc = self._move_to_destination(args, new_folder, dest)
+        if rc:
+            return rc, 'Move failed', new_folder['properties']['name']
+        if dest['folder']:
+            return 0, 'Uploaded', dest['folder']['properties']['name']
+        return 0, 'Uploaded', new_folder['properties']['name']
 
-        if dst_folder:
-            # I want that...other version of a folder
-            folders = self.client.list_objects('folder')
-            new_folder_desc = apiclient.find(folders, 'id', new_folder['id'])
-            dst_folder_desc = apiclient.find(folders, 'id', dst_folder['id'])
+    def default(self, args):
+        log = logging.getLogger('upload')
 
-            log.info('Moving contents of %s to %s' % (
-                new_folder['properties']['name'],
-                dst_folder['properties']['name']))
+        # Expand any patterns the shell did not, keeping each file once
+        filenames = []
+        for pattern in args.filename:
+            for filename in sorted(glob.glob(pattern)) or [pattern]:
+                if filename not in filenames:
+                    filenames.append(filename)
 
-            for waypoint in new_folder_desc['waypoints']:
-                log.info('Moving waypoint %s' % waypoint)
-                dst_folder_desc['waypoints'].append(waypoint)
-            for t in new_folder_desc['tracks']:
-                log.info('Moving track %s' % t)
-                dst_folder_desc['tracks'].append(t)
-            updated_dst = self.client.put_object('folder', dst_folder_desc)
-            log.info('Updated destination folder %s' % (
-                dst_folder['properties']['name']))
-            if not updated_dst:
-                print('Failed to move tracks and waypoints from '
-                      'upload folder %s to requested folder %s' % (
-                          new_folder['properties']['name'],
-                          dst_folder['properties']['name']))
-                return 1
-            log.info('Deleting temporary folder %s' % (
-                new_folder['properties']['name']))
-            self.client.delete_object('folder', new_folder['id'])
+        if args.existing_folder:
+            dst_folder = self.get_object(args.existing_folder,
+                                         objtype='folder')
+        else:
+            dst_folder = None
+        dest = {'folder': dst_folder, 'lock': threading.Lock()}
+        poller = _UploadPoller(self.client, args.poll_timeout,
+                               tick=self._tick)
+        if args.poll:
+            poller.ignore_existing()
+
+        def upload(filename):
+            start = time.monotonic()
+            result = self._upload_one(args, filename, dest, poller)
+            return result + (time.monotonic() - start,)
+
+        rc = 0
+        table = prettytable.PrettyTable(['File', 'Result', 'Folder', 'Time'])
+        table.align = 'l'
+        table.align['Time'] = 'r'
+        results = util.parallel_map(
+            upload, filenames,
+            concurrency=args.jobs or self.client.concurrency,
+            return_exceptions=True)
+        for filename, result in zip(filenames, results):
+            if isinstance(result, Exception):
+                log.debug(''.join(traceback.format_exception(
+                    type(result), result, result.__traceback__)))
+                print('Failed to upload %s: %s' % (filename, result))
+                rc = 1
+                table.add_row([filename, 'Failed', '', ''])
+                continue
+            file_rc, status, folder, elapsed = result
+            rc = rc or file_rc
+            table.add_row([filename, status, folder, '%.1fs' % elapsed])
+
+        if len(filenames) > 1:
+            print(table)
+        return rc
@@ -1,4 +1,7 @@
+import csv
+import json
 import logging
+import sys
 import textwrap
 
 from gaiagps.shell import command
@@ -6,6 +9,10 @@ from gaiagps.shell import options
 from gaiagps import util
 
 
+# Map of icon filenames back to their aliases, for editing
+ICON_ALIASES_REV = {v: k for k, v in util.ICON_ALIASES.items()}
+
+
 class Waypoint(command.Command):
     """Manage waypoints
 
@@ -53,6 +60,11 @@ class Waypoint(command.Command):
         coords.add_argument('--show-name', action='store_true',
                             help=('Show the waypoint name after the '
                                   'coordinates, separated by a single space'))
+        coords.add_argument('--format', default='text',
+                            choices=('text', 'csv', 'geojson', 'jsonl'),
+                            help=('Output format (default is text). The '
+                                  'others include the id and name of each '
+                                  'waypoint'))
 
     def list_icons(self, args):
         for alias, filename in util.ICON_ALIASES.items():
@@ -125,13 +137,64 @@ class Waypoint(command.Command):
         elif args.just_one and len(wpts) != 1:
             raise RuntimeError('More than one waypoints matched')
 
-        for wpt in wpts:
-            wpt = self.get_object(wpt['id'])
-            gc = wpt['geometry']['coordinates']
-            output = '%.6f,%.6f' % (gc[1], gc[0])
-            if args.show_name:
-                output += ' %s' % wpt['properties']['title']
-            print(output)
+        # Each line is written as soon as its waypoint (and those before
+        # it) has been fetched. Any that fail are reported on stderr and
+        # left out, so that what is written is still a complete document.
+        failed = []
+
+        def fetched(summaries):
+            objs = self.client.get_objects(self.objtype,
+                                           [w['id'] for w in summaries],
+                                           return_exceptions=True)
+            for summary, wpt in zip(summaries, objs):
+                if isinstance(wpt, Exception):
+                    print('Failed to fetch %s %r: %s' % (
+                        self.objtype, summary['title'], wpt),
+                        file=sys.stderr)
+                    failed.append(summary)
+                    continue
+                yield wpt
+
+        wpts = fetched(wpts)
+        if args.format == 'csv':
+            writer = csv.writer(sys.stdout, lineterminator='\n')
+            writer.writerow(['id', 'title', 'latitude', 'longitude'])
+            for wpt in wpts:
+                gc = wpt['geometry']['coordinates']
+                writer.writerow([wpt['id'], wpt['properties']['title'],
+                                 '%.6f' % gc[1], '%.6f' % gc[0]])
+        elif args.format == 'jsonl':
+            for wpt in wpts:
+                gc = wpt['geometry']['coordinates']
+                print(json.dumps({'id': wpt['id'],
+                                  'title': wpt['properties']['title'],
+                                  'latitude': gc[1],
+                                  'longitude': gc[0]}))
+        elif args.format == 'geojson':
+            sys.stdout.write('{"type": "FeatureCollection", "features": [')
+            for i, wpt in enumerate(wpts):
+                feature = {'type': 'Feature',
+                           'id': wpt['id'],
+                           'geometry': {
+                               'type': 'Point',
+                               'coordinates': wpt['geometry']['coordinates'],
+                           },
+                           'properties': {
+                               'title': wpt['properties']['title'],
+                           }}
+                sep = i and ',\n' or '\n'
+                sys.stdout.write(sep + json.dumps(feature))
+            sys.stdout.write(']}\n')
+        else:
+            for wpt in wpts:
+                gc = wpt['geometry']['coordinates']
+                output = '%.6f,%.6f' % (gc[1], gc[0])
+                if args.show_name:
+                    output += ' %s' % wpt['properties']['title']
+                print(output)
+
+        if failed:
+            return 1
 
     def _rev_match(self, server, local):
         if (server['properties']['revision'] !=
@@ -151,9 +214,8 @@ class Waypoint(command.Command):
                               ' '.join(util.ICON_ALIASES.keys())))
 
     def _edit_preprocess(self, obj):
-        icon_rev = {v: k for k, v in util.ICON_ALIASES.items()}
-        obj['properties']['icon'] = icon_rev.get(obj['properties']['icon'],
-                                                 obj['properties']['icon'])
+        obj['properties']['icon'] = ICON_ALIASES_REV.get(
+            obj['properties']['icon'], obj['properties']['icon'])
         return obj
 
     def _edit_postprocess(self, obj):
@@ -0,0 +1,183 @@
+import asyncio
+import mock
+import os
+import tempfile
+import threading
+import unittest
+
+from gaiagps import aioclient
+from gaiagps import apiclient
+
+
+def _response(status_code=200, url='/foo', json=None, content=b''):
+    r = mock.MagicMock()
+    r.status_code = status_code
+    r.url = url
+    r.json.return_value = json
+    r.content = content
+    return r
+
+
+@unittest.skipIf(aioclient.httpx is None, 'httpx is not installed')
+class TestAsyncClientUnit(unittest.TestCase):
+    def setUp(self):
+        self.client_mock = mock.patch('httpx.AsyncClient')
+        client_mock = self.client_mock.start()
+        self.requests = client_mock.return_value
+        for method in ('get', 'post', 'put', 'delete', 'aclose'):
+            setattr(self.requests, method, mock.AsyncMock())
+        self.requests.get.return_value = _response()
+
+    def tearDown(self):
+        self.client_mock.stop()
+
+    def _run(self, coro):
+        return asyncio.run(coro)
+
+    def test_connect_logged_in(self):
+        api = aioclient.AsyncGaiaClient('foo', 'bar')
+        self._run(api.connect())
+        self.requests.get.assert_called_once_with(apiclient.gurl('profile'))
+        self.requests.post.assert_not_called()
+
+    def test_connect_login(self):
+        self.requests.get.return_value = _response(url='/login')
+        self.requests.post.return_value = _response(url='/something')
+
+        async def connect():
+            async with aioclient.AsyncGaiaClient('foo', 'bar'):
+                pass
+
+        self._run(connect())
+        self.requests.post.assert_called_once_with(
+            apiclient.gurl('register/addDevice'),
+            data={'email': 'foo', 'password': 'bar'})
+        self.requests.aclose.assert_called_once_with()
+
+    def test_connect_login_failure(self):
+        self.requests.get.return_value = _response(url='/login')
+        self.requests.post.return_value = _response(url='/login')
+        api = aioclient.AsyncGaiaClient('foo', 'bar')
+        self.assertRaises(apiclient.AuthFailure, self._run, api.connect())
+
+        api = aioclient.AsyncGaiaClient(None, None)
+        self.assertRaises(RuntimeError, self._run, api.connect())
+
+    def test_list_objects_pages(self):
+        api = aioclient.AsyncGaiaClient('foo', 'bar')
+        self.requests.get.side_effect = [
+            _response(json=[{'id': '1'}, {'id': '2'}]),
+            _response(json=[{'id': '3'}]),
+        ]
+
+        async def list_small_pages():
+            return [i async for i in api.iter_objects('waypoint',
+                                                      page_size=2)]
+
+        objs = self._run(list_small_pages())
+        self.assertEqual(['1', '2', '3'], [o['id'] for o in objs])
+        self.assertEqual(
+            ['1', '2'],
+            [c[1]['params']['page']
+             for c in self.requests.get.call_args_list])
+
+    def test_get_objects(self):
+        api = aioclient.AsyncGaiaClient('foo', 'bar')
+
+        async def fake_get(url):
+            id_ = url.rstrip('/').split('/')[-1]
+            if id_ == 'missing':
+                raise apiclient.NotFound()
+            return _response(json={'id': id_})
+
+        self.requests.get.side_effect = fake_get
+        objs = self._run(api.get_objects('waypoint', ['1', 'missing', '3'],
+                                         concurrency=2,
+                                         return_exceptions=True))
+        self.assertEqual({'id': '1'}, objs[0])
+        self.assertIsInstance(objs[1], apiclient.NotFound)
+        self.assertEqual({'id': '3'}, objs[2])
+
+        self.assertRaises(apiclient.NotFound,
+                          self._run, api.get_objects('waypoint',
+                                                     ['missing']))
+
+    def test_put_object(self):
+        api = aioclient.AsyncGaiaClient('foo', 'bar')
+        self.requests.put.return_value = _response(status_code=201,
+                                                   json={'id': '1'})
+        obj = self._run(api.put_object('waypoint', {'name': 'foo',
+                                                    'id': '1'}))
+        self.assertEqual({'id': '1'}, obj)
+        self.requests.put.assert_called_once_with(
+            apiclient.gurl('api', 'objects', 'waypoint', '1'),
+            json={'name': 'foo', 'id': '1'})
+
+        self.requests.put.return_value = _response(status_code=400)
+        self.assertIsNone(self._run(api.put_object('waypoint', {'id': '1'})))
+
+    def test_add_object_to_folder(self):
+        api = aioclient.AsyncGaiaClient('foo', 'bar')
+        self.requests.get.return_value = _response(json=[
+            {'id': 'folder1', 'waypoints': ['2'], 'children': []},
+        ])
+        self.requests.put.return_value = _response(status_code=201)
+        self._run(api.add_object_to_folder('folder1', 'waypoint', '3'))
+        self.requests.put.assert_called_once_with(
+            apiclient.gurl('api', 'objects', 'folder', 'folder1'),
+            json={'id': 'folder1', 'waypoints': ['2', '3'], 'children': []})
+
+    def test_upload_queued(self):
+        api = aioclient.AsyncGaiaClient('foo', 'bar')
+        bodies = []
+
+        async def fake_post(url, content=None, headers=None):
+            bodies.append((headers, b''.join([c async for c in content])))
+            return _response(content=b'File uploaded to queue')
+
+        self.requests.post.side_effect = fake_post
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'foo.gpx')
+            with open(path, 'wb') as f:
+                f.write(b'gpxdata')
+            self.assertIsNone(self._run(api.upload_file(path)))
+        self.requests.post.assert_called_once_with(
+            apiclient.gurl('upload'), content=mock.ANY, headers=mock.ANY)
+        self.requests.get.assert_not_called()
+
+        headers, body = bodies[0]
+        self.assertEqual(str(len(body)), headers['Content-Length'])
+        self.assertIn(b'filename="foo.gpx"\r\n\r\ngpxdata\r\n', body)
+
+    def test_upload_reads_off_loop(self):
+        api = aioclient.AsyncGaiaClient('foo', 'bar')
+        readers = []
+
+        async def fake_post(url, content=None, headers=None):
+            loop_thread = threading.get_ident()
+            body = b''.join([c async for c in content])
+            self.assertNotIn(loop_thread, readers)
+            self.assertTrue(readers)
+            self.assertIn(b'0123456789' * 10, body)
+            return _response(content=b'File uploaded to queue')
+
+        self.requests.post.side_effect = fake_post
+        real_open = open
+
+        def fake_open(*a, **k):
+            f = real_open(*a, **k)
+            real_read = f.read
+
+            def read(*ra):
+                readers.append(threading.get_ident())
+                return real_read(*ra)
+
+            f.read = read
+            return f
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'foo.gpx')
+            with open(path, 'wb') as f:
+                f.write(b'0123456789' * 10)
+            with mock.patch('builtins.open', fake_open):
+                self._run(api.upload_file(path))
@@ -1,10 +1,14 @@
+import datetime
 import http.cookiejar
+import io
 import mock
 import os
+import requests
 import tempfile
 import unittest
 
 from gaiagps import apiclient
+from gaiagps import cache
 from gaiagps import util
 
 
@@ -105,6 +109,83 @@ class TestClientUnit(unittest.TestCase):
             self.requests.get.assert_called_once_with(
                 apiclient.gurl('api', 'objects', 'waypoint', '2.gpx'))
 
+    def test_get_object_cached(self):
+        api = self.get_api()
+        api.object_cache = mock.MagicMock()
+        api.object_cache.get.return_value = None
+        self.requests.get.return_value.json.side_effect = [
+            {'id': '1', 'properties': {'revision': 5}},
+            [{'id': '1', 'title': 'mypoint', 'revision': 5}],
+        ]
+
+        # Unknown revision, so the cache can not be used
+        obj = api.get_object('waypoint', id_='1')
+        api.object_cache.get.assert_not_called()
+        self.assertEqual({'id': '1', 'properties': {'revision': 5}}, obj)
+        api.object_cache.put.assert_called_once_with('waypoint', '1', 5, obj)
+
+        # Once the listing shows the revision, the cache is used
+        api.list_objects('waypoint')
+        self.requests.get.reset_mock()
+        api.object_cache.get.return_value = mock.sentinel.cached
+        self.assertEqual(mock.sentinel.cached,
+                         api.get_object('waypoint', id_='1'))
+        api.object_cache.get.assert_called_once_with('waypoint', '1', 5)
+        self.requests.get.assert_not_called()
+
+    def test_get_object_after_put(self):
+        api = self.get_api()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        api.object_cache = cache.ObjectCache(
+            os.path.join(tmpdir.name, 'objects.db'))
+        self.addCleanup(api.object_cache.close)
+        self.requests.get.return_value.json.side_effect = [
+            [{'id': '1', 'title': 'old', 'revision': 5}],
+            {'id': '1', 'properties': {'title': 'old', 'revision': 5}},
+            {'id': '1', 'properties': {'title': 'new', 'revision': 5}},
+        ]
+        self.requests.put.return_value.status_code = 200
+
+        api.list_objects('waypoint')
+        api.get_object('waypoint', id_='1')
+        self.assertEqual('old',
+                         api.get_object('waypoint',
+                                        id_='1')['properties']['title'])
+        self.assertEqual(2, self.requests.get.call_count)
+
+        # Once we change it, the cached copy is not used any more
+        api.put_object('waypoint', {'id': '1', 'title': 'new'})
+        self.assertEqual('new',
+                         api.get_object('waypoint',
+                                        id_='1')['properties']['title'])
+        self.assertEqual(3, self.requests.get.call_count)
+
+    def test_get_object_conditional(self):
+        api = self.get_api()
+        api.validator_store = cache.MemoryValidatorStore()
+        url = apiclient.gurl('api', 'objects', 'waypoint', '1')
+
+        r = self.requests.get.return_value
+        r.status_code = 200
+        r.headers = {'ETag': '"rev1"'}
+        r.content = b'{"id": "1"}'
+        r.json.return_value = {'id': '1'}
+        self.assertEqual({'id': '1'}, api.get_object('waypoint', id_='1'))
+        self.requests.get.assert_called_once_with(url)
+        self.assertEqual(1, api.validator_store.downloaded)
+
+        # Unchanged, so the stored body is used
+        self.requests.get.reset_mock()
+        r = requests.Response()
+        r.status_code = 304
+        self.requests.get.return_value = r
+        self.assertEqual({'id': '1'},
+                         api.get_object('waypoint', id_='1'))
+        self.requests.get.assert_called_once_with(
+            url, headers={'If-None-Match': '"rev1"'})
+        self.assertEqual(1, api.validator_store.revalidated)
+
     def test_get_object_failures(self):
         api = self.get_api()
 
@@ -115,6 +196,29 @@ class TestClientUnit(unittest.TestCase):
         self.assertRaises(apiclient.NotFound,
                           api.get_object, 'waypoint', name='foo')
 
+    def test_get_objects(self):
+        api = self.get_api()
+
+        def fake_get(objtype, id_):
+            if id_ == 'missing':
+                raise apiclient.NotFound()
+            return {'id': id_, 'type': objtype}
+
+        with mock.patch.object(api, 'get_object', side_effect=fake_get):
+            objs = list(api.get_objects('waypoint', ['1', '2', '3'],
+                                        concurrency=2))
+            self.assertEqual(['1', '2', '3'], [o['id'] for o in objs])
+
+            objs = list(api.get_objects('waypoint', ['1', 'missing', '3'],
+                                        return_exceptions=True))
+            self.assertEqual({'id': '1', 'type': 'waypoint'}, objs[0])
+            self.assertIsInstance(objs[1], apiclient.NotFound)
+            self.assertEqual({'id': '3', 'type': 'waypoint'}, objs[2])
+
+            self.assertRaises(apiclient.NotFound,
+                              list, api.get_objects('waypoint',
+                                                    ['1', 'missing']))
+
     def test_create_object(self):
         api = self.get_api()
 
@@ -187,6 +291,22 @@ class TestClientUnit(unittest.TestCase):
                       'children': ['folder2'],
                       'waypoints': ['2', 'waypoint1']})
 
+    def test_add_object_to_folder_fresh(self):
+        api = self.get_api()
+        self.requests.put.return_value.status_code = 201
+        self.requests.get.return_value.json.side_effect = [
+            [{'id': 'folder1', 'waypoints': ['2']}],
+            [{'id': 'folder1', 'waypoints': ['2', '3']}],
+        ]
+
+        api.list_objects('folder')
+        # Someone else adds a waypoint, so our cached listing is stale
+        api.add_object_to_folder('folder1', 'waypoint', '4')
+        self.assertEqual(2, self.requests.get.call_count)
+        self.requests.put.assert_called_once_with(
+            apiclient.gurl('api', 'objects', 'folder', 'folder1'),
+            json={'id': 'folder1', 'waypoints': ['2', '3', '4']})
+
     def test_add_object_to_folder_failures(self):
         api = self.get_api()
 
@@ -240,51 +360,197 @@ class TestClientUnit(unittest.TestCase):
                           api.remove_object_from_folder,
                           'none', 'waypoint', '1')
 
-    @mock.patch('builtins.open')
-    def test_upload(self, mock_open):
+    def test_add_remove_objects_folder(self):
         api = self.get_api()
 
+        with mock.patch.object(api, 'list_objects') as mock_list:
+            self.requests.put.return_value.status_code = 201
+            mock_list.side_effect = lambda objtype: [
+                {'id': 'folder1', 'name': 'My Folder',
+                 'waypoints': ['2'], 'tracks': ['t1'], 'children': []},
+            ]
+
+            api.add_objects_to_folder('folder1', {'waypoint': ['3', '4'],
+                                                  'track': ['t2']})
+            mock_list.assert_called_once_with('folder')
+            self.requests.put.assert_called_once_with(
+                apiclient.gurl('api', 'objects', 'folder', 'folder1'),
+                json={'id': 'folder1', 'name': 'My Folder',
+                      'children': [],
+                      'waypoints': ['2', '3', '4'],
+                      'tracks': ['t1', 't2']})
+
+            self.requests.put.reset_mock()
+            api.remove_objects_from_folder('folder1', {'waypoint': ['2'],
+                                                       'track': ['t1']})
+            self.requests.put.assert_called_once_with(
+                apiclient.gurl('api', 'objects', 'folder', 'folder1'),
+                json={'id': 'folder1', 'name': 'My Folder',
+                      'children': [], 'waypoints': [], 'tracks': []})
+
+            # Nothing is changed if any of the objects are not eligible
+            self.requests.put.reset_mock()
+            self.assertRaises(AssertionError,
+                              api.add_objects_to_folder,
+                              'folder1', {'waypoint': ['3', '2']})
+            self.assertRaises(AssertionError,
+                              api.remove_objects_from_folder,
+                              'folder1', {'waypoint': ['2'], 'image': ['1']})
+            self.requests.put.assert_not_called()
+
+    def _upload_file(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, 'foo.gpx')
+        with open(path, 'w') as f:
+            f.write(SAMPLE_GPX % 'point')
+        return path
+
+    def test_upload(self):
+        api = self.get_api()
+        path = self._upload_file()
+        bodies = []
+
+        def fake_post(url, data=None, headers=None, allow_redirects=False):
+            bodies.append((headers['Content-Type'], len(data), data.read()))
+            return mock.DEFAULT
+
+        self.requests.post.side_effect = fake_post
         self.requests.post.return_value.url = '/foo/newfolderid/'
+        progress = mock.MagicMock()
         with mock.patch.object(api, 'get_object') as mock_get:
-            folder = api.upload_file('path/to/foo.gpx')
+            folder = api.upload_file(path, progress=progress)
             self.assertEqual(mock_get.return_value, folder)
             mock_get.assert_called_once_with('folder', id_='newfolderid')
             self.requests.post.assert_called_once_with(
                 apiclient.gurl('upload'),
-                files={'files': mock_open.return_value},
-                data={'name': 'foo.gpx'},
+                data=mock.ANY,
+                headers={'Content-Type': mock.ANY},
                 allow_redirects=True)
-            mock_open.assert_called_once_with('path/to/foo.gpx', 'rb')
 
-    @mock.patch('builtins.open')
-    def test_upload_queued(self, mock_open):
+        content_type, length, body = bodies[0]
+        self.assertTrue(content_type.startswith('multipart/form-data; '))
+        self.assertEqual(length, len(body))
+        self.assertIn(b'name="name"\r\n\r\nfoo.gpx\r\n', body)
+        self.assertIn(b'name="files"; filename="foo.gpx"', body)
+        self.assertIn((SAMPLE_GPX % 'point').encode(), body)
+        progress.assert_called_once_with(length, length)
+
+        # The file is closed when the upload is done
+        self.assertTrue(
+            self.requests.post.call_args[1]['data']._f.closed)
+
+    def test_upload_queued(self):
         api = self.get_api()
+        path = self._upload_file()
 
         self.requests.post.return_value.content = (
             b'blah blah '
             b'File uploaded to queue'
             b' blah blah')
         with mock.patch.object(api, 'get_object') as mock_get:
-            folder = api.upload_file('path/to/foo.gpx')
+            folder = api.upload_file(path)
             self.assertIsNone(folder)
             mock_get.assert_not_called()
 
-    @mock.patch('builtins.open')
-    def test_upload_rejected(self, mock_open):
+    def test_upload_rejected(self):
         api = self.get_api()
+        path = self._upload_file()
 
         self.requests.post.return_value.url = 'foo/upload/'
         with mock.patch.object(api, 'get_object') as mock_get:
             self.assertRaises(RuntimeError,
-                              api.upload_file, 'path/to/foo.gpx')
+                              api.upload_file, path)
             mock_get.assert_not_called()
 
+        # The file is closed even though the body was never read
+        self.assertTrue(
+            self.requests.post.call_args[1]['data']._f.closed)
+
+    def test_multipart_encoder(self):
+        path = self._upload_file()
+        content = (SAMPLE_GPX % 'point').encode()
+        progress = []
+        body = apiclient.MultipartEncoder(
+            {'name': 'a "b".gpx'}, 'files', path, chunk_size=7,
+            progress=lambda sent, total: progress.append((sent, total)))
+        total = len(body)
+
+        # Mix reads of different sizes with iteration
+        data = body.read(3) + body.read(100)
+        data += b''.join(body)
+        self.assertEqual(b'', body.read())
+        self.assertEqual(total, len(data))
+        self.assertTrue(body._f.closed)
+        self.assertEqual((total, total), progress[-1])
+
+        boundary = body.boundary.encode()
+        self.assertEqual(
+            b'--' + boundary + b'\r\n'
+            b'Content-Disposition: form-data; name="name"\r\n\r\n'
+            b'a "b".gpx\r\n'
+            b'--' + boundary + b'\r\n'
+            b'Content-Disposition: form-data; name="files"; '
+            b'filename="foo.gpx"\r\n\r\n' +
+            content +
+            b'\r\n--' + boundary + b'--\r\n',
+            data)
+
+        # A file that shrinks after we have measured it is an error
+        body = apiclient.MultipartEncoder({}, 'files', path)
+        with open(path, 'w'):
+            pass
+        self.assertRaises(RuntimeError, body.read)
+        self.assertTrue(body._f.closed)
+
     def test_gurl(self):
         self.assertEqual('https://www.gaiagps.com/a/b/',
                          apiclient.gurl('a', 'b'))
         self.assertEqual('https://www.gaiagps.com/a/b/c/',
                          apiclient.gurl('a/', '/b', '/c/'))
 
+    def test_object_index(self):
+        items = [
+            {'id': '1', 'title': 'camp', 'folder': ''},
+            {'id': '2', 'title': 'camp', 'folder': 'f1'},
+            {'id': '3', 'title': 'trailhead', 'folder': 'f1'},
+        ]
+        index = apiclient.ObjectIndex(iter(items))
+        self.assertEqual(items, list(index))
+        self.assertEqual(3, len(index))
+
+        self.assertEqual(items[2], apiclient.find(index, 'id', '3'))
+        self.assertEqual(items[2], apiclient.find(index, 'title', 'trailhead'))
+        self.assertRaises(RuntimeError,
+                          apiclient.find, index, 'title', 'camp')
+        self.assertRaises(apiclient.NotFound,
+                          apiclient.find, index, 'id', '4')
+        self.assertEqual(items[:2], index.lookup('title', 'camp'))
+
+        self.assertEqual(items[:2], apiclient.match(index, 'title', '^c'))
+        self.assertEqual(items, apiclient.match(index, 'title', 'a'))
+        # Results are copies, so callers can not corrupt the cache
+        apiclient.match(index, 'title', '^c').pop()
+        self.assertEqual(items[:2], apiclient.match(index, 'title', '^c'))
+
+        self.assertEqual(items[1:], index.in_folder('f1'))
+        self.assertEqual(items[:1], index.in_folder(''))
+        self.assertEqual([], index.in_folder('f2'))
+
+    def test_object_index_between(self):
+        items = [
+            {'id': '1', 'time_created': '2019-06-01T00:00:00Z'},
+            {'id': '2', 'time_created': '2015-10-21T23:29:00Z'},
+            {'id': '3'},
+        ]
+        index = apiclient.ObjectIndex(items)
+        self.assertEqual(items[:1],
+                         index.between(datetime.datetime(2019, 1, 1),
+                                       datetime.datetime(2020, 1, 1)))
+        self.assertEqual([items[1], items[0]],
+                         index.between(datetime.datetime(2015, 1, 1),
+                                       datetime.datetime(2020, 1, 1)))
+
     def test_list_objects(self):
         api = self.get_api()
         expected_params = {
@@ -307,6 +573,91 @@ class TestClientUnit(unittest.TestCase):
             apiclient.gurl('api', 'objects', 'waypoint'),
             params=expected_params)
 
+    def test_iter_objects_pages(self):
+        api = self.get_api()
+        pages = [[{'id': '1'}, {'id': '2'}],
+                 [{'id': '3'}, {'id': '4'}],
+                 [{'id': '5'}]]
+        self.requests.get.return_value.json.side_effect = pages
+
+        items = api.iter_objects('waypoint', page_size=2)
+        self.assertEqual({'id': '1'}, next(items))
+        # Only the first page has been requested so far
+        self.assertEqual(1, self.requests.get.call_count)
+
+        self.assertEqual(['2', '3', '4', '5'], [i['id'] for i in items])
+        self.assertEqual(3, self.requests.get.call_count)
+        self.assertEqual(
+            ['1', '2', '3'],
+            [c[1]['params']['page']
+             for c in self.requests.get.call_args_list])
+        self.assertEqual(
+            {'2'},
+            {c[1]['params']['count']
+             for c in self.requests.get.call_args_list})
+
+    def test_list_objects_all_pages(self):
+        api = self.get_api()
+        full_page = [{'id': str(i)}
+                     for i in range(apiclient.DEFAULT_PAGE_SIZE)]
+        self.requests.get.return_value.json.side_effect = [
+            full_page,
+            [{'id': 'last'}],
+        ]
+        objs = api.list_objects('waypoint')
+        self.assertEqual(apiclient.DEFAULT_PAGE_SIZE + 1, len(objs))
+        self.assertEqual({'id': 'last'}, objs[-1])
+        self.assertEqual(2, self.requests.get.call_count)
+
+    def test_list_objects_cached(self):
+        api = self.get_api()
+        self.requests.get.return_value.json.return_value = [{'id': '1'}]
+        self.requests.put.return_value.status_code = 200
+
+        self.assertEqual([{'id': '1'}], api.list_objects('waypoint'))
+        self.assertEqual([{'id': '1'}], api.list_objects('waypoint'))
+        self.assertEqual(1, self.requests.get.call_count)
+        self.assertEqual(1, api.listing_cache.hits)
+
+        # Changing a track does not affect waypoints
+        api.put_object('track', {'id': '2'})
+        api.list_objects('waypoint')
+        self.assertEqual(1, self.requests.get.call_count)
+
+        # Changing a waypoint (or any folder) does
+        api.put_object('waypoint', {'id': '1'})
+        api.list_objects('waypoint')
+        self.assertEqual(2, self.requests.get.call_count)
+        api.delete_object('folder', '3')
+        api.list_objects('waypoint')
+        self.assertEqual(3, self.requests.get.call_count)
+
+    def test_list_objects_invalidated_during_fetch(self):
+        api = self.get_api()
+        self.requests.get.return_value.json.return_value = [{'id': '1'}]
+        self.requests.put.return_value.status_code = 200
+
+        items = api.iter_objects('waypoint')
+        next(items)
+        # A change lands while the listing is being fetched
+        api.put_object('waypoint', {'id': '1'})
+        self.assertEqual([], list(items))
+
+        # So what was fetched is not cached
+        api.list_objects('waypoint')
+        self.assertEqual(2, self.requests.get.call_count)
+        api.list_objects('waypoint')
+        self.assertEqual(2, self.requests.get.call_count)
+
+    @mock.patch('gaiagps.apiclient.GaiaClient.test_auth')
+    def test_list_objects_cache_disabled(self, mock_test_auth):
+        mock_test_auth.return_value = True
+        api = apiclient.GaiaClient('foo', 'bar', list_cache_ttl=0)
+        self.requests.get.return_value.json.return_value = []
+        api.list_objects('waypoint')
+        api.list_objects('waypoint')
+        self.assertEqual(2, self.requests.get.call_count)
+
     def test_set_objects_archive(self):
         api = self.get_api()
         self.requests.put.return_value.status_code = 200
@@ -339,6 +690,59 @@ class TestClientUnit(unittest.TestCase):
         self.assertEqual(self.requests.get.return_value.content, content)
         self.requests.get.assert_called_once_with('https://foo.com/bar')
 
+    def test_get_photo_stream(self):
+        api = self.get_api()
+        resp = self.requests.get.return_value
+        resp.status_code = 200
+        resp.headers = {'Content-Type': 'image/png'}
+        resp.iter_content.return_value = [b'abc', b'def']
+        photo = {'properties': {'scaled_url': 'https://foo.com/bar'}}
+
+        # To a file object, with the photo already known
+        with mock.patch.object(api, 'get_object') as mock_get:
+            f = io.BytesIO()
+            self.assertEqual(('image/png', 6),
+                             api.get_photo('photo1', size='scaled',
+                                           photo=photo, dest=f))
+            mock_get.assert_not_called()
+        self.assertEqual(b'abcdef', f.getvalue())
+        self.requests.get.assert_called_once_with('https://foo.com/bar',
+                                                  stream=True)
+        resp.close.assert_called_once_with()
+
+        # To a file named for the content type
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dest = mock.MagicMock()
+            dest.return_value = os.path.join(tmpdir, 'foo.png')
+            self.assertEqual(('image/png', 6),
+                             api.get_photo('photo1', size='scaled',
+                                           photo=photo, dest=dest))
+            dest.assert_called_once_with('image/png')
+            with open(dest.return_value, 'rb') as f:
+                self.assertEqual(b'abcdef', f.read())
+
+            # A failed download does not leave a partial file
+            def fail():
+                yield b'abc'
+                raise IOError('connection lost')
+
+            resp.iter_content.side_effect = lambda chunk_size: fail()
+            self.assertRaises(IOError,
+                              api.get_photo, 'photo1', size='scaled',
+                              photo=photo, dest=dest.return_value)
+            self.assertFalse(os.path.exists(dest.return_value))
+
+        # Skipped by the callable
+        self.assertEqual(('image/png', None),
+                         api.get_photo('photo1', size='scaled', photo=photo,
+                                       dest=lambda content_type: None))
+
+        # The photo is fetched if we were not given the URL
+        with mock.patch.object(api, 'get_object') as mock_get:
+            mock_get.return_value = photo
+            api.get_photo('photo1', size='scaled', photo={'id': 'photo1'})
+            mock_get.assert_called_once_with('photo', id_='photo1')
+
     def test_get_photo_errors(self):
         api = self.get_api()
 
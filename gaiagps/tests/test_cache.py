@@ -0,0 +1,249 @@
+import json
+import mock
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import zlib
+
+from gaiagps import cache
+
+
+class TestListingCacheUnit(unittest.TestCase):
+    @mock.patch('time.monotonic')
+    def test_get_put(self, mock_time):
+        mock_time.return_value = 100
+        c = cache.ListingCache(ttl=10)
+        self.assertIsNone(c.get('waypoint', True))
+        c.put('waypoint', True, [{'id': '1'}])
+
+        items = c.get('waypoint', True)
+        self.assertEqual([{'id': '1'}], items)
+        self.assertIsNone(c.get('waypoint', False))
+
+        # Callers get a copy they can modify
+        items[0]['id'] = '2'
+        self.assertEqual([{'id': '1'}], c.get('waypoint', True))
+        self.assertEqual(2, c.hits)
+        self.assertEqual(2, c.misses)
+
+        # Expired
+        mock_time.return_value = 110
+        self.assertIsNone(c.get('waypoint', True))
+
+    def test_disabled(self):
+        c = cache.ListingCache(ttl=0)
+        c.put('waypoint', True, [{'id': '1'}])
+        self.assertIsNone(c.get('waypoint', True))
+        self.assertEqual(1, c.misses)
+
+    def test_invalidate(self):
+        c = cache.ListingCache()
+        for objtype in ('waypoint', 'track', 'folder'):
+            c.put(objtype, True, [])
+        c.invalidate('waypoint', 'folder')
+        self.assertIsNone(c.get('waypoint', True))
+        self.assertIsNone(c.get('folder', True))
+        self.assertEqual([], c.get('track', True))
+
+        c.invalidate()
+        self.assertIsNone(c.get('track', True))
+
+    def test_put_stale_generation(self):
+        c = cache.ListingCache()
+        generation = c.generation('waypoint')
+        c.invalidate('waypoint')
+        c.put('waypoint', True, [{'id': '1'}], generation=generation)
+        self.assertIsNone(c.get('waypoint', True))
+
+        # Other types are unaffected
+        generation = c.generation('track')
+        c.invalidate('waypoint')
+        c.put('track', True, [], generation=generation)
+        self.assertEqual([], c.get('track', True))
+
+        # Invalidating everything affects every type
+        generation = c.generation('track')
+        c.invalidate()
+        c.put('track', True, [], generation=generation)
+        self.assertIsNone(c.get('track', True))
+
+        c.put('track', True, [], generation=c.generation('track'))
+        self.assertEqual([], c.get('track', True))
+
+    def test_put_copies(self):
+        c = cache.ListingCache()
+        items = [{'id': '1'}]
+        c.put('waypoint', True, items)
+        items[0]['id'] = '2'
+        self.assertEqual([{'id': '1'}], c.get('waypoint', True))
+
+
+class TestObjectCacheUnit(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'objects.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_put(self):
+        c = cache.ObjectCache(self.path)
+        self.assertIsNone(c.get('waypoint', '1', 5))
+        c.put('waypoint', '1', 5, {'id': '1', 'properties': {'revision': 5}})
+        self.assertEqual({'id': '1', 'properties': {'revision': 5}},
+                         c.get('waypoint', '1', 5))
+        # Other revisions and types are not returned
+        self.assertIsNone(c.get('waypoint', '1', 6))
+        self.assertIsNone(c.get('track', '1', 5))
+        self.assertEqual(1, c.hits)
+        self.assertEqual(3, c.misses)
+
+        # A new revision replaces the old one
+        c.put('waypoint', '1', 6, {'id': '1'})
+        self.assertIsNone(c.get('waypoint', '1', 5))
+        self.assertEqual({'id': '1'}, c.get('waypoint', '1', 6))
+        c.close()
+
+        # Persistent across instances
+        c = cache.ObjectCache(self.path)
+        self.assertEqual({'id': '1'}, c.get('waypoint', '1', 6))
+        c.close()
+
+    def test_delete(self):
+        c = cache.ObjectCache(self.path)
+        c.put('waypoint', '1', 5, {'id': '1'})
+        c.put('track', '1', 5, {'id': '1'})
+        c.delete('waypoint', '1')
+        self.assertIsNone(c.get('waypoint', '1', 5))
+        self.assertEqual({'id': '1'}, c.get('track', '1', 5))
+        c.close()
+
+    def test_size_tracked(self):
+        def table_size():
+            return c._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+
+        c = cache.ObjectCache(self.path)
+        c.put('waypoint', '1', 1, {'id': '1'})
+        c.put('waypoint', '2', 1, {'id': '2'})
+        c.put('waypoint', '1', 2, {'id': '1', 'more': 'x' * 100})
+        self.assertEqual(table_size(), c._size)
+        c.delete('waypoint', '2')
+        c.delete('waypoint', '3')
+        self.assertEqual(table_size(), c._size)
+        size = c._size
+        c.close()
+
+        # The total is picked up again when the cache is opened
+        c = cache.ObjectCache(self.path)
+        self.assertEqual(size, c._size)
+        c.close()
+
+    @mock.patch('time.time')
+    def test_evict_lru(self, mock_time):
+        mock_time.return_value = 1
+        obj = {'data': os.urandom(200).hex()}
+        size = len(zlib.compress(json.dumps(obj).encode()))
+        # Room for two objects, but not three
+        c = cache.ObjectCache(self.path, max_size=size * 2.5)
+        c.put('waypoint', '1', 1, obj)
+        mock_time.return_value = 2
+        c.put('waypoint', '2', 1, obj)
+        mock_time.return_value = 3
+        # Touch the first so that the second is least-recently-used
+        self.assertIsNotNone(c.get('waypoint', '1', 1))
+        mock_time.return_value = 4
+        c.put('waypoint', '3', 1, obj)
+
+        self.assertIsNotNone(c.get('waypoint', '1', 1))
+        self.assertIsNone(c.get('waypoint', '2', 1))
+        self.assertIsNotNone(c.get('waypoint', '3', 1))
+        c.close()
+
+
+class TestValidatorStoreUnit(unittest.TestCase):
+    def _test_store(self, store):
+        self.assertIsNone(store.get('https://foo/1'))
+        store.put('https://foo/1', '"abc"', None, b'body1')
+        store.put('https://foo/2', None, 'Tue, 01 Jan 2019', b'body2')
+        self.assertEqual(('"abc"', None, b'body1'), store.get('https://foo/1'))
+        self.assertEqual((None, 'Tue, 01 Jan 2019', b'body2'),
+                         store.get('https://foo/2'))
+        store.put('https://foo/1', '"def"', None, b'body3')
+        self.assertEqual(('"def"', None, b'body3'), store.get('https://foo/1'))
+
+    def test_memory(self):
+        self._test_store(cache.MemoryValidatorStore())
+
+    def test_disk(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'validators.db')
+            store = cache.DiskValidatorStore(path)
+            self._test_store(store)
+            store.close()
+
+            store = cache.DiskValidatorStore(path)
+            self.assertEqual(('"def"', None, b'body3'),
+                             store.get('https://foo/1'))
+            store.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch('time.time')
+    def test_disk_evict_lru(self, mock_time):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock_time.return_value = 1
+        body = os.urandom(200)
+        size = len(zlib.compress(body))
+        # Room for two bodies, but not three
+        store = cache.DiskValidatorStore(
+            os.path.join(tmpdir, 'validators.db'), max_size=size * 2.5)
+        store.put('https://foo/1', '"1"', None, body)
+        mock_time.return_value = 2
+        store.put('https://foo/2', '"2"', None, body)
+        mock_time.return_value = 3
+        # Touch the first so that the second is least-recently-used
+        self.assertIsNotNone(store.get('https://foo/1'))
+        mock_time.return_value = 4
+        store.put('https://foo/3', '"3"', None, body)
+
+        self.assertIsNotNone(store.get('https://foo/1'))
+        self.assertIsNone(store.get('https://foo/2'))
+        self.assertIsNotNone(store.get('https://foo/3'))
+        store.close()
+
+    def test_disk_old_schema(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'validators.db')
+        db = sqlite3.connect(path)
+        with db:
+            db.execute('CREATE TABLE validators ('
+                       'key TEXT PRIMARY KEY, etag TEXT, '
+                       'last_modified TEXT, body BLOB NOT NULL)')
+            db.execute('INSERT INTO validators VALUES (?, ?, ?, ?)',
+                       ('https://foo/1', '"1"', None, zlib.compress(b'x')))
+        db.close()
+
+        store = cache.DiskValidatorStore(path)
+        self.assertIsNone(store.get('https://foo/1'))
+        store.put('https://foo/1', '"1"', None, b'x')
+        self.assertEqual(('"1"', None, b'x'), store.get('https://foo/1'))
+        store.close()
+
+    def test_counters(self):
+        store = cache.MemoryValidatorStore()
+        threads = [threading.Thread(target=store.note_downloaded)
+                   for i in range(10)]
+        threads.append(threading.Thread(target=store.note_revalidated))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(10, store.downloaded)
+        self.assertEqual(1, store.revalidated)
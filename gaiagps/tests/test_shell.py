@@ -2,6 +2,7 @@ import contextlib
 import copy
 import datetime
 import io
+import json
 import mock
 import os
 import pprint
@@ -9,9 +10,13 @@ import shlex
 import tempfile
 import time
 import unittest
+import yaml
 
 from gaiagps import apiclient
+from gaiagps import cache
 from gaiagps import shell
+from gaiagps.shell import command
+from gaiagps.shell import waypoint
 from gaiagps.tests import test_apiclient
 from gaiagps.tests import test_util
 from gaiagps import util
@@ -73,6 +78,8 @@ class FakeClient(object):
     ]
 
     s = None
+    listing_cache = cache.ListingCache(0)
+    concurrency = util.DEFAULT_CONCURRENCY
 
     def __init__(self, *a, **k):
         pass
@@ -111,6 +118,9 @@ class FakeClient(object):
         else:
             raise Exception('Invalid type %s' % objtype)
 
+    def iter_objects(self, objtype, archived=True):
+        return iter(self.list_objects(objtype, archived=archived))
+
     def get_object(self, objtype, name=None, id_=None, fmt=None):
         def add_props(o):
             o = copy.deepcopy(o)
@@ -155,12 +165,28 @@ class FakeClient(object):
                 if t['folder'] == obj['id']]
         return obj
 
+    def get_objects(self, objtype, ids, concurrency=None,
+                    return_exceptions=False):
+        for id_ in ids:
+            try:
+                yield self.get_object(objtype, id_=id_)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                yield e
+
     def add_object_to_folder(self, folderid, objtype, objid):
         raise NotImplementedError('Mock me')
 
     def remove_object_from_folder(self, folderid, objtype, objid):
         raise NotImplementedError('Mock me')
 
+    def add_objects_to_folder(self, folderid, objects):
+        raise NotImplementedError('Mock me')
+
+    def remove_objects_from_folder(self, folderid, objects):
+        raise NotImplementedError('Mock me')
+
     def delete_object(self, objtype, id_):
         raise NotImplementedError('Mock me')
 
@@ -179,9 +205,22 @@ class FakeClient(object):
     def test_auth(self):
         raise NotImplementedError('Mock me')
 
-    def get_photo(self, photoid, size='fullsize'):
+    def get_photo(self, photoid, size='fullsize', photo=None, dest=None):
         photo = [x for x in self.PHOTOS if x['id'] == photoid][0]
-        return ('image/jpeg', b'photodatafor%s' % photo['title'].encode())
+        content_type = 'image/jpeg'
+        content = b'photodatafor%s' % photo['title'].encode()
+        if callable(dest):
+            dest = dest(content_type)
+            if dest is None:
+                return content_type, None
+        if dest is None:
+            return content_type, content
+        if not isinstance(dest, str):
+            dest.write(content)
+            return content_type, len(content)
+        with open(dest, 'wb') as f:
+            f.write(content)
+        return content_type, len(content)
 
     def get_access(self, folderid):
         return [{'admin': False,
@@ -279,6 +318,30 @@ class TestShellUnit(unittest.TestCase):
                         '--format "%(title)s"')
         self.assertEqual('wpt1', out.strip())
 
+    def test_list_formatted_parallel(self):
+        real_get_objects = FakeClient.get_objects
+
+        def fake_get_objects(client, objtype, ids, **kwargs):
+            self.assertEqual(['001', '003'], ids)
+            self.assertEqual({'concurrency': 3, 'return_exceptions': True},
+                             kwargs)
+            return real_get_objects(client, objtype, ids, **kwargs)
+
+        with mock.patch.object(FakeClient, 'get_objects', fake_get_objects):
+            out = self._run('waypoint list --match "wpt[13]" --jobs 3 '
+                            '--format "%(title)s"')
+        self.assertEqual(['wpt1', 'wpt3'], out.strip().split(os.linesep))
+
+    @mock.patch.object(FakeClient, 'get_objects')
+    def test_list_formatted_failure(self, mock_get):
+        mock_get.return_value = iter([apiclient.NotFound('gone'),
+                                      {'id': '003',
+                                       'properties': {'title': 'wpt3'}}])
+        out = self._run('waypoint list --match "wpt[13]" '
+                        '--format "%(title)s"', expect_fail=True)
+        self.assertIn('Failed to fetch waypoint \'wpt1\': gone', out)
+        self.assertIn('wpt3', out)
+
     def test_list_format_help(self):
         out = self._run('waypoint list --format=help')
         self.assertIn('format takes', out)
@@ -379,7 +442,7 @@ class TestShellUnit(unittest.TestCase):
         self.assertNotIn('wpt1', out)
         self.assertNotIn('wpt2', out)
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
+    @mock.patch.object(FakeClient, 'add_objects_to_folder')
     def test_move(self, mock_add, verbose=False, dry=False):
         out = self._run('%s waypoint move wpt1 wpt2 folder2 %s' % (
             verbose and '--verbose' or '',
@@ -387,8 +450,8 @@ class TestShellUnit(unittest.TestCase):
         if dry:
             mock_add.assert_not_called()
         else:
-            mock_add.assert_has_calls([mock.call('102', 'waypoint', '001'),
-                                       mock.call('102', 'waypoint', '002')])
+            mock_add.assert_called_once_with(
+                '102', {'waypoint': ['001', '002']})
         if verbose:
             self.assertIn('wpt1', out)
             self.assertIn('wpt2', out)
@@ -407,47 +470,53 @@ class TestShellUnit(unittest.TestCase):
     def test_move_dry_run(self):
         self.test_move(verbose=True, dry=True)
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
+    @mock.patch.object(FakeClient, 'add_objects_to_folder')
     def test_move_match(self, mock_add):
         self._run('waypoint move --match w.*2 folder2')
-        mock_add.assert_has_calls([mock.call('102', 'waypoint', '002')])
+        mock_add.assert_called_once_with('102', {'waypoint': ['002']})
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
+    @mock.patch.object(FakeClient, 'add_objects_to_folder')
     def test_move_match_date(self, mock_add):
         self._run('waypoint move --match-date 2015-10-21 folder2')
-        mock_add.assert_called_once_with('102', 'waypoint', '003')
+        mock_add.assert_called_once_with('102', {'waypoint': ['003']})
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
+    @mock.patch.object(FakeClient, 'add_objects_to_folder')
     def test_move_match_none(self, mock_add):
         out = self._run('waypoint move --match-date 2019-03-14 folder2',
                         expect_fail=True)
         self.assertIn('', out)
         mock_add.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
+    @mock.patch.object(FakeClient, 'add_objects_to_folder')
     def test_move_match_ambiguous(self, mock_add):
         out = self._run('--verbose waypoint move folder2',
                         expect_fail=True)
         self.assertIn('No items', out)
         mock_add.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
+    @mock.patch.object(FakeClient, 'add_objects_to_folder')
     def test_move_to_nonexistent_folder(self, mock_add):
         out = self._run('waypoint move wpt1 wpt2 foobar',
                         expect_fail=True)
         self.assertIn('foobar not found', out)
         mock_add.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'remove_object_from_folder')
+    @mock.patch.object(FakeClient, 'remove_objects_from_folder')
     def test_move_to_root(self, mock_remove):
         out = self._run('waypoint move wpt1 wpt2 /')
-        mock_remove.assert_has_calls([mock.call('101', 'waypoint', '002')])
+        mock_remove.assert_called_once_with('101', {'waypoint': ['002']})
         self.assertIn('\'wpt1\' is already at root', out)
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
+    @mock.patch.object(FakeClient, 'add_objects_to_folder')
+    def test_move_already_in_folder(self, mock_add):
+        out = self._run('waypoint move wpt1 wpt2 folder1')
+        mock_add.assert_called_once_with('101', {'waypoint': ['001']})
+        self.assertIn('\'wpt2\' is already in folder1', out)
+
+    @mock.patch.object(FakeClient, 'add_objects_to_folder')
     def test_move_in_folder_all(self, mock_add):
         self._run('--verbose waypoint move --in-folder folder1 folder2')
-        mock_add.assert_called_once_with('102', 'waypoint', '002')
+        mock_add.assert_called_once_with('102', {'waypoint': ['002']})
 
     @mock.patch.object(FakeClient, 'delete_object')
     def test_remove(self, mock_delete, dry=False):
@@ -586,11 +655,13 @@ class TestShellUnit(unittest.TestCase):
                                            'activities': ['hiking', 'camping'],
                                            'revision': 6}}]}]
         out = self._run('track edit trk1 -f tracks.yml')
-        self.assertEqual('', out)
+        self.assertEqual('Updated 1, skipped 0 unchanged, 0 failed',
+                         out.strip())
         mock_open.assert_called_once_with('tracks.yml', 'r')
         fake_file = mock_open.return_value.__enter__.return_value
         fake_file.read.assert_called_once_with()
-        mock_load.assert_called_once_with(fake_file.read.return_value)
+        mock_load.assert_called_once_with(fake_file.read.return_value,
+                                          Loader=command._YAML_LOADER)
         obj = FakeClient().get_object('track', 'trk1')
         expected = copy.deepcopy(obj['features'][0]['properties'])
         expected['title'] = 'newname'
@@ -607,7 +678,8 @@ class TestShellUnit(unittest.TestCase):
         mock_load.return_value = [{'id': '201',
                                    'features': [{
                                        'properties': {'title': 'val'}}]}]
-        out = self._run('track edit trk1 -f track.yml')
+        out = self._run('track edit trk1 -f track.yml',
+                        expect_fail=True)
         self.assertIn('changed on the server', out)
 
         # ID mismatch
@@ -618,7 +690,8 @@ class TestShellUnit(unittest.TestCase):
                                                       'notes': '',
                                                       'public': False,
                                                       'title': 'val'}}]}]
-        out = self._run('--debug --verbose track edit trk1 -f track.yml')
+        out = self._run('--debug --verbose track edit trk1 -f track.yml',
+                        expect_fail=True)
         self.assertIn('id does not match', out)
 
         # User removed a value
@@ -791,15 +864,161 @@ class TestShellUnit(unittest.TestCase):
                                        'title': 'newname',
                                        'revision': 6}}]
         out = self._run('waypoint edit wpt3 -f waypoint.yml')
-        self.assertEqual('', out)
+        self.assertEqual('Updated 1, skipped 0 unchanged, 0 failed',
+                         out.strip())
         mock_open.assert_called_once_with('waypoint.yml', 'r')
         fake_file = mock_open.return_value.__enter__.return_value
         fake_file.read.assert_called_once_with()
-        mock_load.assert_called_once_with(fake_file.read.return_value)
+        mock_load.assert_called_once_with(fake_file.read.return_value,
+                                          Loader=command._YAML_LOADER)
         updated = copy.deepcopy(FakeClient().get_object('waypoint', 'wpt3'))
         updated['properties']['title'] = 'newname'
         mock_put.assert_called_once_with('waypoint', updated)
 
+    def test_edit_waypoint_dump_streams(self):
+        cmd = waypoint.Waypoint(FakeClient())
+        wpts = []
+        for i in range(3):
+            wpt = FakeClient().get_object('waypoint', id_='003')
+            wpt['id'] = str(i)
+            wpts.append(wpt)
+        editable = ['id', 'properties/icon', 'properties/title']
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, 'waypoints.yml')
+            with mock.patch.object(FakeClient, 'get_objects',
+                                   return_value=iter(wpts)):
+                dumped = cmd._dump_for_edit([{'id': w['id']} for w in wpts],
+                                            editable, fn)
+            with open(fn) as f:
+                loaded = yaml.safe_load(f)
+
+        expected = [{'id': str(i), 'properties': {'icon': 'foo',
+                                                  'title': 'wpt3'}}
+                    for i in range(3)]
+        self.assertEqual(expected, loaded)
+        self.assertEqual(expected, dumped)
+
+    @mock.patch.object(FakeClient, 'put_object')
+    def test_edit_waypoint_jsonl(self, mock_put):
+        mock_put.return_value = {'id': '003'}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, 'waypoints.jsonl')
+            cmd = waypoint.Waypoint(FakeClient())
+            editable = ['id'] + ['properties/%s' % p for p in (
+                'icon', 'notes', 'public', 'title', 'revision')]
+            objs = [{'id': '003'}]
+            cmd._dump_for_edit(objs, editable, fn, fmt='jsonl')
+            with open(fn) as f:
+                lines = f.readlines()
+            self.assertEqual(1, len(lines))
+            entry = json.loads(lines[0])
+            self.assertEqual({'id': '003',
+                              'properties': {'icon': 'foo', 'notes': '',
+                                             'public': False,
+                                             'title': 'wpt3',
+                                             'revision': 6}}, entry)
+
+            # Edit and apply it, inferring the format from the name
+            entry['properties']['title'] = 'newname'
+            with open(fn, 'w') as f:
+                f.write(json.dumps(entry) + '\n\n')
+            out = self._run('waypoint edit wpt3 -f %s' % fn)
+
+        self.assertIn('Updated 1, skipped 0 unchanged, 0 failed', out)
+        updated = FakeClient().get_object('waypoint', id_='003')
+        updated['properties']['title'] = 'newname'
+        mock_put.assert_called_once_with('waypoint', updated)
+
+    @mock.patch.object(FakeClient, 'put_object')
+    @mock.patch('builtins.open')
+    @mock.patch('yaml.load')
+    def test_edit_waypoint_load_unchanged(self, mock_load, mock_open,
+                                          mock_put):
+        mock_load.return_value = [{'id': '003',
+                                   'properties': {
+                                       'icon': 'foo',
+                                       'notes': '',
+                                       'public': False,
+                                       'title': 'wpt3',
+                                       'revision': 6}}]
+        out = self._run('waypoint edit wpt3 -f waypoint.yml')
+        self.assertEqual('Updated 0, skipped 1 unchanged, 0 failed',
+                         out.strip())
+        mock_put.assert_not_called()
+
+        # A failed update is reported, along with the reason
+        mock_load.return_value[0]['properties']['notes'] = 'changed'
+        mock_put.side_effect = apiclient.NotFound('it is gone')
+        out = self._run('waypoint edit wpt3 -f waypoint.yml',
+                        expect_fail=True)
+        self.assertIn('Failed to update object 0 (wpt3): it is gone', out)
+        self.assertIn('Updated 0, skipped 0 unchanged, 1 failed', out)
+
+    @mock.patch.object(FakeClient, 'put_object')
+    @mock.patch.object(FakeClient, 'get_objects')
+    @mock.patch('builtins.open')
+    @mock.patch('yaml.load')
+    def test_edit_waypoint_load_dumped(self, mock_load, mock_open,
+                                       mock_get, mock_put):
+        cmd = waypoint.Waypoint(FakeClient())
+        editable = ['id', 'properties/title', 'properties/revision']
+        dumped = [{'id': '003', 'properties': {'title': 'wpt3',
+                                               'revision': 6}}]
+        objs = [{'id': '003'}]
+
+        # Nothing changed since the dump, so nothing is fetched or updated
+        mock_load.return_value = copy.deepcopy(dumped)
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertTrue(cmd._load_for_edit(objs, editable, 'wpt.yml',
+                                               dumped=dumped))
+        mock_get.assert_not_called()
+        mock_put.assert_not_called()
+
+        # Only the changed object is fetched
+        mock_load.return_value[0]['properties']['title'] = 'new'
+        mock_get.return_value = [
+            FakeClient().get_object('waypoint', id_='003')]
+        mock_put.return_value = {'id': '003'}
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertTrue(cmd._load_for_edit(objs, editable, 'wpt.yml',
+                                               dumped=dumped))
+        mock_get.assert_called_once_with('waypoint', ['003'],
+                                         return_exceptions=True)
+        self.assertEqual('new',
+                         mock_put.call_args[0][1]['properties']['title'])
+
+    @mock.patch.object(FakeClient, 'put_object')
+    @mock.patch.object(FakeClient, 'get_objects')
+    @mock.patch('builtins.open')
+    @mock.patch('yaml.load')
+    def test_edit_waypoint_load_fetch_failed(self, mock_load, mock_open,
+                                             mock_get, mock_put):
+        cmd = waypoint.Waypoint(FakeClient())
+        editable = ['id', 'properties/title', 'properties/revision']
+        dumped = [{'id': '002', 'properties': {'title': 'wpt2',
+                                               'revision': 6}},
+                  {'id': '003', 'properties': {'title': 'wpt3',
+                                               'revision': 6}}]
+        objs = [{'id': '002'}, {'id': '003'}]
+        mock_load.return_value = copy.deepcopy(dumped)
+        for entry in mock_load.return_value:
+            entry['properties']['title'] = 'new'
+        mock_get.return_value = iter([
+            apiclient.NotFound('gone'),
+            FakeClient().get_object('waypoint', id_='003')])
+        mock_put.return_value = {'id': '003'}
+
+        # The other object is still updated, but the result is a failure
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+            self.assertFalse(cmd._load_for_edit(objs, editable, 'wpt.yml',
+                                                dumped=dumped))
+        self.assertIn('Failed to fetch object 0 (002): gone', out.getvalue())
+        self.assertIn('Updated 1, skipped 0 unchanged, 1 failed',
+                      out.getvalue())
+        mock_put.assert_called_once_with('waypoint', mock.ANY)
+        self.assertEqual('003', mock_put.call_args[0][1]['id'])
+
     @mock.patch.object(FakeClient, 'put_object')
     @mock.patch('builtins.open')
     @mock.patch('yaml.load')
@@ -830,13 +1049,15 @@ class TestShellUnit(unittest.TestCase):
                                                   'notes': '',
                                                   'public': False,
                                                   'title': 'val'}}]
-        out = self._run('waypoint edit wpt3 -f waypoint.yml')
+        out = self._run('waypoint edit wpt3 -f waypoint.yml',
+                        expect_fail=True)
         self.assertIn('changed on the server', out)
 
         # User deleted revision
         mock_load.return_value = [{'id': '003',
                                    'properties': {'title': 'val'}}]
-        out = self._run('waypoint edit wpt3 -f waypoint.yml')
+        out = self._run('waypoint edit wpt3 -f waypoint.yml',
+                        expect_fail=True)
         self.assertIn('changed on the server', out)
 
         # ID mismatch
@@ -846,7 +1067,8 @@ class TestShellUnit(unittest.TestCase):
                                                   'notes': '',
                                                   'public': False,
                                                   'title': 'val'}}]
-        out = self._run('waypoint edit wpt3 -f waypoint.yml')
+        out = self._run('waypoint edit wpt3 -f waypoint.yml',
+                        expect_fail=True)
         self.assertIn('id does not match', out)
 
         # User removed a value
@@ -912,10 +1134,10 @@ class TestShellUnit(unittest.TestCase):
     def test_edit_waypoint_in_folder(self, mock_dump):
         the_wpts = []
 
-        def _dump(wpts, editable, fn):
+        def _dump(wpts, editable, fn, fmt):
             the_wpts.clear()
             the_wpts.extend(wpts)
-            return 1
+            return wpts
 
         mock_dump.side_effect = _dump
 
@@ -942,6 +1164,86 @@ class TestShellUnit(unittest.TestCase):
         self._run('upload foo.gpx')
         mock_upload.assert_called_once_with('foo.gpx')
 
+    @mock.patch.object(FakeClient, 'put_object')
+    @mock.patch.object(FakeClient, 'upload_file')
+    def test_upload_strip_and_colorize(self, mock_upload, mock_put):
+        uploaded = []
+
+        def fake_upload(filename):
+            with open(filename) as f:
+                uploaded.append((filename, f.read()))
+            return {'id': '102', 'properties': {'name': 'folder2'}}
+
+        mock_upload.side_effect = fake_upload
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'foo.gpx')
+            with open(source, 'w') as f:
+                f.write(test_util.GPX_WITH_EXTENSIONS.replace(
+                    'gaiagpsclient test data test track', 'trk2'))
+            with mock.patch('gaiagps.util.iter_track_colors_from_gpx') as \
+                    mock_colors:
+                self._run('upload --strip-gpx-extensions --temp-dir '
+                          '--colorize-tracks %s' % source)
+            self.assertEqual(['foo.gpx'], os.listdir(tmpdir))
+
+        # The file was only read once, and the colors come from the
+        # original, not the stripped copy
+        mock_colors.assert_not_called()
+        mock_put.assert_called_once_with('track', {'id': '202',
+                                                   'color': '#F90553'})
+
+        # The stripped copy keeps its name, in a directory that is gone
+        filename, content = uploaded[0]
+        self.assertEqual('foo.gpx', os.path.basename(filename))
+        self.assertNotEqual(tmpdir, os.path.dirname(filename))
+        self.assertFalse(os.path.exists(os.path.dirname(filename)))
+        self.assertNotIn('<extensions>', content)
+
+    @mock.patch.object(FakeClient, 'delete_object')
+    @mock.patch.object(FakeClient, 'put_object')
+    @mock.patch.object(FakeClient, 'create_object')
+    @mock.patch.object(FakeClient, 'upload_file')
+    def test_upload_many(self, mock_upload, mock_create, mock_put,
+                         mock_delete):
+        folders = {'a.gpx': {'id': '101', 'properties': {'name': 'folder1'}},
+                   'b.gpx': {'id': '102', 'properties': {'name': 'folder2'}}}
+
+        def fake_upload(filename):
+            try:
+                return folders[os.path.basename(filename)]
+            except KeyError:
+                raise RuntimeError('Server rejected file')
+
+        mock_upload.side_effect = fake_upload
+        mock_create.return_value = {'id': '104',
+                                    'properties': {'name': 'emptyfolder'}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ('a.gpx', 'b.gpx', 'c.kml'):
+                with open(os.path.join(tmpdir, name), 'w'):
+                    pass
+            pattern = os.path.join(tmpdir, '*.gpx')
+            out = self._run('upload --jobs 2 --new-folder emptyfolder '
+                            '%s %s %s' % (pattern,
+                                          os.path.join(tmpdir, 'a.gpx'),
+                                          os.path.join(tmpdir, 'c.kml')),
+                            expect_fail=True)
+
+        self.assertEqual(['a.gpx', 'b.gpx', 'c.kml'],
+                         sorted(os.path.basename(c[0][0])
+                                for c in mock_upload.call_args_list))
+        # The destination is only created once, and each upload is moved
+        mock_create.assert_called_once_with('folder', mock.ANY)
+        self.assertEqual(2, mock_put.call_count)
+        self.assertEqual(['104', '104'],
+                         [c[0][1]['id'] for c in mock_put.call_args_list])
+        mock_delete.assert_has_calls([mock.call('folder', '101'),
+                                      mock.call('folder', '102')],
+                                     any_order=True)
+        self.assertIn('Failed to upload', out)
+        self.assertIn('Server rejected file', out)
+        self.assertRegex(out, r'a\.gpx +\| Uploaded \| emptyfolder')
+        self.assertRegex(out, r'c\.kml +\| Failed')
+
     @mock.patch.object(FakeClient, 'upload_file')
     @mock.patch('gaiagps.util.strip_gpx_extensions')
     def test_upload_strip_gpx_extensions(self, mock_strip, mock_upload):
@@ -958,34 +1260,78 @@ class TestShellUnit(unittest.TestCase):
         self.assertIn('upload has been queued', out)
         self.assertIn('Unable to move', out)
 
+    @mock.patch('time.monotonic')
     @mock.patch('time.sleep')
+    @mock.patch.object(FakeClient, 'list_objects')
     @mock.patch.object(FakeClient, 'get_object')
     @mock.patch.object(FakeClient, 'upload_file')
-    def test_upload_queued_poll(self, mock_upload, mock_get, mock_sleep):
+    def test_upload_queued_poll(self, mock_upload, mock_get, mock_list,
+                                mock_sleep, mock_time):
+        now = [0]
+        mock_time.side_effect = lambda: now[0]
+
+        def fake_sleep(seconds):
+            now[0] += seconds
+
+        mock_sleep.side_effect = fake_sleep
         mock_upload.return_value = None
-        mock_get.side_effect = [apiclient.NotFound,
-                                apiclient.NotFound,
-                                {'id': 'foo',
-                                 'properties': {
-                                     'name': 'folder'}}]
+        # A folder from an earlier upload of the same file is not ours
+        old = {'id': 'old', 'title': 'foo.gpx'}
+        mock_list.side_effect = [[old],
+                                 [old],
+                                 [old, {'id': 'bar', 'title': 'bar.gpx'}],
+                                 [old, {'id': 'foo', 'title': 'foo.gpx'}]]
+        mock_get.return_value = {'id': 'foo',
+                                 'properties': {'name': 'folder'}}
         out = self._run('--verbose upload --poll foo.gpx')
         self.assertIn('..done', out)
-        mock_get.assert_has_calls([mock.call('folder', 'foo.gpx'),
-                                   mock.call('folder', 'foo.gpx'),
-                                   mock.call('folder', 'foo.gpx')])
+        mock_list.assert_has_calls([mock.call('folder')] * 4)
+        mock_get.assert_called_once_with('folder', id_='foo')
 
-        mock_get.side_effect = apiclient.NotFound
-        out = self._run('--verbose upload --poll foo.gpx')
+        # Each tick waits longer than the last, with some jitter
+        delays = [c[0][0] for c in mock_sleep.call_args_list]
+        self.assertTrue(1 <= delays[0] <= 2)
+        self.assertTrue(2 <= delays[1] <= 4)
+        self.assertTrue(4 <= delays[2] <= 8)
+
+        # Give up once the deadline passes
+        mock_list.reset_mock()
+        mock_list.side_effect = None
+        mock_list.return_value = []
+        out = self._run('--verbose upload --poll --poll-timeout 30 foo.gpx')
         self.assertIn('queued at the server', out)
+        self.assertTrue(3 <= mock_list.call_count <= 20)
 
+    @mock.patch('time.sleep')
+    @mock.patch.object(FakeClient, 'list_objects')
+    @mock.patch.object(FakeClient, 'get_object')
     @mock.patch.object(FakeClient, 'upload_file')
-    @mock.patch('gaiagps.util.get_track_colors_from_gpx')
+    def test_upload_queued_poll_many(self, mock_upload, mock_get, mock_list,
+                                     mock_sleep):
+        mock_upload.return_value = None
+        folders = [{'id': 'f%i' % i, 'title': '%i.gpx' % i}
+                   for i in range(4)]
+        mock_list.side_effect = lambda objtype: (
+            folders if mock_list.call_count > 1 else [])
+        mock_get.side_effect = lambda objtype, id_: {
+            'id': id_, 'properties': {'name': id_}}
+        out = self._run('upload --poll --jobs 4 0.gpx 1.gpx 2.gpx 3.gpx')
+        # One listing (after the one of existing folders) can satisfy
+        # all of the waiting uploads
+        self.assertTrue(2 <= mock_list.call_count <= 5)
+        self.assertEqual(['f0', 'f1', 'f2', 'f3'],
+                         sorted(c[1]['id_'] for c in mock_get.call_args_list))
+        for i in range(4):
+            self.assertRegex(out, r'%i\.gpx +\| Uploaded \| f%i' % (i, i))
+
+    @mock.patch.object(FakeClient, 'upload_file')
+    @mock.patch('gaiagps.util.iter_track_colors_from_gpx')
     @mock.patch.object(FakeClient, 'put_object')
     def test_upload_colorize_tracks(self, mock_put, mock_colors, mock_upload):
         mock_upload.return_value = {'id': '102',
                                     'properties': {'name': 'folder2'}}
         mock_colors.return_value = {'trk1': 'Red',
-                                    'trk2': 'Green'}
+                                    'trk2': 'Green'}.items()
         self._run('--verbose upload --colorize-tracks foo.gpx')
         # Since we're reusing fake folder2 from the fixture, which has
         # only trk2 in it, we expect to only see trk2 updated since
@@ -1058,6 +1404,64 @@ class TestShellUnit(unittest.TestCase):
         self._run('waypoint coords',
                   expect_fail=True)
 
+    def test_waypoint_coords_formats(self):
+        out = self._run('waypoint coords --format csv --match wpt')
+        lines = out.strip().splitlines()
+        self.assertEqual('id,title,latitude,longitude', lines[0])
+        self.assertEqual('001,wpt1,45.500000,-122.000000', lines[1])
+        self.assertEqual(4, len(lines))
+
+        out = self._run('waypoint coords --format jsonl --match wpt')
+        entries = [json.loads(line) for line in out.strip().splitlines()]
+        self.assertEqual({'id': '001', 'title': 'wpt1',
+                          'latitude': 45.5, 'longitude': -122.0},
+                         entries[0])
+        self.assertEqual(['001', '002', '003'], [e['id'] for e in entries])
+
+        out = self._run('waypoint coords --format geojson --match wpt')
+        collection = json.loads(out)
+        self.assertEqual('FeatureCollection', collection['type'])
+        self.assertEqual(['001', '002', '003'],
+                         [f['id'] for f in collection['features']])
+        self.assertEqual({'type': 'Point',
+                          'coordinates': [-122.0, 45.5, 123]},
+                         collection['features'][0]['geometry'])
+
+        out = self._run('waypoint coords --format geojson wpt9',
+                        expect_fail=True)
+
+    @mock.patch.object(FakeClient, 'get_objects')
+    def test_waypoint_coords_failure(self, mock_get):
+        wpt3 = {'id': '003',
+                'geometry': {'coordinates': [-122.0, 45.5, 123]},
+                'properties': {'title': 'wpt3'}}
+        for fmt in ('text', 'csv', 'jsonl', 'geojson'):
+            mock_get.return_value = iter([apiclient.NotFound('gone'), wpt3])
+            out = FakeOutput()
+            err = FakeOutput()
+            with mock.patch.multiple('sys', stdout=out, stderr=err,
+                                     stdin=out):
+                rc = shell.main(shlex.split(
+                    'waypoint coords --format %s --match "wpt[13]"' % fmt))
+            self.assertEqual(1, rc)
+            self.assertIn('Failed to fetch waypoint \'wpt1\': gone',
+                          err.getvalue())
+            self.assertNotIn('wpt1', out.getvalue())
+            mock_get.assert_called_with('waypoint', ['001', '003'],
+                                        return_exceptions=True)
+            if fmt == 'geojson':
+                collection = json.loads(out.getvalue())
+                self.assertEqual(['003'],
+                                 [f['id'] for f in collection['features']])
+            elif fmt == 'jsonl':
+                self.assertEqual('003',
+                                 json.loads(out.getvalue())['id'])
+            elif fmt == 'csv':
+                self.assertEqual(2, len(out.getvalue().splitlines()))
+            else:
+                self.assertEqual('45.500000,-122.000000',
+                                 out.getvalue().strip())
+
     @mock.patch.object(FakeClient, 'create_object')
     def test_add_folder(self, fake_create):
         out = self._run('folder add foo')
@@ -1310,6 +1714,15 @@ class TestShellUnit(unittest.TestCase):
         mock_test.return_value = True
         self._run('--debug test')
 
+    @mock.patch('gaiagps.cache.ObjectCache')
+    @mock.patch.object(FakeClient, 'test_auth')
+    def test_object_cache(self, mock_test, mock_cache):
+        mock_test.return_value = True
+        self._run('test')
+        mock_cache.assert_not_called()
+        self._run('--object-cache test')
+        mock_cache.assert_called_once_with()
+
     @mock.patch.object(FakeClient, '__init__')
     def test_client_init_login_failure(self, mock_init):
         mock_init.side_effect = Exception()
@@ -1422,6 +1835,15 @@ class TestShellUnit(unittest.TestCase):
         self.assertIn('folder1', out)
         self.assertIn('21 Oct', out)
 
+    def test_tree_fast(self):
+        with mock.patch.object(FakeClient, 'get_object') as mock_get:
+            out = self._run('tree --fast')
+            mock_get.assert_not_called()
+        self.assertEqual(self._run('tree'), out)
+
+        out = self._run('tree --fast --long')
+        self.assertIn('21 Oct', out)
+
     @mock.patch.object(FakeClient, 'put_object')
     def test_colorize_track(self, mock_put):
         # Bad color
@@ -1490,13 +1912,13 @@ class TestShellUnit(unittest.TestCase):
         mock_put.assert_any_call('track', {'id': '202',
                                            'color': 'color2'})
 
-    @mock.patch('gaiagps.util.get_track_colors_from_gpx')
+    @mock.patch('gaiagps.util.iter_track_colors_from_gpx')
     @mock.patch.object(FakeClient, 'put_object')
     def test_colorize_track_from_gpx(self, mock_put, mock_get_tracks):
         mock_get_tracks.return_value = {
             'trk1': 'Red',
             'trk3': 'Green',
-        }
+        }.items()
 
         # Match with no matches
         out = self._run('track colorize --from-gpx-file foo.gpx --match notrk',
@@ -1529,7 +1951,7 @@ class TestShellUnit(unittest.TestCase):
 
         # In folder only selects the right tracks
         mock_get_tracks.return_value = {'trk1': 'Green',
-                                        'trk2': 'Red'}
+                                        'trk2': 'Red'}.items()
         mock_put.reset_mock()
         self._run('--verbose track colorize --from-gpx-file foo.gpx '
                   '--in-folder folder2')
@@ -1537,7 +1959,7 @@ class TestShellUnit(unittest.TestCase):
                                                    'color': '#F90553'})
 
         # No tracks in gpx data
-        mock_get_tracks.return_value = {}
+        mock_get_tracks.return_value = {}.items()
         mock_put.reset_mock()
         out = self._run('--verbose track colorize --from-gpx-file foo.gpx',
                         expect_fail=True)
@@ -1545,13 +1967,37 @@ class TestShellUnit(unittest.TestCase):
         mock_put.assert_not_called()
 
         # Tracks in gpx, but no matching
-        mock_get_tracks.return_value = {'notrk': 'foo'}
+        mock_get_tracks.return_value = {'notrk': 'foo'}.items()
         mock_put.reset_mock()
         out = self._run('--verbose track colorize --from-gpx-file foo.gpx',
                         expect_fail=True)
         self.assertIn('No matching objects', out)
         mock_put.assert_not_called()
 
+    @mock.patch('gaiagps.util.iter_track_colors_from_gpx')
+    @mock.patch.object(FakeClient, 'put_object')
+    def test_colorize_track_from_gpx_duplicates(self, mock_put,
+                                                mock_get_tracks):
+        tracks = copy.deepcopy(FakeClient.TRACKS)
+        tracks.append(dict(tracks[1], id='203'))
+
+        # A name used by more than one track is not guessed at
+        mock_get_tracks.return_value = [('trk1', 'Red'), ('trk2', 'Green')]
+        with mock.patch.object(FakeClient, 'TRACKS', tracks):
+            out = self._run('track colorize --from-gpx-file foo.gpx',
+                            expect_fail=True)
+        self.assertIn('Multiple tracks named \'trk2\' found', out)
+        mock_put.assert_called_once_with('track', {'id': '201',
+                                                   'color': '#F90553'})
+
+        # A name that appears twice in the file is only colored once
+        mock_put.reset_mock()
+        mock_get_tracks.return_value = [('trk1', 'Red'), ('trk1', 'Green')]
+        out = self._run('--verbose track colorize --from-gpx-file foo.gpx')
+        self.assertIn('more than once', out)
+        mock_put.assert_called_once_with('track', {'id': '201',
+                                                   'color': '#F90553'})
+
     @mock.patch('gaiagps.util.date_parse')
     @mock.patch('os.utime')
     @mock.patch('builtins.open')
@@ -1590,6 +2036,169 @@ class TestShellUnit(unittest.TestCase):
         out = self._run('--verbose photo export --match',
                         expect_fail=True)
 
+    @mock.patch('os.utime')
+    def test_photo_export_parallel(self, mock_utime):
+        real_get_photo = FakeClient.get_photo
+        calls = []
+
+        def fake_get_photo(client, photoid, **kwargs):
+            calls.append((photoid, kwargs['photo']['id']))
+            if photoid == '302':
+                raise RuntimeError('Server did not return image')
+            return real_get_photo(client, photoid, **kwargs)
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.object(FakeClient, 'get_photo', fake_get_photo):
+                os.chdir(tmpdir)
+                try:
+                    out = self._run('--verbose photo export --jobs 2 '
+                                    'pho1 pho2', expect_fail=True)
+                finally:
+                    os.chdir(cwd)
+                with open(os.path.join(tmpdir, 'pho1.jpg'), 'rb') as f:
+                    self.assertEqual(b'photodataforpho1', f.read())
+
+        self.assertEqual([('301', '301'), ('302', '302')], sorted(calls))
+        self.assertIn('Wrote \'pho1.jpg\'', out)
+        self.assertIn('Failed to download \'pho2\': Server did not', out)
+
+    def test_photo_export_sync(self):
+        real_get_photo = FakeClient.get_photo
+        calls = []
+
+        def fake_get_photo(client, photoid, **kwargs):
+            calls.append((photoid, kwargs['size']))
+            return real_get_photo(client, photoid, **kwargs)
+
+        photos = copy.deepcopy(FakeClient.PHOTOS)
+        photos[0]['revision'] = 1
+        photos[1]['revision'] = 1
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(FakeClient, 'get_photo', fake_get_photo), \
+                mock.patch.object(FakeClient, 'PHOTOS', photos):
+            out = self._run('photo export --sync %s' % tmpdir)
+            self.assertIn('Downloaded 2, linked 0 duplicates, 0 up to date',
+                          out)
+            self.assertEqual([('301', 'fullsize'), ('302', 'fullsize')],
+                             sorted(calls))
+            with open(os.path.join(tmpdir, 'pho1.jpg'), 'rb') as f:
+                self.assertEqual(b'photodataforpho1', f.read())
+            with open(os.path.join(tmpdir, '.gaiagps-manifest.json')) as f:
+                manifest = json.load(f)
+            self.assertEqual({'301/fullsize', '302/fullsize'},
+                             set(manifest['photos']))
+            entry = manifest['photos']['301/fullsize']
+            self.assertEqual('pho1.jpg', entry['filename'])
+            self.assertEqual(1, entry['revision'])
+            self.assertEqual(16, entry['size'])
+
+            # Nothing changed, so nothing is downloaded
+            del calls[:]
+            out = self._run('photo export --sync %s' % tmpdir)
+            self.assertIn('Downloaded 0, linked 0 duplicates, 2 up to date',
+                          out)
+            self.assertEqual([], calls)
+
+            # A new revision is downloaded again, and a missing file is
+            # restored
+            photos[0]['revision'] = 2
+            os.remove(os.path.join(tmpdir, 'pho2.jpg'))
+            out = self._run('photo export --sync %s' % tmpdir)
+            self.assertIn('Downloaded 2, linked 0 duplicates, 0 up to date',
+                          out)
+            self.assertEqual(['.gaiagps-manifest.json', 'pho1.jpg',
+                              'pho2.jpg'], sorted(os.listdir(tmpdir)))
+
+    def test_photo_export_sync_no_revision(self):
+        contents = {'301': b'first', '302': b'second'}
+        calls = []
+
+        def fake_get_photo(client, photoid, size='fullsize', photo=None,
+                           dest=None):
+            calls.append(photoid)
+            dest.write(contents[photoid])
+            return 'image/jpeg', len(contents[photoid])
+
+        photos = copy.deepcopy(FakeClient.PHOTOS)
+        photos[0]['updated_date'] = '2019-05-26T21:02:34Z'
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(FakeClient, 'get_photo', fake_get_photo), \
+                mock.patch.object(FakeClient, 'PHOTOS', photos):
+            self._run('photo export --sync %s' % tmpdir)
+
+            # Without a revision, pho2 has to be fetched to see if it has
+            # changed, but pho1 can go by when it was last updated
+            del calls[:]
+            out = self._run('photo export --sync %s' % tmpdir)
+            self.assertIn('Downloaded 0, linked 0 duplicates, 2 up to date',
+                          out)
+            self.assertEqual(['302'], calls)
+
+            del calls[:]
+            contents = {'301': b'third', '302': b'fourth'}
+            photos[0]['updated_date'] = '2019-05-27T21:02:34Z'
+            out = self._run('photo export --sync %s' % tmpdir)
+            self.assertIn('Downloaded 2, linked 0 duplicates, 0 up to date',
+                          out)
+            with open(os.path.join(tmpdir, 'pho2.jpg'), 'rb') as f:
+                self.assertEqual(b'fourth', f.read())
+
+            # A file changed locally is fetched again
+            del calls[:]
+            with open(os.path.join(tmpdir, 'pho1.jpg'), 'wb') as f:
+                f.write(b'edited')
+            out = self._run('photo export --sync %s' % tmpdir)
+            self.assertIn('Downloaded 1, linked 0 duplicates, 1 up to date',
+                          out)
+            self.assertEqual(['301', '302'], sorted(calls))
+            with open(os.path.join(tmpdir, 'pho1.jpg'), 'rb') as f:
+                self.assertEqual(b'third', f.read())
+
+    def test_photo_export_sync_dedup(self):
+        def fake_get_photo(client, photoid, size='fullsize', photo=None,
+                           dest=None):
+            dest.write(b'samephoto')
+            return 'image/jpeg', 9
+
+        photos = [dict(p, title='same') for p in FakeClient.PHOTOS]
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(FakeClient, 'get_photo', fake_get_photo), \
+                mock.patch.object(FakeClient, 'PHOTOS', photos):
+            out = self._run('photo export --sync %s' % tmpdir)
+            self.assertIn('Downloaded 1, linked 1 duplicates', out)
+            first = os.path.join(tmpdir, 'same.jpg')
+            second = os.path.join(tmpdir, 'same-302.jpg')
+            self.assertTrue(os.path.samefile(first, second))
+
+    def test_photo_export_sync_replace_dedup(self):
+        contents = {'301': b'first', '302': b'second'}
+
+        def fake_get_photo(client, photoid, size='fullsize', photo=None,
+                           dest=None):
+            dest.write(contents[photoid])
+            return 'image/jpeg', len(contents[photoid])
+
+        photos = copy.deepcopy(FakeClient.PHOTOS)
+        photos[0]['revision'] = 1
+        photos[1]['revision'] = 1
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(FakeClient, 'get_photo', fake_get_photo), \
+                mock.patch.object(FakeClient, 'PHOTOS', photos):
+            self._run('photo export --sync %s' % tmpdir)
+
+            # pho1 changes, and pho2 now has what pho1 used to, which must
+            # not be linked to pho1's (replaced) file
+            contents = {'301': b'third', '302': b'first'}
+            photos[0]['revision'] = 2
+            photos[1]['revision'] = 2
+            out = self._run('photo export --sync %s' % tmpdir)
+            self.assertIn('Downloaded 2, linked 0 duplicates', out)
+            with open(os.path.join(tmpdir, 'pho1.jpg'), 'rb') as f:
+                self.assertEqual(b'third', f.read())
+            with open(os.path.join(tmpdir, 'pho2.jpg'), 'rb') as f:
+                self.assertEqual(b'first', f.read())
+
     def test_folder_access(self):
         self._run('folder access folder1',
                   expect_fail=True)
@@ -4,12 +4,22 @@ import io
 import mock
 import os
 import pytz
+import tempfile
+import time
+import tracemalloc
 import unittest
+from xml.etree import ElementTree as ET
 
 from gaiagps import util
 
 
 class TestUtilUnit(unittest.TestCase):
+    def setUp(self):
+        # The local zone is cached, so make sure tests that mock it see
+        # their own (and do not leak it)
+        util._local_zone.cache_clear()
+        self.addCleanup(util._local_zone.cache_clear)
+
     @mock.patch('tzlocal.get_localzone')
     def test_date_parse(self, mock_get_localzone):
         hill_valley = pytz.timezone('America/Los_Angeles')
@@ -19,7 +29,9 @@ class TestUtilUnit(unittest.TestCase):
             datetime.datetime(2015, 10, 21, 16, 29))
         formats = ['2015-10-21T23:29:00Z',
                    '2015-10-21T23:29:00.00',
-                   '2015-10-21T23:29:00']
+                   '2015-10-21T23:29:00',
+                   '2015-10-21T23:29:00.000Z',
+                   '2015-10-21T23:29:00+00:00']
         for i in formats:
             self.assertEqual(expected,
                              util.date_parse({'time_created': i}))
@@ -27,6 +39,41 @@ class TestUtilUnit(unittest.TestCase):
                              util.date_parse({'properties': {
                                  'time_created': i}}))
 
+        self.assertIsNone(util.date_parse({'time_created': ''}))
+        self.assertIsNone(util.date_parse({'title': 'foo'}))
+        self.assertRaises(ValueError,
+                          util.date_parse, {'time_created': 'yesterday'})
+
+        # The local zone is only looked up once
+        mock_get_localzone.assert_called_once_with()
+
+    @mock.patch('tzlocal.get_localzone')
+    def test_date_index(self, mock_get_localzone):
+        mock_get_localzone.return_value = pytz.utc
+        things = [
+            {'id': '1', 'time_created': '2019-01-02T00:00:00Z'},
+            {'id': '2', 'time_created': '2015-10-21T23:29:00Z'},
+            {'id': '3'},
+            {'id': '4', 'properties': {
+                'time_created': '2019-01-01T00:00:00.5'}},
+            {'id': '5', 'time_created': '2019-01-03T00:00:00Z'},
+        ]
+        index = util.DateIndex(things)
+        self.assertEqual(4, len(index))
+
+        def between(start, end):
+            return [t['id'] for t in index.between(start, end)]
+
+        self.assertEqual(['4', '1'],
+                         between(datetime.datetime(2019, 1, 1),
+                                 datetime.datetime(2019, 1, 2)))
+        self.assertEqual(['2', '4', '1', '5'],
+                         between(datetime.datetime(2000, 1, 1),
+                                 datetime.datetime(2020, 1, 1)))
+        self.assertEqual([],
+                         between(datetime.datetime(2016, 1, 1),
+                                 datetime.datetime(2017, 1, 1)))
+
     @mock.patch('tzlocal.get_localzone')
     def test_datefmt(self, mock_get_localzone):
         hill_valley = pytz.timezone('America/Los_Angeles')
@@ -42,6 +89,31 @@ class TestUtilUnit(unittest.TestCase):
             self.assertEqual(expected,
                              util.datefmt({'properties': {'time_created': i}}))
 
+    def test_parallel_map(self):
+        def slow_double(i):
+            # Make early items finish last to exercise ordering
+            time.sleep(0.001 * (10 - i))
+            return i * 2
+
+        self.assertEqual([i * 2 for i in range(10)],
+                         list(util.parallel_map(slow_double, range(10),
+                                                concurrency=4)))
+
+    def test_parallel_map_errors(self):
+        def fail_odd(i):
+            if i % 2:
+                raise ValueError(i)
+            return i
+
+        results = list(util.parallel_map(fail_odd, range(4),
+                                         return_exceptions=True))
+        self.assertEqual([0, 2], results[0::2])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[3], ValueError)
+
+        results = util.parallel_map(fail_odd, range(4))
+        self.assertRaises(ValueError, list, results)
+
     def test_title_sort(self):
         self.assertEqual([{'title': 'abc'}, {'title': 'def'}],
                          util.title_sort([
@@ -136,6 +208,30 @@ class TestUtilUnit(unittest.TestCase):
 
         return tree
 
+    def test_make_tree_contents(self):
+        folders = self._test_folders()
+        for folder in folders:
+            folder.update(folder.pop('properties'))
+        waypoints = [{'id': '100', 'folder': '1'},
+                     {'id': '101', 'folder': '1'},
+                     {'id': '102', 'folder': '2'},
+                     {'id': '103', 'folder': ''}]
+        tracks = [{'id': '200', 'folder': '1'},
+                  {'id': '202', 'folder': '4'}]
+        tree = util.make_tree(folders, waypoints=waypoints, tracks=tracks)
+
+        self.assertEqual([waypoints[3]], tree['properties']['waypoints'])
+        self.assertEqual([], tree['properties']['tracks'])
+
+        root1 = tree['subfolders']['1']
+        self.assertEqual(waypoints[:2], root1['properties']['waypoints'])
+        # Ids missing from the listing are skipped
+        self.assertEqual(tracks[:1], root1['properties']['tracks'])
+
+        subsub = tree['subfolders']['3']['subfolders']['2']['subfolders']['4']
+        self.assertEqual([], subsub['properties']['waypoints'])
+        self.assertEqual(tracks[1:], subsub['properties']['tracks'])
+
     def _test_resolve_tree(self):
         folders = self._test_folders()
         full_folders = {i['id']: copy.deepcopy(i) for i in folders}
@@ -153,6 +249,7 @@ class TestUtilUnit(unittest.TestCase):
                 for i in folder['properties']['tracks']]
 
         fake_client = mock.MagicMock()
+        fake_client.concurrency = 2
         fake_client.get_object.side_effect = lambda t, id_: full_folders[id_]
         fake_client.list_objects.return_value = [{'title': 'testdata',
                                                   'properties': {},
@@ -173,16 +270,61 @@ class TestUtilUnit(unittest.TestCase):
             [{'id': '202', 'title': 'track_202', 'properties': {}}],
             subsub['properties']['tracks'])
 
+    def test_iter_resolve_tree(self):
+        folders = self._test_folders()
+        fetched = []
+
+        def fake_get(objtype, id_):
+            fetched.append(id_)
+            return {'id': id_, 'properties': {'name': 'full_%s' % id_}}
+
+        fake_client = mock.MagicMock()
+        fake_client.get_object.side_effect = fake_get
+        fake_client.list_objects.side_effect = lambda objtype: [
+            {'id': objtype, 'folder': ''},
+            {'id': 'other', 'folder': '1'}]
+
+        tree = util.make_tree(folders)
+        subtrees = util.iter_resolve_tree(fake_client, tree, concurrency=4)
+
+        # The first subtree is generated with everything below it resolved,
+        # and the root contents are already in place
+        root1 = next(subtrees)
+        self.assertEqual('full_1', root1['properties']['name'])
+        self.assertEqual([{'id': 'waypoint', 'folder': ''}],
+                         tree['properties']['waypoints'])
+        self.assertEqual([{'id': 'track', 'folder': ''}],
+                         tree['properties']['tracks'])
+
+        root2 = next(subtrees)
+        self.assertEqual('full_3', root2['properties']['name'])
+        subsub = root2['subfolders']['2']['subfolders']['4']
+        self.assertEqual('full_4', subsub['properties']['name'])
+        self.assertRaises(StopIteration, next, subtrees)
+
+        # Each folder was fetched once, parents before children
+        self.assertEqual(['1', '2', '3', '4'], sorted(fetched))
+        self.assertLess(fetched.index('2'), fetched.index('4'))
+        fake_client.get_objects.assert_not_called()
+
+    def test_iter_resolve_tree_folder(self):
+        fake_client = mock.MagicMock()
+        fake_client.get_object.side_effect = lambda t, id_: {
+            'id': id_, 'properties': {'name': id_}}
+        folder = {'id': 'top', 'subfolders': {
+            'a': {'id': 'a', 'name': 'a'}}}
+        subtrees = list(util.iter_resolve_tree(fake_client, folder,
+                                               concurrency=1))
+        self.assertEqual('top', folder['properties']['name'])
+        self.assertEqual(['a'], [s['id'] for s in subtrees])
+        fake_client.list_objects.assert_not_called()
+
     def test_pprint_folder(self):
         resolved = self._test_resolve_tree()
-        with mock.patch('builtins.print') as mock_print:
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
             util.pprint_folder(resolved)
 
-        lines = []
-        for call in mock_print.call_args_list:
-            lines.append(call[0][0] if call[0] else '')
-
-        output = ''.join(lines)
+        output = out.getvalue()
 
         # Check some things at the root and at the leaves for proper
         # nesting
@@ -191,6 +333,64 @@ class TestUtilUnit(unittest.TestCase):
         self.assertIn('subsub/', output)
         self.assertIn('[T] track_202', output)
 
+    def test_iter_folder_lines(self):
+        resolved = self._test_resolve_tree()
+        mid = '\u251c\u2500\u2500'
+        last = '\u2514\u2500\u2500'
+        self.assertEqual([
+            '/',
+            '%s root1/' % mid,
+            '    %s [W] waypoint_100' % mid,
+            '    %s [W] waypoint_101' % mid,
+            '    %s [T] track_200' % mid,
+            '    %s [T] track_201' % last,
+            '%s root2/' % mid,
+            '    %s subfolder/' % mid,
+            '        %s subsub/' % mid,
+            '            %s [T] track_202' % last,
+            '        %s [W] waypoint_102' % last,
+            '%s [W] testdata' % mid,
+            '%s [T] testdata' % last,
+        ], list(util.iter_folder_lines(resolved)))
+
+    def test_iter_folder_lines_deep(self):
+        # Deeper than the recursion limit
+        root = folder = {'properties': {'name': '/', 'waypoints': [],
+                                        'tracks': []}}
+        for i in range(2000):
+            sub = {'properties': {'name': 'f%i' % i, 'waypoints': [],
+                                  'tracks': [{'title': 't%i' % i}]}}
+            folder['subfolders'] = {i: sub}
+            folder = sub
+
+        lines = list(util.iter_folder_lines(root))
+        self.assertEqual(4001, len(lines))
+        self.assertEqual(' ' * 7996 + '\u251c\u2500\u2500 f1999/',
+                         lines[2000])
+        self.assertEqual(' ' * 8000 + '\u2514\u2500\u2500 [T] t1999',
+                         lines[2001])
+        self.assertEqual('    \u2514\u2500\u2500 [T] t0', lines[-1])
+
+    def test_pprint_folder_streams(self):
+        resolved = self._test_resolve_tree()
+        out = io.StringIO()
+        seen = []
+
+        def subfolders():
+            for subf in util.name_sort(resolved['subfolders'].values()):
+                seen.append(out.getvalue())
+                yield subf
+
+        util.pprint_folder(resolved, subfolders=subfolders(), file=out)
+
+        # Everything printed so far is written out before waiting for
+        # each subfolder
+        self.assertEqual('/\n', seen[0])
+        self.assertIn('track_201', seen[1])
+        self.assertNotIn('root2/', seen[1])
+        self.assertEqual(out.getvalue(),
+                         '\n'.join(util.iter_folder_lines(resolved)) + '\n')
+
     @mock.patch('os.environ')
     @mock.patch('os.access')
     def test_get_editor(self, mock_access, mock_environ):
@@ -222,6 +422,58 @@ class TestUtilUnit(unittest.TestCase):
         self.assertIn('<wpt', output.getvalue())
         self.assertNotIn('<extensions>', output.getvalue())
 
+    def test_strip_gpx_extensions_streaming(self):
+        gpx = GPX_WITH_EXTENSIONS.replace(
+            '<time>2018-07-11T15:25:05Z</time>',
+            '<time>2018-07-11T15:25:05Z</time>'
+            '<extensions><gpxtpx:TrackPointExtension><gpxtpx:hr>97'
+            '</gpxtpx:hr></gpxtpx:TrackPointExtension></extensions>').replace(
+            '<name>gaiagpsclient test data test track</name>',
+            '<name xml:lang="en">Fish &amp; &lt;Chips&gt; \u00e9</name>')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'in.gpx')
+            dest = os.path.join(tmpdir, 'out.gpx')
+            with open(source, 'w', encoding='utf-8') as f:
+                f.write(gpx)
+            # Use a tiny buffer to make sure elements split across reads
+            # are handled
+            with mock.patch.object(util, 'GPX_CHUNK_SIZE', 7):
+                colors = util.strip_gpx_extensions(source, dest)
+            root = ET.parse(dest).getroot()
+            with open(dest, encoding='utf-8') as f:
+                output = f.read()
+
+        ns = {'gpx': util.GPX_NS}
+        self.assertEqual([], root.findall('.//gpx:extensions', ns))
+        self.assertEqual(
+            'http://www.topografix.com/GPX/1/1 '
+            'http://www.topografix.com/GPX/1/1/gpx.xsd',
+            root.attrib['{%s}schemaLocation' % util.XSI_NS])
+        self.assertEqual(2, len(root.findall('.//gpx:trkpt', ns)))
+        self.assertEqual(['2018-07-11T15:25:05Z', '2018-07-11T15:35:15Z'],
+                         [t.text for t in root.findall('.//gpx:trkpt/gpx:time',
+                                                       ns)])
+        name = root.find('gpx:trk/gpx:name', ns)
+        self.assertEqual('Fish & <Chips> \u00e9', name.text)
+        self.assertEqual('en', name.attrib['{%s}lang' % util.XML_NS])
+        self.assertEqual('1621.01171875',
+                         root.find('gpx:wpt/gpx:ele', ns).text)
+        self.assertNotIn('xmlschemas', output)
+        # The colors are collected on the way through
+        self.assertEqual({'Fish & <Chips> \u00e9': 'Red'}, colors)
+        self.assertIn('    <type>user</type>\n  </wpt>', output)
+
+    def test_strip_gpx_extensions_truncated(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'in.gpx')
+            dest = os.path.join(tmpdir, 'out.gpx')
+            with open(source, 'w') as f:
+                f.write(GPX_WITH_EXTENSIONS[:2000])
+            self.assertRaises(Exception, util.strip_gpx_extensions,
+                              source, dest)
+            # No partial output is left behind
+            self.assertFalse(os.path.exists(dest))
+
     @mock.patch('builtins.open')
     def test_strip_gpx_extensions_errors(self, mock_open):
         input = io.BytesIO(b'foo')
@@ -269,6 +521,28 @@ class TestUtilUnit(unittest.TestCase):
         mock_open.return_value = input
         self.assertEqual({}, util.get_track_colors_from_gpx('input-file'))
 
+    def test_iter_track_colors_from_gpx(self):
+        # Two tracks, the second of which is cut off partway through, so
+        # only the first can ever be generated
+        trk = GPX_WITH_EXTENSIONS[GPX_WITH_EXTENSIONS.index('<trk>'):
+                                  GPX_WITH_EXTENSIONS.index('</gpx>')]
+        gpx = GPX_WITH_EXTENSIONS.replace(
+            trk, trk + trk.replace('test track', 'other').replace(
+                'Red', 'Blue'))
+        gpx = gpx[:gpx.rindex('<trkpt')]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'in.gpx')
+            with open(source, 'w') as f:
+                f.write(gpx)
+            with mock.patch.object(util, 'GPX_CHUNK_SIZE', 64):
+                tracks = util.iter_track_colors_from_gpx(source)
+                # The first track is available before the rest of the
+                # file has been read
+                self.assertEqual(
+                    ('gaiagpsclient test data test track', 'Red'),
+                    next(tracks))
+                self.assertRaises(Exception, next, tracks)
+
     def test_thingformatter_keys(self):
         self.assertEqual(
             sorted(['title', 'created', 'updated', 'id',
@@ -429,3 +703,51 @@ TEST_TRK = {'features': [{'geometry': {'coordinates': [[[-120.221565,
                           'type': 'Feature'}],
             'id': 'b0298a9a30b073b3493ca54e3a1417bb',
             'type': 'FeatureCollection'}
+
+
+def _write_big_gpx(f, points):
+    f.write(GPX_WITH_EXTENSIONS.split('<metadata>')[0])
+    f.write('<trk><name>big</name><trkseg>\n')
+    for i in range(points):
+        f.write('<trkpt lat="45.%06i" lon="-122.%06i"><ele>100.0</ele>'
+                '<time>2019-01-01T00:00:00Z</time><extensions>'
+                '<gpxtpx:TrackPointExtension><gpxtpx:hr>120</gpxtpx:hr>'
+                '</gpxtpx:TrackPointExtension></extensions></trkpt>\n' % (
+                    i, i))
+    f.write('</trkseg></trk>\n</gpx>\n')
+
+
+@unittest.skipUnless(os.environ.get('GAIAGPS_BENCHMARK'),
+                     'Set GAIAGPS_BENCHMARK=1 to run benchmarks')
+class TestGPXBenchmark(unittest.TestCase):
+    POINTS = int(os.environ.get('GAIAGPS_BENCHMARK_POINTS', 1000000))
+
+    def test_strip_gpx_extensions(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'in.gpx')
+            dest = os.path.join(tmpdir, 'out.gpx')
+            with open(source, 'w') as f:
+                _write_big_gpx(f, self.POINTS)
+
+            start = time.monotonic()
+            util.strip_gpx_extensions(source, dest)
+            elapsed = time.monotonic() - start
+
+            tracemalloc.start()
+            try:
+                util.strip_gpx_extensions(source, dest)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+            points = 0
+            with open(dest) as f:
+                for line in f:
+                    self.assertNotIn('<extensions>', line)
+                    points += line.count('<trkpt ')
+
+        print('Stripped %i points in %.1fs (%i/s), peak memory %.1fMiB' % (
+            points, elapsed, points / elapsed, peak / 1024 / 1024))
+        self.assertEqual(self.POINTS, points)
+        # Memory use should not depend on the size of the file
+        self.assertLess(peak, 8 * 1024 * 1024)
@@ -1,14 +1,22 @@
+import bisect
+import collections
+import concurrent.futures
 import datetime
 import functools
+import itertools
 import logging
 import os
 import pytz
 import string
+import sys
 import tzlocal
 from xml.etree import ElementTree as ET
 
 LOG = logging.getLogger(__name__)
 
+# The default number of API calls to run at once for bulk operations
+DEFAULT_CONCURRENCY = 8
+
 
 ICON_ALIASES = {
     'blue': 'blue-pin-down.png',
@@ -117,6 +125,52 @@ GPXX_COLORS_TO_GAIA = {
 }
 
 
+def parallel_map(fn, items, concurrency=DEFAULT_CONCURRENCY,
+                 return_exceptions=False):
+    """Call a function on each of a set of items using a pool of threads.
+
+    Results are generated in the same order as ``items``, each one as
+    soon as it (and everything before it) has finished. At most
+    ``concurrency`` calls are in flight at once, and only a small window
+    of results is held ahead of the consumer, so very long inputs can be
+    processed in bounded memory.
+
+    :param fn: A function that takes a single item
+    :type fn: callable
+    :param items: The items to process
+    :param concurrency: The maximum number of calls to run at once
+    :type concurrency: int
+    :param return_exceptions: If ``True``, an exception raised for an item
+                              is generated in place of its result. If
+                              ``False``, it is raised to the caller.
+    :type return_exceptions: bool
+    :returns: A generator of results in input order
+    """
+    concurrency = max(1, concurrency or 1)
+    items = iter(items)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency) as pool:
+        pending = collections.deque(
+            pool.submit(fn, item)
+            for item in itertools.islice(items, concurrency * 2))
+        try:
+            while pending:
+                future = pending.popleft()
+                # Keep the pool full while the consumer handles this one
+                for item in itertools.islice(items, 1):
+                    pending.append(pool.submit(fn, item))
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    result = e
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 def date_parse(thing, property_name='time_created'):
     """Parse a local datetime from a thing with a datestamp.
 
@@ -143,15 +197,100 @@ def date_parse(thing, property_name='time_created'):
     if not ds:
         return None
 
-    if 'Z' in ds:
-        dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%SZ')
-    elif '.' in ds:
-        dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%S.%f')
-    else:
-        dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%S')
+    return _parse_utc(ds).astimezone(_local_zone())
+
+
+@functools.lru_cache(maxsize=None)
+def _local_zone():
+    # Looking up the local zone is expensive, and it does not change
+    return tzlocal.get_localzone()
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_utc(ds):
+    # Parse a UTC datestamp from the API into an aware datetime
+    try:
+        dt = datetime.datetime.fromisoformat(ds.rstrip('Z'))
+    except ValueError:
+        # Older pythons are fussier about fractional seconds
+        if 'Z' in ds:
+            dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%SZ')
+        elif '.' in ds:
+            dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%S.%f')
+        else:
+            dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%S')
+
+    if dt.tzinfo is None:
+        return pytz.utc.localize(dt)
+    return dt.astimezone(pytz.utc)
+
+
+class DateIndex(object):
+    """A sorted index of objects by datestamp.
 
-    dt = pytz.utc.localize(dt)
-    return dt.astimezone(tzlocal.get_localzone())
+    This parses the datestamps of a whole listing once (see
+    :func:`date_parse`) so that the objects within a date range can be
+    found with a binary search instead of parsing each of them again for
+    every lookup. Objects without a datestamp are not indexed.
+
+    Dates are compared in local time, without time zone information,
+    which is how date ranges are given on the command line.
+
+    :param things: Raw objects from the API
+    :type things: list
+    :param property_name: The datestamp to index by
+    :type property_name: str
+    """
+
+    def __init__(self, things, property_name='time_created'):
+        dated = []
+        for thing in things:
+            dt = date_parse(thing, property_name=property_name)
+            if dt:
+                dated.append((dt.replace(tzinfo=None), thing))
+        dated.sort(key=lambda pair: pair[0])
+        self._dates = [dt for dt, thing in dated]
+        self._things = [thing for dt, thing in dated]
+
+    def __len__(self):
+        return len(self._things)
+
+    def between(self, start, end):
+        """Find objects dated within a range.
+
+        :param start: The start of the range (inclusive)
+        :type start: datetime.datetime
+        :param end: The end of the range (inclusive)
+        :type end: datetime.datetime
+        :returns: The objects in the range, in date order
+        :rtype: `list`
+        """
+        lo = bisect.bisect_left(self._dates, start)
+        hi = bisect.bisect_right(self._dates, end)
+        return self._things[lo:hi]
+
+
+def object_revision(thing):
+    """Find the revision of an object.
+
+    This works with object descriptions from
+    :func:`~gaiagps.apiclient.GaiaClient.list_objects` as well as full
+    objects (including tracks, which keep their properties in a feature).
+
+    :param thing: A raw object from the API
+    :type thing: dict
+    :returns: The revision, or ``None`` if the object does not have one
+    """
+    if 'revision' in thing:
+        return thing['revision']
+    try:
+        return thing['properties']['revision']
+    except (KeyError, TypeError):
+        pass
+    try:
+        return thing['features'][0]['properties']['revision']
+    except (KeyError, IndexError, TypeError):
+        return None
 
 
 def datefmt(thing, property_name='time_created'):
@@ -218,7 +357,7 @@ def make_folder(name):
     return {'title': name}
 
 
-def make_tree(folders):
+def make_tree(folders, waypoints=None, tracks=None):
     """Creates a hierarchical structure of folders.
 
     This takes a flat list of folder objects and returns
@@ -226,9 +365,22 @@ def make_tree(folders):
     ``subfolders`` key. A new root folder structure is at the
     top, with a name of ``/``.
 
+    If ``waypoints`` and ``tracks`` listings are provided, the
+    ``waypoints`` and ``tracks`` id lists of each folder summary are
+    joined against them to fill in the folder contents. The result can
+    then be passed to :func:`pprint_folder` without needing
+    :func:`resolve_tree` (and a request per folder), although the
+    contents are only the summaries from the listings.
+
     :param folders: A flat ``list`` of folders like you get from
                     :func:`~gaiagps.apiclient.GaiaClient.list_objects`
     :type folders: list
+    :param waypoints: A ``list`` of all waypoints like you get from
+                      :func:`~gaiagps.apiclient.GaiaClient.list_objects`
+    :type waypoints: list
+    :param tracks: A ``list`` of all tracks like you get from
+                   :func:`~gaiagps.apiclient.GaiaClient.list_objects`
+    :type tracks: list
     :returns: A hierarchical ``dict`` of folders
     :rtype: `dict`
     """
@@ -251,47 +403,155 @@ def make_tree(folders):
         parent.setdefault('subfolders', {})
         parent['subfolders'][folder['id']] = folder
 
+    if waypoints is not None and tracks is not None:
+        _join_tree_contents(root, folders, waypoints, tracks)
+
     return root
 
 
-def resolve_tree(client, folder):
+def _join_tree_contents(root, folders, waypoints, tracks):
+    # Fill in the contents of each folder (and the root) from the
+    # listings, by the ids in the folder summaries
+    waypoints_by_id = {w['id']: w for w in waypoints}
+    tracks_by_id = {t['id']: t for t in tracks}
+
+    for folder in folders:
+        props = dict(folder.get('properties') or {})
+        props.setdefault('name', folder.get('title'))
+        props['waypoints'] = [waypoints_by_id[i]
+                              for i in folder.get('waypoints', [])
+                              if i in waypoints_by_id]
+        props['tracks'] = [tracks_by_id[i]
+                           for i in folder.get('tracks', [])
+                           if i in tracks_by_id]
+        folder['properties'] = props
+
+    root['properties']['waypoints'] = [w for w in waypoints
+                                       if not w.get('folder')]
+    root['properties']['tracks'] = [t for t in tracks
+                                    if not t.get('folder')]
+
+
+def resolve_tree(client, folder, concurrency=None):
     """Walk the tree and flesh out folders with waypoint/track data.
 
     This takes a hierarchical folder tree from :func:`make_tree` and
     replaces the folder descriptions with full definitions, as you
     would get from :func:`~gaiagps.apiclient.GaiaClient.get_object`.
+    See :func:`iter_resolve_tree` for details.
 
     :param client: An instance of :class:`~gaiagps.apiclient.GaiaClient`
     :type client: GaiaClient
     :param folder: A root folder of a hierarchical tree from
                    :func:`make_tree`
     :type folder: dict
+    :param concurrency: The maximum number of requests to run at once
+                        (defaults to the client's ``concurrency``)
+    :type concurrency: int
     :returns: A hierarchical tree of full folder definitions.
     :rtype: `dict`
     """
+    for subfolder in iter_resolve_tree(client, folder,
+                                       concurrency=concurrency):
+        pass
+    return folder
 
-    if 'id' in folder:
-        LOG.debug('Resolving %s' % folder['id'])
-        updated = client.get_object('folder', id_=folder['id'])
-        subf = folder.get('subfolders', {})
-        folder.clear()
-        folder.update(updated)
-        folder['subfolders'] = subf
-    else:
-        # This is the fake root folder
-        LOG.debug('Resolving root folder (by force)')
-        folder['properties']['waypoints'] = [
-            w for w in client.list_objects('waypoint')
-            if w['folder'] == '']
-        folder['properties']['tracks'] = [
-            t for t in client.list_objects('track')
-            if t['folder'] == '']
-
-    for subfolder in folder.get('subfolders', {}).values():
-        LOG.debug('Descending into %s' % subfolder['id'])
-        resolve_tree(client, subfolder)
 
-    return folder
+def iter_resolve_tree(client, folder, concurrency=None):
+    """Resolve a tree, generating subtrees as they are finished.
+
+    This does the same thing as :func:`resolve_tree`, but walks the tree
+    breadth-first with up to ``concurrency`` folder fetches in flight at
+    once. The waypoints and tracks of the fake root folder are listed
+    concurrently with the rest of the work.
+
+    The top-level subfolders of ``folder`` are generated in name order,
+    each one as soon as it (and everything below it) has been resolved,
+    so that a caller can start displaying the tree before all of it has
+    been fetched. The contents of ``folder`` itself are resolved before
+    the first subfolder is generated.
+
+    :param client: An instance of :class:`~gaiagps.apiclient.GaiaClient`
+    :type client: GaiaClient
+    :param folder: A root folder of a hierarchical tree from
+                   :func:`make_tree`
+    :type folder: dict
+    :param concurrency: The maximum number of requests to run at once
+                        (defaults to the client's ``concurrency``)
+    :type concurrency: int
+    :returns: A generator of resolved top-level subfolders
+    """
+    concurrency = max(1, concurrency or getattr(client, 'concurrency',
+                                                DEFAULT_CONCURRENCY))
+    tops = name_sort(folder.get('subfolders', {}).values())
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency) as pool:
+        if 'id' in folder:
+            LOG.debug('Resolving %s' % folder['id'])
+            root_futures = [pool.submit(client.get_object, 'folder',
+                                        id_=folder['id'])]
+        else:
+            # This is the fake root folder
+            LOG.debug('Resolving root folder (by force)')
+            root_futures = [pool.submit(client.list_objects, objtype)
+                            for objtype in ('waypoint', 'track')]
+
+        # Map of in-flight fetches to the folder and the index of the
+        # top-level subtree they belong to, and the number of folders
+        # left to resolve in each subtree
+        pending = {}
+        remaining = [0] * len(tops)
+
+        def fetch(subfolder, top):
+            LOG.debug('Descending into %s' % subfolder['id'])
+            future = pool.submit(client.get_object, 'folder',
+                                 id_=subfolder['id'])
+            pending[future] = (subfolder, top)
+            remaining[top] += 1
+
+        try:
+            for top, subfolder in enumerate(tops):
+                fetch(subfolder, top)
+
+            if 'id' in folder:
+                _update_folder(folder, root_futures[0].result())
+            else:
+                waypoints, tracks = [f.result() for f in root_futures]
+                folder['properties']['waypoints'] = [
+                    w for w in waypoints if w['folder'] == '']
+                folder['properties']['tracks'] = [
+                    t for t in tracks if t['folder'] == '']
+
+            next_top = 0
+            while next_top < len(tops):
+                while remaining[next_top]:
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        subfolder, top = pending.pop(future)
+                        _update_folder(subfolder, future.result())
+                        remaining[top] -= 1
+                        for child in subfolder['subfolders'].values():
+                            fetch(child, top)
+
+                # Generate everything that is finished, in order
+                while next_top < len(tops) and not remaining[next_top]:
+                    yield tops[next_top]
+                    next_top += 1
+        finally:
+            for future in list(pending) + root_futures:
+                future.cancel()
+
+
+def _update_folder(folder, updated):
+    # Replace a folder description with the full definition, in place,
+    # keeping the subfolders we have already attached to it
+    subf = folder.get('subfolders', {})
+    folder.clear()
+    folder.update(updated)
+    folder['subfolders'] = subf
 
 
 def title_sort(iterable):
@@ -312,16 +572,23 @@ def name_sort(iterable):
     return sorted(iterable, key=lambda e: e.get('name', ''))
 
 
-def pprint_folder(folder, indent=0, long=False):
-    """Print a tree of folder contents.
+def iter_folder_lines(folder, indent=0, long=False, subfolders=None):
+    """Generate the lines of a tree of folder contents.
 
-    This prints a pseudo-filesystem view of a folder tree to the
-    console.
+    This generates the pseudo-filesystem view of a folder tree printed by
+    :func:`pprint_folder`, one line (without a newline) at a time. The
+    tree is walked iteratively, so arbitrarily deep trees can be
+    rendered, and each line is generated as soon as it is known.
 
     :param folder: A folder tree root from :func:`resolve_tree`
     :type folder: dict
     :param indent: Number of spaces to indent the first level
     :type indent: int
+    :param long: Include dates in the output
+    :type long: bool
+    :param subfolders: The top-level subfolders to render, in order, if not
+                       all of those in ``folder``
+    :returns: A generator of lines
     """
     midchild = b'\xe2\x94\x9c\xe2\x94\x80\xe2\x94\x80'.decode()
     lastchild = b'\xe2\x94\x94\xe2\x94\x80\xe2\x94\x80'.decode()
@@ -334,27 +601,92 @@ def pprint_folder(folder, indent=0, long=False):
                       thing.get('properties')['name'])
         return ' '.join(fields)
 
+    def sorted_subfolders(folder):
+        return iter(name_sort(folder.get('subfolders', {}).values()))
+
     if indent == 0:
-        print('/')
-
-    pfx = (' ' * indent) + midchild
-    for subf in name_sort(folder.get('subfolders', {}).values()):
-        print('%s %s/' % (pfx, format_thing(subf)))
-        pprint_folder(subf, indent=indent + 4, long=long)
-
-    children = (
-        [('W', w) for w in title_sort(
-            folder['properties']['waypoints'])] +
-        [('T', t) for t in title_sort(
-            folder['properties']['tracks'])])
-
-    while children:
-        char, child = children.pop(0)
-        if children:
-            pfx = (' ' * indent) + midchild
-        else:
-            pfx = (' ' * indent) + lastchild
-        print('%s [%s] %s' % (pfx, char, format_thing(child)))
+        yield '/'
+
+    if subfolders is None:
+        subfolders = sorted_subfolders(folder)
+
+    # Each entry is a folder whose subfolders are being rendered, along
+    # with its indent and an iterator of the subfolders left to do
+    stack = [(folder, indent, iter(subfolders))]
+    while stack:
+        folder, indent, remaining = stack[-1]
+        subf = next(remaining, None)
+        if subf is not None:
+            yield '%s%s %s/' % (' ' * indent, midchild, format_thing(subf))
+            stack.append((subf, indent + 4, sorted_subfolders(subf)))
+            continue
+
+        # All the subfolders are done, so finish with our own contents
+        stack.pop()
+        children = (
+            [('W', w) for w in title_sort(
+                folder['properties']['waypoints'])] +
+            [('T', t) for t in title_sort(
+                folder['properties']['tracks'])])
+        last = len(children) - 1
+        for i, (char, child) in enumerate(children):
+            yield '%s%s [%s] %s' % (' ' * indent,
+                                    lastchild if i == last else midchild,
+                                    char, format_thing(child))
+
+
+def pprint_folder(folder, indent=0, long=False, subfolders=None,
+                  file=None):
+    """Print a tree of folder contents.
+
+    This prints a pseudo-filesystem view of a folder tree to the
+    console. Output is written in batches of lines, as generated by
+    :func:`iter_folder_lines`.
+
+    :param folder: A folder tree root from :func:`resolve_tree`
+    :type folder: dict
+    :param indent: Number of spaces to indent the first level
+    :type indent: int
+    :param long: Include dates in the output
+    :type long: bool
+    :param subfolders: The top-level subfolders to print, in order, if not
+                       all of those in ``folder``. This may be a generator
+                       from :func:`iter_resolve_tree`, in which case each
+                       subtree is printed as soon as it is resolved.
+    :param file: The stream to write to (defaults to ``sys.stdout``)
+    """
+    if file is None:
+        file = sys.stdout
+
+    batch = []
+
+    def write():
+        if batch:
+            batch.append('')
+            file.write('\n'.join(batch))
+            batch.clear()
+            file.flush()
+
+    def write_before_each(iterable):
+        # Write out what we have before waiting for each subfolder, so
+        # that slowly-generated subtrees are displayed as they arrive
+        iterator = iter(iterable)
+        while True:
+            write()
+            try:
+                yield next(iterator)
+            except StopIteration:
+                return
+
+    if subfolders is not None:
+        subfolders = write_before_each(subfolders)
+
+    for line in iter_folder_lines(folder, indent=indent, long=long,
+                                  subfolders=subfolders):
+        batch.append(line)
+        if len(batch) >= 256:
+            write()
+    write()
 
 
 def validate_lat(lat):
@@ -447,85 +779,334 @@ def get_editor():
         return editor
 
 
+GPX_NS = 'http://www.topografix.com/GPX/1/1'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+GPXX_NS = 'http://www.garmin.com/xmlschemas/GpxExtensions/v3'
+
+# The size of the pieces GPX files are read in
+GPX_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_gpx(source):
+    """Generate parse events from a GPX file as it is read.
+
+    This yields ``(event, item)`` tuples for ``start-ns``, ``start`` and
+    ``end`` events, like :func:`xml.etree.ElementTree.iterparse`. Nothing
+    is generated until the root element has been checked, so the first
+    ``next()`` raises if the input is not a GPX file at all. Callers are
+    expected to remove elements from the tree once they are done with
+    them.
+
+    :param source: A file open for binary reading
+    :raises Exception: If the source file is not a GPX file
+    """
+    parser = ET.XMLPullParser(events=('start-ns', 'start', 'end'))
+    pending = []
+    try:
+        while True:
+            chunk = source.read(GPX_CHUNK_SIZE)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+            for event, item in parser.read_events():
+                if pending is None:
+                    yield event, item
+                    continue
+                pending.append((event, item))
+                if event == 'start':
+                    if item.tag != '{%s}gpx' % GPX_NS:
+                        raise Exception('Input is not a GPX file')
+                    yield from pending
+                    pending = None
+            if not chunk:
+                break
+    except ET.ParseError:
+        raise Exception('Input is not a GPX file')
+
+
+def _escape_text(text):
+    if not text:
+        return ''
+    if '&' in text or '<' in text or '>' in text:
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace(
+            '>', '&gt;')
+    return text
+
+
+def _escape_attrib(value):
+    return _escape_text(value).replace('"', '&quot;').replace(
+        '\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#09;')
+
+
+class _GPXWriter(object):
+    """Writes a GPX document as it is parsed, without its extensions.
+
+    Feed this the events from :func:`_iter_gpx`. Each element is written
+    as soon as its contents are known and is then removed from the tree,
+    so the whole document is never held in memory. ``<extensions>``
+    elements (and anything in them) are dropped, as are the schemas for
+    them in the root's ``xsi:schemaLocation``.
+
+    :param dest: A file open for writing text
+    """
+
+    EXTENSIONS = '{%s}extensions' % GPX_NS
+    SCHEMA_LOCATION = '{%s}schemaLocation' % XSI_NS
+
+    def __init__(self, dest):
+        self.dest = dest
+        # Prefixes used for each namespace in the source
+        self._prefixes = {}
+        # One entry per open element, with the namespaces in scope for it
+        # (and the names we have already worked out in that scope)
+        self._stack = []
+        self._skipping = 0
+        self.dest.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+
+    def _qname(self, frame, name, decls, attribute=False):
+        qname = frame['names'].get((name, attribute))
+        if qname is not None:
+            return qname
+        if not name.startswith('{'):
+            return name
+
+        uri, local = name[1:].split('}', 1)
+        prefix = frame['ns'].get(uri)
+        if uri == XML_NS:
+            prefix = 'xml'
+        elif prefix is None or (attribute and not prefix):
+            prefix = self._prefixes.get(uri)
+            if prefix is None or (attribute and not prefix):
+                prefix = 'ns%i' % len(frame['ns'])
+            # Declare it here, for this element and its children
+            frame['ns'] = dict(frame['ns'], **{uri: prefix})
+            frame['names'] = dict(frame['names'])
+            decls.append((prefix, uri))
+        qname = prefix and '%s:%s' % (prefix, local) or local
+        frame['names'][(name, attribute)] = qname
+        return qname
+
+    def _add_child(self, frame):
+        # A child is starting, so everything before it is known
+        if not frame['started']:
+            self.dest.write(_escape_text(frame['elem'].text))
+            frame['started'] = True
+        if frame['last'] is not None:
+            self.dest.write(_escape_text(frame['last'].tail))
+
+    def start(self, elem):
+        if self._skipping or elem.tag == self.EXTENSIONS:
+            self._skipping += 1
+            return
+
+        attrib = elem.attrib
+        if self._stack:
+            parent = self._stack[-1]
+            self._add_child(parent)
+            frame = {'ns': parent['ns'], 'names': parent['names']}
+        else:
+            frame = {'ns': {}, 'names': {}}
+            schemas = attrib.get(self.SCHEMA_LOCATION)
+            if schemas:
+                # Only keep the GPX schema itself
+                attrib = dict(attrib)
+                attrib[self.SCHEMA_LOCATION] = ' '.join(
+                    x for x in schemas.split() if 'GPX/1/1' in x)
+        frame.update(elem=elem, started=False, last=None)
+
+        decls = []
+        tag = frame['tag'] = self._qname(frame, elem.tag, decls)
+        if attrib:
+            tag = ' '.join([tag] + [
+                '%s="%s"' % (self._qname(frame, k, decls, attribute=True),
+                             _escape_attrib(v))
+                for k, v in attrib.items()])
+        if decls:
+            tag = ' '.join([tag] + [
+                '%s="%s"' % (prefix and 'xmlns:%s' % prefix or 'xmlns',
+                             _escape_attrib(uri))
+                for prefix, uri in decls])
+        self.dest.write('<%s>' % tag)
+        self._stack.append(frame)
+
+    def end(self, elem):
+        if self._skipping:
+            self._skipping -= 1
+            if not self._skipping:
+                parent = self._stack[-1]
+                parent['elem'].remove(elem)
+                if parent['last'] is not None:
+                    # Use the whitespace after the extensions instead of
+                    # what came before them, to keep the indentation
+                    parent['last'] = elem
+                    del elem[:]
+            return
+
+        frame = self._stack.pop()
+        if not frame['started']:
+            self.dest.write(_escape_text(elem.text))
+        if frame['last'] is not None:
+            self.dest.write(_escape_text(frame['last'].tail))
+        self.dest.write('</%s>' % frame['tag'])
+
+        if self._stack:
+            # We still need our tail, which may not be known yet, but
+            # nothing else
+            parent = self._stack[-1]
+            parent['last'] = elem
+            parent['elem'].remove(elem)
+            elem.text = None
+            elem.attrib.clear()
+        else:
+            self.dest.write('\n')
+
+    def start_ns(self, prefix, uri):
+        self._prefixes.setdefault(uri, prefix)
+
+
+class _TrackColors(object):
+    """Picks out the names and colors of tracks from GPX parse events.
+
+    Feed this the ``start`` and ``end`` events from :func:`_iter_gpx`.
+    It only looks at each element as it ends, so it does not matter what
+    happens to the tree after that.
+    """
+
+    TRK = '{%s}trk' % GPX_NS
+    NAME = '{%s}name' % GPX_NS
+    COLOR_PATH = ['{%s}extensions' % GPX_NS,
+                  '{%s}TrackExtension' % GPXX_NS,
+                  '{%s}DisplayColor' % GPXX_NS]
+
+    def __init__(self):
+        self._path = []
+        self._count = 0
+        self._name = None
+        self._color = None
+
+    def start(self, elem):
+        self._path.append(elem.tag)
+
+    def end(self, elem):
+        """Handle the end of an element.
+
+        :returns: A tuple of (name, color) when a track with both ends,
+                  otherwise ``None``
+        """
+        path = self._path
+        track = None
+        if len(path) > 1 and path[1] == self.TRK:
+            if len(path) == 2:
+                track = self._finish()
+            elif path[2:] == [self.NAME]:
+                if self._name is None:
+                    self._name = elem.text
+            elif path[2:] == self.COLOR_PATH:
+                if self._color is None:
+                    self._color = elem.text
+        path.pop()
+        return track
+
+    def _finish(self):
+        self._count += 1
+        name, color = self._name, self._color
+        self._name = self._color = None
+        if name is None:
+            LOG.info('Skipping unnamed track #%i' % self._count)
+        elif color is None:
+            LOG.info('Skipping uncolored track #%i (%s)' % (self._count,
+                                                            name))
+        else:
+            return name, color
+
+
 def strip_gpx_extensions(source_file, dest_file):
     """Strip any GPX extensions from a file.
 
     Remove any GPX extensions from source_file and write the
-    result to dest_file.
+    result to dest_file. The file is processed as it is read, so memory
+    use does not depend on its size.
+
+    Since the track colors are lost along with the extensions, they are
+    collected on the way through and returned, as
+    :func:`get_track_colors_from_gpx` would for the source file.
 
     :param source_file: Source filename
     :type source_file: str
     :param dest_file: Destination filename
     :type dest_file: str
+    :returns: Dict of track name:color
     :raises Exception: If the source file is not a GPX file
     """
-    namespaces = {'': 'http://www.topografix.com/GPX/1/1'}
-    for ns, url in namespaces.items():
-        ET.register_namespace(ns, url)
-
-    try:
-        tree = ET.parse(source_file)
-    except ET.ParseError:
-        raise Exception('Input is not a GPX file')
+    tracks = {}
+    with open(source_file, 'rb') as source:
+        events = _iter_gpx(source)
+        # Make sure this is a GPX file before we create anything
+        first = next(events)
+        try:
+            with open(dest_file, 'w', encoding='utf-8') as dest:
+                writer = _GPXWriter(dest)
+                colors = _TrackColors()
+                for event, item in itertools.chain([first], events):
+                    if event == 'start':
+                        colors.start(item)
+                        writer.start(item)
+                    elif event == 'end':
+                        track = colors.end(item)
+                        if track:
+                            tracks[track[0]] = track[1]
+                        writer.end(item)
+                    else:
+                        writer.start_ns(*item)
+        except Exception:
+            # Do not leave a partial file behind
+            if os.path.exists(dest_file):
+                os.remove(dest_file)
+            raise
+    return tracks
 
-    root = tree.getroot()
-    if root.tag != '{http://www.topografix.com/GPX/1/1}gpx':
-        raise Exception('Input is not a GPX file')
 
-    # Remove the extension schemas
-    xsi = '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'
-    nslist = root.attrib[xsi]
-    nslist = ' '.join(x for x in nslist.split() if 'GPX/1/1' in x)
-    root.attrib[xsi] = nslist
+def iter_track_colors_from_gpx(source_file):
+    """Generate the names and colors of tracks in a GPX file.
 
-    # For each, wpt, trk, etc, remove the <extensions> if present
-    for elem in root.findall('*'):
-        ext = elem.find('{http://www.topografix.com/GPX/1/1}extensions')
-        if ext:
-            elem.remove(ext)
+    The file is scanned as it is read and discarded as it goes, so each
+    track is generated as soon as it ends, and memory use does not depend
+    on the size of the file. Tracks without a name or a color are
+    skipped.
 
-    tree.write(dest_file)
+    :param source_file: Source GPX filename
+    :type source_file: str
+    :returns: An iterator of (name, color) tuples, in file order
+    :raises Exception: If the source file is not a GPX file
+    """
+    with open(source_file, 'rb') as source:
+        colors = _TrackColors()
+        stack = []
+        for event, elem in _iter_gpx(source):
+            if event == 'start':
+                colors.start(elem)
+                stack.append(elem)
+            elif event == 'end':
+                track = colors.end(elem)
+                stack.pop()
+                if stack:
+                    stack[-1].remove(elem)
+                if track:
+                    yield track
 
 
 def get_track_colors_from_gpx(source_file):
     """Return a dict of track names and colors from a GPX file.
 
+    See :func:`iter_track_colors_from_gpx`.
+
     :param source_file: Source GPX filename
     :type source_file: str
     :returns: Dict of name:color
     """
-    namespaces = {'gpx': 'http://www.topografix.com/GPX/1/1',
-                  'gpxx': 'http://www.garmin.com/xmlschemas/GpxExtensions/v3'}
-    for ns, url in namespaces.items():
-        ET.register_namespace(ns, url)
-
-    try:
-        tree = ET.parse(source_file)
-    except ET.ParseError:
-        raise Exception('Input is not a GPX file')
-
-    root = tree.getroot()
-    if root.tag != '{http://www.topografix.com/GPX/1/1}gpx':
-        raise Exception('Input is not a GPX file')
-
-    tracks = {}
-    for i, trk in enumerate(root.findall('gpx:trk', namespaces)):
-        names = trk.findall('gpx:name', namespaces)
-        if not names:
-            LOG.info('Skipping unnamed track #%i' % (i + 1))
-            continue
-        name = names[0].text
-        colors = trk.findall(
-            'gpx:extensions/gpxx:TrackExtension/gpxx:DisplayColor',
-            namespaces)
-        if not colors:
-            LOG.info('Skipping uncolored track #%i (%s)' % (i + 1, name))
-            continue
-        color = colors[0].text
-
-        tracks[name] = color
-
-    return tracks
+    return dict(iter_track_colors_from_gpx(source_file))
 
 
 class ThingFormatter(object):
@@ -5,6 +5,9 @@ setup(
     version='0.1.1',
     packages=find_packages(),
     install_requires=['requests', 'prettytable', 'pytz', 'tzlocal', 'pyyaml', 'pathvalidate'],
+    extras_require={
+        'async': ['httpx'],
+    },
     entry_points={
         'console_scripts': ['gaiagps = gaiagps.shell:main'],
     },